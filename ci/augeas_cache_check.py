@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Check that the file cache and the shared Augeas session of a mounted
+guest see each other's changes.
+
+The calls the Linux system preparation tasks make on a GRUB legacy
+configuration are replayed on an in-memory guest: the boot menu timeout is
+changed through the file cache and then the root device is replaced through
+Augeas, before the media is unmounted. Both changes must end up in the file.
+The guest only understands a tiny subset of the guestfs API and its Augeas
+lens treats every line of a file as a `key value' pair.
+"""
+
+import os
+import sys
+from fnmatch import fnmatch
+
+CI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CI))
+
+from image_creator.guestfs_wrapper import GuestFS, FileIndex, FileCache, \
+    AugeasSession  # noqa
+
+MENU_LST = '/boot/grub/menu.lst'
+DEFAULT_GRUB = '/etc/default/grub'
+
+FILES = {
+    MENU_LST: "timeout 5\nroot /dev/sda1\n",
+    DEFAULT_GRUB: "GRUB_TIMEOUT 5\n",
+}
+
+EXPECTED = {
+    MENU_LST: "timeout 0\nroot UUID=abc\n",
+    DEFAULT_GRUB: "GRUB_TIMEOUT 0\n",
+}
+
+
+class Guest(object):
+    """An in-memory guest with a toy Augeas implementation"""
+
+    def __init__(self, files):
+        self.files = dict(files)
+        self.load = {}
+        self.tree = None
+
+    def cat(self, path):
+        """Returns the contents of a file"""
+        return self.files[path]
+
+    def write(self, path, content):
+        """Replace the contents of a file"""
+        self.files[path] = content
+
+    def readdir(self, directory):
+        """List a directory"""
+        names = set(p[len(directory):].lstrip('/').split('/')[0]
+                    for p in self.files if p.startswith(directory + '/'))
+        return [{'name': n, 'ftyp': 'r'} for n in names]
+
+    def umount_all(self):
+        """Nothing is mounted"""
+        pass
+
+    def aug_init(self, root, flags):
+        """Start an empty session"""
+        self.load = {}
+        self.tree = {}
+
+    def aug_close(self):
+        """Drop the session"""
+        self.tree = None
+
+    def aug_rm(self, path):
+        """Only removing the transforms is supported"""
+        self.load.pop(path.split('/')[3], None)
+
+    def aug_set(self, path, value):
+        """Set a transform option or a key of a loaded file"""
+        if path.startswith('/augeas/load/'):
+            name, option = path.split('/')[3:5]
+            options = self.load.setdefault(name, {})
+            options.setdefault(option.split('[')[0], []).append(value)
+            return
+        path, key = path[len('/files'):].rsplit('/', 1)
+        lines = self.tree[path]
+        for i, (name, _) in enumerate(lines):
+            if name == key:
+                lines[i] = (key, value)
+
+    def aug_get(self, path):
+        """Returns the value of a key of a loaded file"""
+        path, key = path[len('/files'):].rsplit('/', 1)
+        return dict(self.tree[path])[key]
+
+    def aug_load(self):
+        """Parse the files matched by the incl and not the excl patterns"""
+        self.tree = {}
+        for options in self.load.values():
+            for path in self.files:
+                name = path.rpartition('/')[2]
+                if any(fnmatch(path, p) for p in options['incl']) and \
+                        not any(fnmatch(name, p) for p in options['excl']):
+                    self.tree[path] = [tuple(line.split(' ', 1)) for line in
+                                       self.files[path].splitlines()]
+
+    def aug_save(self):
+        """Write back every loaded file"""
+        for path, lines in self.tree.items():
+            self.files[path] = ''.join('%s %s\n' % kv for kv in lines)
+
+
+def replay(guest):
+    """Make the calls the system preparation tasks make"""
+    g = GuestFS(lambda: guest)
+    files = FileCache(g)
+    fsindex = FileIndex(g, files)
+    augeas = AugeasSession(g)
+    files.add_observer(augeas.observe_file)
+    files.enable()
+    augeas.enable()
+
+    def augeas_load():
+        """Like LinuxOS._augeas_load()"""
+        augeas.add_transform('Shellvars', 'Shellvars.lns', [DEFAULT_GRUB])
+        augeas.add_transform('Grub', 'Grub.lns', [MENU_LST])
+        augeas.load()
+
+    # LinuxOS._change_bootmenu_timeout()
+    if fsindex.is_file(DEFAULT_GRUB):
+        augeas_load()
+        g.aug_set('/files%s/GRUB_TIMEOUT' % DEFAULT_GRUB, '0')
+    if fsindex.is_file(MENU_LST):
+        files.write(MENU_LST, files.cat(MENU_LST).replace('5', '0'))
+
+    # LinuxOS._persistent_grub1()
+    augeas_load()
+    root = '/files%s/root' % MENU_LST
+    if g.aug_get(root).startswith('/dev/'):
+        g.aug_set(root, 'UUID=abc')
+
+    # The umount() of the Mount context manager
+    try:
+        augeas.disable()
+    finally:
+        files.disable()
+    g.umount_all()
+    return g
+
+
+def main():
+    """Replay the calls and compare the files to the expected ones"""
+    guest = Guest(FILES)
+    g = replay(guest)
+
+    ok = True
+    for path in sorted(EXPECTED):
+        result = 'ok' if guest.files[path] == EXPECTED[path] else \
+            'FAILED: %r != %r' % (guest.files[path], EXPECTED[path])
+        ok = ok and result == 'ok'
+        print "%-22s %s" % (path, result)
+    print "guestfs calls: %d" % g.total_calls
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
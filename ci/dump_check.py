@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Check Image.dump() the way snf-mkimage calls it.
+
+A raw media file with random data and holes is dumped with the arguments
+snf-mkimage passes for its default options, and for a few variations. For
+each one, the checksum that is returned and the content of the dumped file
+are compared to the media, and the path taken is reported: `fast' if the
+file was copied by the kernel and `copy' if it was read in user space.
+"""
+
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+
+CI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CI))
+
+from image_creator.output import Output  # noqa
+from image_creator.image import Image  # noqa
+
+MB = 2 ** 20
+
+# The dump() arguments snf-mkimage uses for its default options, and the
+# options that change them
+DEFAULT_ARGS = {'md5': True, 'sparse': False, 'used_only': False,
+                'hashmap': None, 'compress': None, 'fmt': 'raw',
+                'bmap': None, 'pipeline': False}
+SCENARIOS = (('default', {}),
+             ('sparse', {'sparse': True}),
+             ('pipeline', {'pipeline': True}),
+             ('no-md5', {'md5': False}))
+
+
+def make_media(path, size, seed):
+    """Create a media file with random data. About a quarter of it is left
+    as holes.
+    """
+    rand = random.Random(seed)
+    with open(path, 'wb') as f:
+        for offset in xrange(0, size, MB):
+            if rand.random() < 0.25:
+                continue
+            f.seek(offset)
+            f.write(os.urandom(min(MB, size - offset)))
+        f.truncate(size)
+
+
+def file_md5(path):
+    """Returns the MD5 checksum of a file"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(MB), ''):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def check(image, name, args, outfile, expected):
+    """Dump the image and compare the result to the media"""
+    copies = []
+    copy = image._copy  # pylint: disable=protected-access
+
+    def counting_copy(*a, **kw):
+        """Record that the data was read in user space"""
+        copies.append(a[0])
+        return copy(*a, **kw)
+
+    image._copy = counting_copy  # pylint: disable=protected-access
+    try:
+        kwargs = dict(DEFAULT_ARGS)
+        kwargs.update(args)
+        start = time.time()
+        checksum = image.dump(outfile, **kwargs)
+        elapsed = time.time() - start
+    finally:
+        image._copy = copy  # pylint: disable=protected-access
+
+    errors = []
+    if kwargs['md5'] and checksum != expected:
+        errors.append("checksum %s != %s" % (checksum, expected))
+    if not kwargs['md5'] and checksum is not None:
+        errors.append("unexpected checksum %s" % checksum)
+    if file_md5(outfile) != expected:
+        errors.append("the dumped file differs from the media")
+    os.unlink(outfile)
+
+    print "%-10s %-5s %8.2f  %s" % (name, 'copy' if copies else 'fast',
+                                    elapsed, '; '.join(errors) or 'ok')
+    return not errors
+
+
+def main():
+    """Parse the arguments and run the checks"""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split('\n\n', 1)[1])
+    parser.add_argument('--size', type=int, default=64,
+                        help="size of the media in MB [default: %(default)s]")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the generated data")
+    parser.add_argument('--tmpdir', default=None,
+                        help="create the files under this directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.tmpdir)
+    media = os.path.join(workdir, 'media.raw')
+    try:
+        make_media(media, args.size * MB, args.seed)
+        expected = file_md5(media)
+
+        image = Image(media, Output())
+        # Image.enable() would launch the helper VM to find this out
+        image.size = os.path.getsize(media)
+
+        print "%-10s %-5s %8s  %s" % ('scenario', 'path', 'time (s)',
+                                      'result')
+        ok = True
+        for name, scenario in SCENARIOS:
+            ok = check(image, name, scenario,
+                       os.path.join(workdir, 'dump.raw'), expected) and ok
+    finally:
+        for name in os.listdir(workdir):
+            os.unlink(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
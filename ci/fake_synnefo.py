@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for the Synnefo services used by snf-image-creator.
+
+The server speaks enough of the Astakos (identity), Pithos+ (object storage)
+and Image APIs for what kamaki_wrapper.Kamaki needs: authentication and the
+service catalog, container creation and info, object creation from a
+hashmap including the missing block replies, block uploads, object info,
+hashmaps and sharing, and image registration. Only the hashes and the sizes
+of the blocks are kept, not their data.
+
+A fixed latency can be added to every request and the bandwidth of the
+request and the response bodies can be limited, to approximate a remote
+deployment. The requests served and the bytes transferred are counted.
+"""
+
+import sys
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from collections import defaultdict
+
+TOKEN = 'fake-token'
+USER = 'fake-user-uuid'
+BLOCK_SIZE = 4 * 2 ** 20
+BLOCK_HASH = 'sha256'
+
+IDENTITY = '/identity/v2.0'
+ACCOUNT = '/account/v1.0'
+UI = '/ui'
+OBJECT_STORE = '/object-store/v1'
+IMAGE = '/image/v1.0'
+
+CHUNK = 2 ** 16
+
+
+def hash_block(block, blockhash=BLOCK_HASH):
+    """Hash a block the way Pithos+ does"""
+    return hashlib.new(blockhash, block.rstrip('\x00')).hexdigest()
+
+
+class Throttle(object):
+    """Limits the rate of a link shared by all the connections"""
+
+    def __init__(self, rate=None):
+        """Create a Throttle instance. rate is in bytes per second, None
+        means unlimited.
+        """
+        self.rate = rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """Wait until size bytes may pass through the link"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + float(size) / self.rate
+            delay = self._next - now
+        time.sleep(delay)
+
+
+class Store(object):
+    """The state of the fake deployment"""
+
+    def __init__(self):
+        """Create an empty Store instance"""
+        self.lock = threading.Lock()
+        self.blocks = {}  # hash -> size
+        self.containers = defaultdict(dict)  # account -> name -> objects
+        self.images = {}
+
+    def put_blocks(self, data):
+        """Store the blocks of data. Returns their hashes."""
+        hashes = []
+        for offset in xrange(0, len(data), BLOCK_SIZE):
+            block = data[offset:offset + BLOCK_SIZE]
+            block_hash = hash_block(block)
+            with self.lock:
+                self.blocks[block_hash] = len(block)
+            hashes.append(block_hash)
+        return hashes
+
+    def missing(self, hashes):
+        """Returns the hashes of the blocks that are not stored"""
+        with self.lock:
+            return [h for h in hashes if h not in self.blocks]
+
+
+class Stats(object):
+    """Counters of the requests served"""
+
+    def __init__(self):
+        """Create a Stats instance"""
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zero the counters"""
+        with self._lock:
+            self.requests = defaultdict(int)
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def add(self, operation, bytes_in, bytes_out):
+        """Record a request"""
+        with self._lock:
+            self.requests[operation] += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def snapshot(self):
+        """Returns the counters as a dictionary"""
+        with self._lock:
+            return {'requests': dict(self.requests),
+                    'total_requests': sum(self.requests.values()),
+                    'bytes_in': self.bytes_in,
+                    'bytes_out': self.bytes_out}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the requests of a single connection"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        """Log the requests only if asked to"""
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, fmt, *args)
+
+    def _read_body(self):
+        """Read the body of the request through the throttled link"""
+        length = int(self.headers.get('content-length') or 0)
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(CHUNK, length))
+            if not chunk:
+                break
+            self.server.throttle_in.consume(len(chunk))
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    def _reply(self, status, body='', headers=None, content_type=None):
+        """Send a response"""
+        if not isinstance(body, str):
+            body = json.dumps(body)
+            content_type = content_type or 'application/json'
+        self.send_response(status)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            for offset in xrange(0, len(body), CHUNK):
+                chunk = body[offset:offset + CHUNK]
+                self.server.throttle_out.consume(len(chunk))
+                self.wfile.write(chunk)
+        return len(body)
+
+    def _handle(self):
+        """Dispatch a request to the method that serves it"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlparse.urlparse(self.path)
+        path = urlparse.unquote(url.path)
+        query = urlparse.parse_qs(url.query, keep_blank_values=True)
+        body = self._read_body()
+
+        if path == '/_stats':
+            operation = None
+            sent = self._reply(200, self.server.stats.snapshot())
+        elif self.headers.get('x-auth-token') != self.server.token:
+            operation = 'unauthorized'
+            sent = self._reply(401, {'unauthorized': {
+                'message': 'Invalid token', 'code': 401}})
+        elif path.rstrip('/') == IDENTITY + '/tokens':
+            operation = 'authenticate'
+            sent = self._reply(200, self.server.catalog())
+        elif path.startswith(OBJECT_STORE + '/'):
+            parts = path[len(OBJECT_STORE) + 1:].split('/', 2)
+            operation, sent = self._pithos(parts, query, body)
+        elif path.rstrip('/') == IMAGE + '/images':
+            operation, sent = self._image(body)
+        else:
+            operation = 'unknown'
+            sent = self._reply(404, 'Not Found')
+
+        if operation is not None:
+            self.server.stats.add(operation, len(body), sent)
+
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _handle
+
+    def _pithos(self, parts, query, body):
+        """Serve a Pithos+ request. Returns the name of the operation and the
+        size of the response body.
+        """
+        store = self.server.store
+        account = parts[0]
+        container = parts[1] if len(parts) > 1 and parts[1] else None
+        obj = parts[2] if len(parts) > 2 and parts[2] else None
+        method = self.command
+
+        if container is None:
+            return 'account_%s' % method.lower(), self._reply(204)
+
+        containers = store.containers[account]
+        if obj is None:
+            operation = 'container_%s' % method.lower()
+            if method == 'PUT':
+                with store.lock:
+                    exists = container in containers
+                    containers.setdefault(container, {})
+                return operation, self._reply(202 if exists else 201)
+            if container not in containers:
+                return operation, self._reply(404, 'Container not found')
+            if method == 'HEAD':
+                return operation, self._reply(204, headers={
+                    'X-Container-Block-Size': BLOCK_SIZE,
+                    'X-Container-Block-Hash': BLOCK_HASH,
+                    'X-Container-Object-Count': len(containers[container])})
+            if method == 'POST' and 'update' in query:
+                # Block upload
+                return operation, self._reply(202, store.put_blocks(body))
+            if method == 'GET':
+                return operation, self._reply(
+                    200, '\n'.join(sorted(containers[container])))
+            return operation, self._reply(405, 'Method not allowed')
+
+        operation = 'object_%s' % method.lower()
+        if container not in containers:
+            return operation, self._reply(404, 'Container not found')
+        objects = containers[container]
+
+        if method == 'PUT':
+            content_type = self.headers.get('content-type',
+                                            'application/octet-stream')
+            if 'hashmap' in query:
+                operation = 'object_put_hashmap'
+                hashmap = json.loads(body)
+                hashes = [str(h) for h in hashmap['hashes']]
+                missing = store.missing(hashes)
+                if missing:
+                    return operation, self._reply(409, missing)
+                size = int(hashmap['bytes'])
+            else:
+                hashes = store.put_blocks(body)
+                size = len(body)
+            with store.lock:
+                objects[obj] = {'hashes': hashes, 'bytes': size,
+                                'content_type': content_type,
+                                'sharing': None}
+            return operation, self._reply(201)
+
+        with store.lock:
+            info = objects.get(obj)
+        if info is None:
+            return operation, self._reply(404, 'Object not found')
+
+        if method == 'HEAD':
+            headers = {'Content-Type': info['content_type'],
+                       'X-Object-Hash': hashlib.new(BLOCK_HASH, ''.join(
+                           info['hashes'])).hexdigest(),
+                       'X-Object-Size': info['bytes']}
+            if info['sharing']:
+                headers['X-Object-Sharing'] = info['sharing']
+            return operation, self._reply(200, headers=headers)
+        if method == 'GET' and 'hashmap' in query:
+            operation = 'object_get_hashmap'
+            return operation, self._reply(200, {
+                'block_size': BLOCK_SIZE, 'block_hash': BLOCK_HASH,
+                'bytes': info['bytes'], 'hashes': info['hashes']})
+        if method == 'POST':
+            sharing = self.headers.get('x-object-sharing')
+            if sharing is not None:
+                info['sharing'] = sharing
+            return operation, self._reply(202)
+        if method == 'DELETE':
+            with store.lock:
+                objects.pop(obj, None)
+            return operation, self._reply(204)
+        # The data of the blocks is not kept
+        return operation, self._reply(501, 'Not implemented')
+
+    def _image(self, body):
+        """Serve an image registration request"""
+        if self.command != 'POST':
+            return 'image_%s' % self.command.lower(), self._reply(
+                405, 'Method not allowed')
+
+        meta = {}
+        for key, val in self.headers.items():
+            if key.lower().startswith('x-image-meta-'):
+                meta[key.lower()] = val
+        image_id = str(uuid.uuid4())
+        meta['x-image-meta-id'] = image_id
+        meta['x-image-meta-status'] = 'available'
+        with self.server.store.lock:
+            self.server.store.images[image_id] = meta
+        return 'image_register', self._reply(200, headers=meta)
+
+
+class FakeSynnefo(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server that plays the role of a Synnefo deployment"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), token=TOKEN, latency=0,
+                 bandwidth=None, verbose=False):
+        """Create a FakeSynnefo instance. latency is in seconds and
+        bandwidth in bytes per second.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.token = token
+        self.latency = latency
+        self.throttle_in = Throttle(bandwidth)
+        self.throttle_out = Throttle(bandwidth)
+        self.verbose = verbose
+        self.store = Store()
+        self.stats = Stats()
+        self._thread = None
+
+    @property
+    def url(self):
+        """The base URL of the server"""
+        return 'http://%s:%d' % self.server_address[:2]
+
+    @property
+    def auth_url(self):
+        """The authentication URL to pass to the clients"""
+        return self.url + IDENTITY
+
+    def catalog(self):
+        """Returns the reply to an authentication request"""
+        def service(name, service_type, path, version):
+            """An entry of the service catalog"""
+            return {'name': name, 'type': service_type, 'endpoints': [{
+                'versionId': version, 'publicURL': self.url + path,
+                'SNF:uiURL': self.url + UI}]}
+
+        return {'access': {
+            'token': {'id': self.token, 'expires': '2100-01-01T00:00:00Z',
+                      'tenant': {'id': USER, 'name': 'Fake User'}},
+            'user': {'id': USER, 'name': 'Fake User', 'roles': [],
+                     'roles_links': []},
+            'serviceCatalog': [
+                service('astakos_identity', 'identity', IDENTITY, 'v2.0'),
+                service('astakos_account', 'account', ACCOUNT, 'v1.0'),
+                service('pithos_object-store', 'object-store', OBJECT_STORE,
+                        'v1'),
+                service('cyclades_plankton', 'image', IMAGE, 'v1.0')]}}
+
+    def start(self):
+        """Serve requests in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop a server started with start()"""
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+
+def main():
+    """Run the server in the foreground"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--address', default='127.0.0.1',
+                        help="listen on this address [default: %(default)s]")
+    parser.add_argument('--port', type=int, default=8080,
+                        help="listen on this port [default: %(default)s]")
+    parser.add_argument('--token', default=TOKEN,
+                        help="accept this token [default: %(default)s]")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="add this many milliseconds to every request")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="limit each direction to this many MB/s")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="log every request")
+    args = parser.parse_args()
+
+    server = FakeSynnefo(
+        (args.address, args.port), args.token, args.latency / 1000.0,
+        args.bandwidth * 2 ** 20 if args.bandwidth else None, args.verbose)
+    sys.stderr.write("Authentication URL: %s\nToken: %s\nStatistics: %s\n" %
+                     (server.auth_url, server.token, server.url + '/_stats'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how the resources of the libguestfs helper VM affect the time it
+takes to shrink a large file system.
+
+A sparse disk with a single ext4 partition is created and partly filled
+with files. For every helper VM configuration, a copy of the disk is made
+and the operations snf-image-creator runs when shrinking an image are timed:
+the forced file system check, the shrinking to the minimum size and the
+enlarging to the partition size.
+
+A configuration is given as MEMSIZE:SMP[:unsafe], where MEMSIZE is in MB,
+a `-' keeps the libguestfs default and `unsafe' adds the drive with the
+cache mode meant for throwaway snapshots. `default' stands for -:- and
+`auto' for the resources host_appliance_params() selects for this host with
+the unsafe cache mode.
+
+The first configuration is the baseline. After the individual results, the
+mean times of every configuration are compared to the ones of the baseline.
+With the default configurations, this compares the helper VM snf-mkimage
+launches, which has the libguestfs defaults, with one sized to the host.
+The results are what any change of those defaults needs to be based on.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+CI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CI))
+
+from image_creator.image import ApplianceParams, host_appliance_params, \
+    setup_appliance, add_drive  # noqa
+import guestfs  # noqa pylint: disable=wrong-import-order
+
+GB = 2 ** 30
+
+
+def parse_config(spec):
+    """Returns the (ApplianceParams, throwaway) pair of a configuration"""
+    if spec == 'default':
+        return ApplianceParams(None, None), False
+    if spec == 'auto':
+        return host_appliance_params(), True
+
+    fields = spec.split(':')
+    if len(fields) not in (2, 3) or fields[2:] not in ([], ['unsafe']):
+        raise ValueError("Invalid configuration: %s" % spec)
+
+    def value(field):
+        """Parse a resource value"""
+        return None if field == '-' else int(field)
+
+    return ApplianceParams(value(fields[0]), value(fields[1])), \
+        len(fields) == 3
+
+
+def create_disk(path, size, used, files):
+    """Create a disk with an ext4 file system. used bytes of it are taken
+    by files of equal size.
+    """
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    g = guestfs.GuestFS()
+    add_drive(g, path, True)
+    setup_appliance(g, host_appliance_params())
+    g.launch()
+    try:
+        g.part_disk('/dev/sda', 'msdos')
+        g.mkfs('ext4', '/dev/sda1')
+        g.mount('/dev/sda1', '/')
+        for i in xrange(files):
+            g.fallocate64('/file%d' % i, used // files)
+            # Small files scattered among the large ones
+            g.mkdir('/dir%d' % i)
+            g.fill_dir('/dir%d' % i, 100)
+        g.umount_all()
+        g.shutdown()
+    finally:
+        g.close()
+
+
+def measure(path, spec, tmpdir):
+    """Time the shrinking operations on a copy of the disk"""
+    params, throwaway = parse_config(spec)
+    fd, copy = tempfile.mkstemp(dir=tmpdir)
+    os.close(fd)
+    try:
+        subprocess.check_call(['cp', '--sparse=always', path, copy])
+
+        result = {'config': spec, 'memsize': params.memsize,
+                  'smp': params.smp, 'unsafe': throwaway}
+        g = guestfs.GuestFS()
+        try:
+            add_drive(g, copy, throwaway)
+            setup_appliance(g, params)
+
+            steps = (('launch', g.launch),
+                     ('e2fsck', lambda: g.e2fsck('/dev/sda1', forceall=1)),
+                     ('resize2fs_M', lambda: g.resize2fs_M('/dev/sda1')),
+                     ('resize2fs', lambda: g.resize2fs('/dev/sda1')),
+                     ('shutdown', g.shutdown))
+            for name, step in steps:
+                start = time.time()
+                step()
+                result[name] = time.time() - start
+        finally:
+            g.close()
+
+        result['shrink'] = sum(result[step] for step in
+                               ('e2fsck', 'resize2fs_M', 'resize2fs'))
+        return result
+    finally:
+        os.unlink(copy)
+
+
+def compare(results, baseline):
+    """Print the mean times of each configuration and their speedup over
+    the baseline configuration
+    """
+    steps = ('launch', 'shrink')
+    means = {}
+    configs = []
+    for r in results:
+        if r['config'] not in means:
+            configs.append(r['config'])
+            means[r['config']] = dict((step, []) for step in steps)
+        for step in steps:
+            means[r['config']][step].append(r[step])
+    for config in configs:
+        for step in steps:
+            times = means[config][step]
+            means[config][step] = sum(times) / len(times)
+
+    fmt = "%-16s %8s %8s %8s"
+    print
+    print fmt % ('config', 'launch', 'shrink', 'speedup')
+    base = means[baseline]['launch'] + means[baseline]['shrink']
+    for config in configs:
+        total = means[config]['launch'] + means[config]['shrink']
+        print fmt % (config, '%.1f' % means[config]['launch'],
+                     '%.1f' % means[config]['shrink'],
+                     '%.2fx' % (base / total) if total else '-')
+
+
+def main():
+    """Parse the arguments and run the benchmark"""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split('\n\n', 1)[1])
+    parser.add_argument('--size', type=int, default=64,
+                        help="size of the disk in GB [default: %(default)s]")
+    parser.add_argument('--used', type=float, default=0.3,
+                        help="ratio of the file system taken by files "
+                        "[default: %(default)s]")
+    parser.add_argument('--files', type=int, default=64,
+                        help="number of large files [default: %(default)s]")
+    parser.add_argument('--configs', default='default,auto',
+                        help="comma separated helper VM configurations "
+                        "[default: %(default)s]")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="measure each configuration this many times")
+    parser.add_argument('--tmpdir', default=None,
+                        help="create the disks under this directory")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the results to FILE as JSON")
+    args = parser.parse_args()
+
+    configs = args.configs.split(',')
+    try:
+        for spec in configs:
+            parse_config(spec)
+    except ValueError as e:
+        parser.error(str(e))
+
+    fd, path = tempfile.mkstemp(dir=args.tmpdir)
+    os.close(fd)
+    results = []
+    try:
+        sys.stderr.write("Creating a %d GB disk ...\n" % args.size)
+        create_disk(path, args.size * GB, int(args.size * GB * args.used),
+                    args.files)
+        for _ in xrange(args.repeat):
+            for spec in configs:
+                sys.stderr.write("Measuring %s ...\n" % spec)
+                results.append(measure(path, spec, args.tmpdir))
+    finally:
+        os.unlink(path)
+
+    fmt = "%-16s %8s %4s %6s %8s %8s %11s %9s %8s"
+    print fmt % ('config', 'memsize', 'smp', 'unsafe', 'launch', 'e2fsck',
+                 'resize2fs_M', 'resize2fs', 'shrink')
+    for r in results:
+        print fmt % (r['config'], r['memsize'] or '-', r['smp'] or '-',
+                     'yes' if r['unsafe'] else 'no', '%.1f' % r['launch'],
+                     '%.1f' % r['e2fsck'], '%.1f' % r['resize2fs_M'],
+                     '%.1f' % r['resize2fs'], '%.1f' % r['shrink'])
+    compare(results, configs[0])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Count the calls snf-image-creator makes to the libguestfs helper VM while
+inspecting an image and running the system preparation tasks on it.
+
+The media is snapshotted, so it is left untouched. The calls are counted on
+the libguestfs handle itself, which allows comparing trees that predate the
+counting done by snf-image-creator. To get the counts before and after a
+change, run the script once against a checkout of each tree:
+
+    git worktree add /tmp/before <commit>
+    ci/sysprep_calls.py --tree /tmp/before media.raw
+    ci/sysprep_calls.py media.raw
+
+The script needs to run as root, like snf-mkimage.
+"""
+
+import os
+import sys
+import argparse
+from collections import Counter
+
+CI = os.path.dirname(os.path.abspath(__file__))
+
+CALLS = Counter()
+
+
+def count_calls(guestfs):
+    """Make the guestfs handles count the calls made to them"""
+    base = guestfs.GuestFS
+
+    class CountingGuestFS(base):
+        """A guestfs handle that counts the calls made to it"""
+        def __getattribute__(self, name):
+            attr = base.__getattribute__(self, name)
+            if name.startswith('_') or not callable(attr):
+                return attr
+
+            def call(*args, **kwargs):
+                """Count the call and make it"""
+                CALLS[name] += 1
+                return attr(*args, **kwargs)
+            return call
+
+    guestfs.GuestFS = CountingGuestFS
+
+
+def report(phases):
+    """Print the calls made in each phase"""
+    names = sorted(set(n for _, calls in phases for n in calls),
+                   key=lambda n: -sum(c[n] for _, c in phases))
+    fmt = "%-28s" + " %12s" * len(phases)
+    print fmt % (('call',) + tuple(p for p, _ in phases))
+    for name in names:
+        print fmt % ((name,) + tuple(c[name] for _, c in phases))
+    print fmt % (('total',) + tuple(sum(c.values()) for _, c in phases))
+
+
+def main():
+    """Parse the arguments, inspect the media and run the system
+    preparation
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split('\n\n', 1)[1])
+    parser.add_argument('media', help="the reference image")
+    parser.add_argument('--tree', default=os.path.dirname(CI),
+                        help="the snf-image-creator tree to use "
+                        "[default: %(default)s]")
+    parser.add_argument('--tmpdir', default=None,
+                        help="create the snapshot under this directory")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        parser.error("You must run %s as root" % sys.argv[0])
+
+    sys.path.insert(0, os.path.abspath(args.tree))
+
+    import guestfs
+    count_calls(guestfs)
+
+    from image_creator.output.cli import SimpleOutput
+    from image_creator.disk import Disk
+
+    phases = []
+    disk = Disk(args.media, SimpleOutput(), args.tmpdir)
+    try:
+        image = disk.get_image(disk.snapshot())
+        phases.append(('inspection', Counter(CALLS)))
+
+        image.os.do_sysprep()
+        phases.append(('sysprep', CALLS - phases[0][1]))
+    finally:
+        disk.cleanup()
+
+    report(phases)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the upload paths of kamaki_wrapper.Kamaki against a local
+stand-in for a Synnefo deployment (see fake_synnefo.py).
+
+Each scenario uploads a generated image to a fresh storage service and
+records the time it took, the throughput, the requests served per type and
+the bytes that crossed the wire. The scenarios are:
+
+  kamaki       the plain kamaki upload, without a precomputed hashmap
+  hashmap-wN   an upload with a precomputed hashmap over N connections
+  existing     uploading the same image again, when all the blocks exist
+  delta        uploading a modified image against the previous one with
+               --base-object
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import tempfile
+import argparse
+
+CI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CI))
+sys.path.insert(0, CI)
+
+from fake_synnefo import FakeSynnefo, Store  # noqa
+
+from image_creator.output import Output  # noqa
+from image_creator.kamaki_wrapper import Kamaki, CONTAINER  # noqa
+
+MB = 2 ** 20
+
+
+def make_image(path, size, seed, zero_ratio=0.25):
+    """Create a file with random data. About zero_ratio of its blocks only
+    contain zeros, like the free space of a file system.
+    """
+    rand = random.Random(seed)
+    with open(path, 'wb') as f:
+        done = 0
+        while done < size:
+            length = min(MB, size - done)
+            if rand.random() < zero_ratio:
+                f.write('\x00' * length)
+            else:
+                f.write(os.urandom(length))
+            done += length
+
+
+def modify_image(src, dst, ratio, seed):
+    """Copy an image, overwriting about ratio of its megabytes"""
+    shutil.copyfile(src, dst)
+    rand = random.Random(seed)
+    size = os.path.getsize(dst)
+    with open(dst, 'r+b') as f:
+        for offset in xrange(0, size, MB):
+            if rand.random() < ratio:
+                f.seek(offset)
+                f.write(os.urandom(min(MB, size - offset)))
+
+
+def file_hashmap(kamaki, path, workers):
+    """Compute the hashmap of a file the way snf-mkimage does"""
+    hashmap = kamaki.new_hashmap(CONTAINER, workers)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(hashmap.blocksize)
+            if not data:
+                break
+            hashmap.update(data)
+    hashmap.finish()
+    return hashmap
+
+
+def measure(server, name, path, func):
+    """Run a scenario and return its statistics"""
+    server.stats.reset()
+    start = time.time()
+    func()
+    elapsed = max(time.time() - start, 0.001)
+
+    result = server.stats.snapshot()
+    size = os.path.getsize(path)
+    result.update({'scenario': name, 'elapsed': elapsed, 'size': size,
+                   'throughput': float(size) / MB / elapsed})
+    return result
+
+
+def run(args, server, workdir):
+    """Run all the scenarios"""
+    image = os.path.join(workdir, 'image.raw')
+    modified = os.path.join(workdir, 'modified.raw')
+    make_image(image, args.size * MB, args.seed)
+    modify_image(image, modified, args.delta, args.seed + 1)
+
+    account = Kamaki.create_account(server.auth_url, server.token)
+    assert account is not None, "Authentication failed"
+    kamaki = Kamaki(account, Output())
+
+    def upload(path, remote, hashmap=None, workers=1, base=None):
+        """Upload a file"""
+        with open(path, 'rb') as f:
+            kamaki.upload(f, os.path.getsize(path), remote, CONTAINER,
+                          hashmap=hashmap, workers=workers, base=base)
+
+    results = []
+
+    def fresh():
+        """Forget the blocks and objects stored so far"""
+        containers = server.store.containers
+        server.store = Store()
+        for account_name, names in containers.items():
+            for container in names:
+                server.store.containers[account_name][container] = {}
+
+    # The hashmaps are computed before the measurement, like snf-mkimage
+    # does while dumping the image.
+    hashmap = file_hashmap(kamaki, image, args.hash_workers)
+
+    fresh()
+    results.append(measure(server, 'kamaki', image,
+                           lambda: upload(image, 'kamaki.raw')))
+
+    for workers in args.workers:
+        fresh()
+        results.append(measure(
+            server, 'hashmap-w%d' % workers, image,
+            lambda: upload(image, 'image.raw', hashmap, workers)))
+
+    workers = max(args.workers)
+    results.append(measure(
+        server, 'existing', image,
+        lambda: upload(image, 'image.raw', hashmap, workers)))
+
+    base = kamaki.get_hashmap('%s/image.raw' % CONTAINER)
+    modified_hashmap = file_hashmap(kamaki, modified, args.hash_workers)
+    results.append(measure(
+        server, 'delta', modified,
+        lambda: upload(modified, 'modified.raw', modified_hashmap, workers,
+                       base)))
+    return results
+
+
+def report(results):
+    """Print a table with the results"""
+    fmt = "%-12s %9s %10s %9s %11s %10s  %s"
+    print fmt % ('scenario', 'time (s)', 'MB/s', 'requests', 'MB sent',
+                 'MB recv', 'requests per type')
+    for r in results:
+        requests = ', '.join('%s=%d' % item
+                             for item in sorted(r['requests'].items()))
+        print fmt % (r['scenario'], '%.2f' % r['elapsed'],
+                     '%.1f' % r['throughput'], r['total_requests'],
+                     '%.1f' % (float(r['bytes_in']) / MB),
+                     '%.1f' % (float(r['bytes_out']) / MB), requests)
+
+
+def main():
+    """Parse the arguments and run the benchmark"""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split('\n\n', 1)[1])
+    parser.add_argument('--size', type=int, default=256,
+                        help="size of the image in MB [default: %(default)s]")
+    parser.add_argument('--latency', type=float, default=20,
+                        help="latency of each request in milliseconds "
+                        "[default: %(default)s]")
+    parser.add_argument('--bandwidth', type=float, default=100,
+                        help="bandwidth of each direction in MB/s, 0 for "
+                        "unlimited [default: %(default)s]")
+    parser.add_argument('--workers', default='1,4,8',
+                        help="comma separated numbers of upload connections "
+                        "to try [default: %(default)s]")
+    parser.add_argument('--hash-workers', type=int, default=4,
+                        help="number of threads for hashing "
+                        "[default: %(default)s]")
+    parser.add_argument('--delta', type=float, default=0.1,
+                        help="ratio of the image modified for the delta "
+                        "upload [default: %(default)s]")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for generating the image")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write the results to FILE as JSON")
+    args = parser.parse_args()
+    args.workers = [int(w) for w in args.workers.split(',')]
+
+    workdir = tempfile.mkdtemp(prefix='snf-upload-benchmark-')
+    # Do not let the session cache of the user leak into the measurements
+    os.environ['XDG_CACHE_HOME'] = workdir
+
+    server = FakeSynnefo(latency=args.latency / 1000.0,
+                         bandwidth=args.bandwidth * MB or None)
+    server.start()
+    try:
+        results = run(args, server, workdir)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
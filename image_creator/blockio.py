@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides helper functions for reading the payload of an image
+and writing it out, taking holes and zero blocks into account.
+"""
+
+import os
+import stat
+import errno
+import fcntl
+import struct
+import ctypes
+import ctypes.util
+import mmap
+import threading
+import Queue
+from collections import namedtuple
+
+from image_creator.util import FatalError
+
+# Python 2 does not export those. The values are the same on all Linux
+# architectures.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# ioctl requests for sharing extents between files (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940d
+
+# Errors that mean that a fast copy method is not supported for the files
+UNSUPPORTED = (errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EXDEV,
+               errno.EINVAL, errno.EBADF, errno.ETXTBSY)
+
+# Values of the posix_fadvise(2) advice argument
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# Alignment of the buffers and the offsets used with O_DIRECT
+ALIGNMENT = 4096
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _libc_function(name, restype, argtypes):
+    """Returns a function of the C library or None if it is missing"""
+    func = getattr(_libc, name, None)
+    if func is not None:
+        func.restype = restype
+        func.argtypes = argtypes
+    return func
+
+
+# copy_file_range needs glibc 2.27 or newer
+_copy_file_range = _libc_function(
+    'copy_file_range', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint])
+_pread = _libc_function(
+    'pread64', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64])
+_posix_fadvise = _libc_function(
+    'posix_fadvise64', ctypes.c_int,
+    [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+_fallocate = _libc_function(
+    'fallocate64', ctypes.c_int,
+    [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+
+# The parameters of the I/O performed when reading or writing images:
+#   blocksize: the size of each read request
+#   direct: read the source bypassing the page cache (O_DIRECT)
+#   nocache: drop the data from the page cache after it is consumed
+IOParams = namedtuple('IOParams', 'blocksize direct nocache')
+DEFAULT_IO = IOParams(2 ** 22, False, False)
+
+
+def fadvise(fd, offset, length, advice):
+    """Give a hint to the kernel about the access pattern of a file. Any
+    error is ignored, since this is only an optimization.
+    """
+    if _posix_fadvise is not None:
+        _posix_fadvise(fd, offset, length, advice)
+
+
+def fallocate(fd, offset, length):
+    """Allocate disk space for a file. Returns False if this is not
+    supported.
+    """
+    if _fallocate is None or _fallocate(fd, 0, offset, length) != 0:
+        return False
+    return True
+
+
+def data_ranges(fd, size):
+    """Returns a list of (offset, length) tuples with the parts of the first
+    size bytes of a file that contain data.
+
+    Holes are detected using SEEK_DATA/SEEK_HOLE. If the file is not a regular
+    file or the underlying file system does not support them, a single range
+    covering the whole file is returned.
+    """
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return [(0, size)]
+
+    ranges = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # Only a hole after offset
+                    break
+                raise
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            ranges.append((start, end - start))
+            offset = end
+    except OSError as e:
+        if e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+            return [(0, size)]
+        raise
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    return ranges
+
+
+def intersect(ranges_a, ranges_b):
+    """Returns the intersection of two sorted lists of non-overlapping
+    (offset, length) ranges.
+    """
+    result = []
+    i = j = 0
+    while i < len(ranges_a) and j < len(ranges_b):
+        a_start, a_end = ranges_a[i][0], ranges_a[i][0] + ranges_a[i][1]
+        b_start, b_end = ranges_b[j][0], ranges_b[j][0] + ranges_b[j][1]
+        start, end = max(a_start, b_start), min(a_end, b_end)
+        if start < end:
+            result.append((start, end - start))
+        if a_end < b_end:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class _Buffer(object):
+    """Page aligned, reusable buffer that data is read into"""
+
+    def __init__(self, size):
+        self.size = size
+        self._mmap = mmap.mmap(-1, size)
+        self._array = (ctypes.c_char * size).from_buffer(self._mmap)
+        self.address = ctypes.addressof(self._array)
+
+    def view(self, length):
+        """Returns a read-only view of the first length bytes"""
+        return buffer(self._mmap, 0, length)
+
+    def close(self):
+        """Release the memory of the buffer"""
+        del self._array
+        self._mmap.close()
+
+
+class BlockReader(object):
+    """Reads the first size bytes of a file or a block device in blocks.
+
+    The blocks are read by a background thread into a couple of reusable
+    buffers, so that reading the next block overlaps with processing the
+    current one. Depending on the I/O parameters, the source is read with
+    O_DIRECT or the data is dropped from the page cache after it has been
+    consumed.
+    """
+
+    def __init__(self, path, size, params=DEFAULT_IO, nbuffers=2):
+        """Create a BlockReader instance"""
+        self.path = path
+        self.size = size
+        self.params = params
+        self.nbuffers = nbuffers
+
+    def _open_direct(self):
+        """Open the source with O_DIRECT. Returns None if this fails."""
+        try:
+            return os.open(self.path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            return None
+
+    def _read(self, fds, buf, offset, length):
+        """Read a block into a buffer"""
+        done = 0
+        while done < length:
+            pos = offset + done
+            fd = fds['direct']
+            if fd is not None and pos % ALIGNMENT == 0:
+                # O_DIRECT needs aligned lengths too. Reading past the end of
+                # the payload is harmless.
+                count = min(_align(length - done, ALIGNMENT), buf.size - done)
+            else:
+                fd = fds['buffered']
+                count = length - done
+
+            ret = _pread(fd, buf.address + done, count, pos)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if fd == fds['direct'] and err == errno.EINVAL:
+                    # Misaligned request. Go on without O_DIRECT.
+                    os.close(fds['direct'])
+                    fds['direct'] = None
+                    continue
+                raise OSError(err, "Reading `%s' failed: %s" %
+                              (self.path, os.strerror(err)))
+            if ret == 0:
+                raise FatalError("Short read at offset %d. Expected %d bytes, "
+                                 "got %d" % (offset, length, done))
+            done += ret
+
+    def _reader(self, fds, tasks, free, full, stop):
+        """Body of the thread that reads the blocks"""
+        try:
+            for i, (offset, length) in enumerate(tasks):
+                if offset is None:
+                    full.put((length, None))
+                    continue
+
+                buf = free.get()
+                if stop.is_set():
+                    return
+
+                # Let the kernel prefetch the block after this one
+                for next_offset, next_length in tasks[i + 1:i + 2]:
+                    if next_offset is not None and fds['direct'] is None:
+                        fadvise(fds['buffered'], next_offset, next_length,
+                                POSIX_FADV_WILLNEED)
+
+                self._read(fds, buf, offset, length)
+                full.put((length, (offset, buf)))
+        except BaseException as e:
+            full.put((None, e))
+        else:
+            full.put((None, None))
+
+    def _tasks(self, fd, ranges):
+        """Returns the list of (offset, length) reads needed. Holes have a
+        None offset.
+        """
+        to_read = data_ranges(fd, self.size)
+        if ranges is not None:
+            to_read = intersect(to_read, ranges)
+
+        blocksize = self.params.blocksize
+        tasks = []
+        offset = 0
+        for start, length in to_read:
+            if start > offset:
+                tasks.append((None, start - offset))
+            offset = start + length
+            while length > 0:
+                chunk = min(length, blocksize)
+                tasks.append((start, chunk))
+                start += chunk
+                length -= chunk
+
+        if self.size > offset:
+            tasks.append((None, self.size - offset))
+        return tasks
+
+    def blocks(self, ranges=None):
+        """Generator that yields (length, data) tuples with the content of
+        the source.
+
+        data is a read-only buffer that is only valid until the next block is
+        requested. Consumers that need to keep the data should copy it.
+
+        Holes of the file are not read. For those, data is None and length is
+        the size of the hole, which may be larger than the block size. If
+        ranges is defined, only the parts of the file listed there are read
+        and everything else is treated as a hole.
+        """
+        fds = {'buffered': os.open(self.path, os.O_RDONLY), 'direct': None}
+        buffers = []
+        thread = None
+        stop = threading.Event()
+        free = Queue.Queue()
+        try:
+            tasks = self._tasks(fds['buffered'], ranges)
+            if self.params.direct:
+                fds['direct'] = self._open_direct()
+            fadvise(fds['buffered'], 0, self.size, POSIX_FADV_SEQUENTIAL)
+
+            size = _align(self.params.blocksize, ALIGNMENT)
+            for _ in xrange(self.nbuffers):
+                buffers.append(_Buffer(size))
+                free.put(buffers[-1])
+
+            full = Queue.Queue()
+            thread = threading.Thread(target=self._reader,
+                                      args=(fds, tasks, free, full, stop))
+            thread.daemon = True
+            thread.start()
+
+            while True:
+                length, item = full.get()
+                if length is None:
+                    if item is not None:
+                        raise item
+                    break
+
+                if item is None:
+                    yield length, None
+                    continue
+
+                offset, buf = item
+                yield length, buf.view(length)
+                if self.params.nocache:
+                    fadvise(fds['buffered'], offset, length,
+                            POSIX_FADV_DONTNEED)
+                free.put(buf)
+        finally:
+            stop.set()
+            if thread is not None:
+                free.put(None)  # Wake up the thread if it waits for a buffer
+                thread.join()
+            for fd in fds.values():
+                if fd is not None:
+                    os.close(fd)
+            for buf in buffers:
+                buf.close()
+
+
+class OutputFile(object):
+    """Wrapper of a file object opened for writing.
+
+    If nocache is True, the written data is periodically flushed to the
+    disk and dropped from the page cache, so that dumping large images does
+    not evict the cached data of other processes.
+    """
+
+    def __init__(self, fileobj, nocache=False, window=2 ** 26):
+        """Create an OutputFile instance"""
+        self.fileobj = fileobj
+        self.nocache = nocache
+        self.window = window
+        self._dirty = 0
+
+    def fileno(self):
+        """Returns the file descriptor of the file"""
+        return self.fileobj.fileno()
+
+    def allocate(self, size):
+        """Preallocate the disk space for size bytes of data, to avoid
+        fragmenting the file.
+        """
+        return fallocate(self.fileno(), 0, size)
+
+    def _drop_cache(self):
+        """Flush the written data and drop it from the page cache"""
+        self.fileobj.flush()
+        os.fdatasync(self.fileno())
+        fadvise(self.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+        self._dirty = 0
+
+    def write(self, data):
+        """Write data to the file"""
+        self.fileobj.write(data)
+        self._dirty += len(data)
+        if self.nocache and self._dirty >= self.window:
+            self._drop_cache()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Change the position of the file"""
+        self.fileobj.seek(offset, whence)
+
+    def tell(self):
+        """Returns the position of the file"""
+        return self.fileobj.tell()
+
+    def truncate(self, size):
+        """Truncate or extend the file"""
+        self.fileobj.truncate(size)
+
+    def close(self):
+        """Flush the written data. The underlying file object is not
+        closed.
+        """
+        if self.nocache:
+            self._drop_cache()
+        else:
+            self.fileobj.flush()
+
+
+def _align(value, alignment):
+    """Round value up to a multiple of alignment"""
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _reflink(src_fd, dst_fd, size):
+    """Make the first size bytes of the destination share the extents of
+    the source. Returns the number of bytes cloned.
+    """
+    if size == os.fstat(src_fd).st_size:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return size
+
+    # Only whole blocks can be cloned if the range does not end at EOF
+    blksize = os.fstat(dst_fd).st_blksize
+    length = size - size % blksize
+    if length:
+        arg = struct.pack('=qQQQ', src_fd, 0, length, 0)
+        fcntl.ioctl(dst_fd, FICLONERANGE, arg)
+    return length
+
+
+def _offload(src_fd, dst_fd, offset, size, progress=None):
+    """Copy from offset up to size using copy_file_range(2), which lets the
+    kernel or the file system perform the copy. Returns the offset reached.
+    """
+    if _copy_file_range is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    off_in = ctypes.c_int64(offset)
+    off_out = ctypes.c_int64(offset)
+    while off_in.value < size:
+        length = min(size - off_in.value, 2 ** 30)
+        ret = _copy_file_range(src_fd, ctypes.byref(off_in), dst_fd,
+                               ctypes.byref(off_out), length, 0)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if off_in.value > offset:  # Return what was copied so far
+                break
+            raise OSError(err, os.strerror(err))
+        if ret == 0:  # Unexpected EOF
+            break
+        if progress is not None:
+            progress(off_in.value)
+    return off_in.value
+
+
+def fast_copy(src_fd, dst_fd, size, progress=None):
+    """Copy the first size bytes of a regular file to another regular file
+    without moving the data through the user space.
+
+    A reflink (FICLONE/FICLONERANGE) is tried first, which completes in no
+    time on file systems that support it, like btrfs or xfs. Then
+    copy_file_range(2) is used to copy whatever is left. The number of bytes
+    copied from the start of the file is returned. If it is smaller than
+    size, the caller needs to copy the rest in some other way.
+
+    If progress is defined, it is called with the number of bytes copied.
+    """
+    if not (stat.S_ISREG(os.fstat(src_fd).st_mode) and
+            stat.S_ISREG(os.fstat(dst_fd).st_mode)):
+        return 0
+
+    done = 0
+    try:
+        done = _reflink(src_fd, dst_fd, size)
+    except (IOError, OSError) as e:
+        if e.errno not in UNSUPPORTED:
+            raise
+
+    if done < size:
+        try:
+            done = _offload(src_fd, dst_fd, done, size, progress)
+        except (IOError, OSError) as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+
+    if done and progress is not None:
+        progress(done)
+
+    # The caller continues writing from where the copy stopped
+    os.lseek(dst_fd, done, os.SEEK_SET)
+    return done
+
+
+class Zeros(object):
+    """Preallocated buffer of zeros used for detecting zero blocks and for
+    hashing holes without reading them.
+    """
+
+    def __init__(self, blocksize):
+        self.blocksize = blocksize
+        self.block = '\x00' * blocksize
+
+    def get(self, length):
+        """Return a string of length zeros"""
+        return self.block if length == self.blocksize else '\x00' * length
+
+    def chunks(self, length):
+        """Generator that splits a run of zeros in blocks"""
+        while length > 0:
+            chunk = min(length, self.blocksize)
+            yield self.get(chunk)
+            length -= chunk
+
+    def match(self, data):
+        """Check if a block contains only zeros"""
+        zeros = self.get(len(data))
+        return data == (zeros if isinstance(data, str) else buffer(zeros))
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the code for creating block map (bmap) files.
+
+A bmap file lists the ranges of blocks of an image that contain data,
+together with their checksums. It is used by bmaptool to copy an image to a
+disk without writing the unmapped ranges. The files created here follow
+version 2.0 of the format.
+"""
+
+import hashlib
+
+BMAP_VERSION = "2.0"
+BLOCKSIZE = 4096
+CHECKSUM = 'sha256'
+
+
+class Bmap(object):
+    """Computes the block map of an image while the image is being dumped.
+
+    The data is fed sequentially using update(), for ranges that are
+    written to the output file, and skip(), for ranges that are left
+    unmapped. A block is mapped if any part of it was fed with update().
+    """
+
+    def __init__(self, size, blocksize=BLOCKSIZE, checksum=CHECKSUM):
+        """Create a Bmap instance for an image of size bytes"""
+        self.size = size
+        self.blocksize = blocksize
+        self.checksum = checksum
+
+        # (first block, last block, checksum) of each mapped range
+        self.ranges = []
+
+        self._pos = 0
+        # Data of the current, partially fed block
+        self._partial = []
+        self._partial_size = 0
+        self._partial_mapped = False
+        # (first block, checksum object) of the range that is being built
+        self._current = None
+
+    def _close_range(self, end):
+        """Close the current range. end is the first block after it."""
+        if self._current is not None:
+            first, digest = self._current
+            self.ranges.append((first, end - 1, digest.hexdigest()))
+            self._current = None
+
+    def _blocks(self, data, mapped):
+        """Process data that starts at a block boundary"""
+        block = self._pos // self.blocksize
+        if mapped:
+            if self._current is None:
+                self._current = (block, hashlib.new(self.checksum))
+            self._current[1].update(data)
+        else:
+            self._close_range(block)
+        self._pos += len(data)
+
+    def _fill(self, data, mapped):
+        """Add data to the current partial block. Returns the number of
+        bytes consumed.
+        """
+        needed = self.blocksize - self._partial_size
+        chunk = data[:needed]
+        self._partial.append(chunk)
+        self._partial_size += len(chunk)
+        self._partial_mapped = self._partial_mapped or mapped
+
+        if self._partial_size == self.blocksize:
+            self._flush_partial()
+        return len(chunk)
+
+    def _flush_partial(self):
+        """Process the current partial block"""
+        if self._partial_size:
+            self._blocks(''.join(str(c) for c in self._partial),
+                         self._partial_mapped)
+            self._partial = []
+            self._partial_size = 0
+            self._partial_mapped = False
+
+    def update(self, data, mapped=True):
+        """Feed the bmap with the next part of the image. If mapped is
+        False, the data is treated like a hole.
+        """
+        offset = self._fill(data, mapped) if self._partial_size else 0
+        whole = (len(data) - offset) // self.blocksize * self.blocksize
+        if whole:
+            self._blocks(buffer(data, offset, whole), mapped)
+            offset += whole
+        if offset < len(data):
+            self._fill(buffer(data, offset), mapped)
+
+    def skip(self, length):
+        """Skip a part of the image that will not be mapped"""
+        if self._partial_size:
+            length -= self._fill('\x00' * min(
+                length, self.blocksize - self._partial_size), False)
+
+        whole = length // self.blocksize * self.blocksize
+        if whole:
+            self._close_range(self._pos // self.blocksize)
+            self._pos += whole
+            length -= whole
+
+        if length:
+            self._fill('\x00' * length, False)
+
+    def finish(self):
+        """Process the last, partial block of the image"""
+        self._flush_partial()
+        self._close_range((self._pos + self.blocksize - 1) // self.blocksize)
+        assert self._pos == self.size, "The bmap does not match the image"
+
+    def mapped_blocks(self):
+        """Returns the number of mapped blocks"""
+        return sum(last - first + 1 for first, last, _ in self.ranges)
+
+    def to_xml(self):
+        """Returns the content of the bmap file"""
+        blocks = (self.size + self.blocksize - 1) // self.blocksize
+        mapped = self.mapped_blocks()
+        percent = 100.0 * mapped / blocks if blocks else 0.0
+        # The checksum of the file is computed with this field zeroed
+        zeros = '0' * hashlib.new(self.checksum).digest_size * 2
+
+        lines = [
+            '<?xml version="1.0" ?>',
+            '<!-- This file contains the block map for an image file, which '
+            'is basically',
+            '     a list of useful (mapped) block numbers in the image file. '
+            'In other words,',
+            '     it lists only those blocks which contain data (boot sector, '
+            'partition',
+            '     table, file-system metadata, files, directories, extents, '
+            'etc). These',
+            '     blocks have to be copied to the target device. The other '
+            'blocks do not',
+            '     contain any useful data and do not have to be copied to the '
+            'target',
+            '     device. -->',
+            '<bmap version="%s">' % BMAP_VERSION,
+            '    <!-- Image size in bytes: -->',
+            '    <ImageSize> %d </ImageSize>' % self.size,
+            '',
+            '    <!-- Size of a block in bytes -->',
+            '    <BlockSize> %d </BlockSize>' % self.blocksize,
+            '',
+            '    <!-- Count of blocks in the image file -->',
+            '    <BlocksCount> %d </BlocksCount>' % blocks,
+            '',
+            '    <!-- Count of mapped blocks: %.1f%% -->' % percent,
+            '    <MappedBlocksCount> %d </MappedBlocksCount>' % mapped,
+            '',
+            '    <!-- Type of checksum used in this file -->',
+            '    <ChecksumType> %s </ChecksumType>' % self.checksum,
+            '',
+            '    <!-- The checksum of this bmap file. When it is calculated, '
+            'the value of',
+            '         the checksum has to be zero (all ASCII "0" symbols). '
+            '-->',
+            '    <BmapFileChecksum> %s </BmapFileChecksum>' % zeros,
+            '',
+            '    <!-- The block map which consists of elements which may '
+            'either be a',
+            '         range of blocks or a single block. The "chksum" '
+            'attribute',
+            '         (if present) is the checksum of this blocks range. '
+            '-->',
+            '    <BlockMap>']
+
+        for first, last, chksum in self.ranges:
+            blocks_range = str(first) if first == last else \
+                "%d-%d" % (first, last)
+            lines.append('        <Range chksum="%s"> %s </Range>' %
+                         (chksum, blocks_range))
+
+        lines += ['    </BlockMap>', '</bmap>', '']
+
+        xml = '\n'.join(lines)
+        file_checksum = hashlib.new(self.checksum, xml).hexdigest()
+        # The file checksum is the first field of this length
+        return xml.replace(zeros, file_checksum, 1)
+
+    def save(self, path):
+        """Save the bmap in a file"""
+        with open(path, 'w') as f:
+            f.write(self.to_xml())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
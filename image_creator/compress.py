@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides a writer that compresses the dumped image using
+multiple threads.
+
+The data is split in frames that are compressed independently. The frames of
+each format are concatenated in a way that the standard tools can decompress:
+gzip members, xz streams or zstd frames. For zstd, a seek table is appended
+following the zstd seekable format, so that random ranges of the image can be
+decompressed without decompressing everything before them.
+"""
+
+import zlib
+import struct
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from image_creator.util import FatalError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+FRAME_SIZE = 2 ** 22  # 4MB
+
+# Magic numbers of the zstd seekable format
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+EXTENSIONS = {'.gz': 'gzip', '.xz': 'xz', '.zst': 'zstd'}
+
+
+def method_from_filename(filename):
+    """Returns the compression method that matches the extension of a file
+    name or None if there is no match.
+    """
+    for extension, method in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return method
+    return None
+
+
+def _compress_gzip(data, level):
+    """Compress data into a gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_xz(data, level):
+    """Compress data into an xz stream"""
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+
+def _compress_zstd(data, level):
+    """Compress data into a zstd frame"""
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+METHODS = {
+    # name: (function, default level, available)
+    'gzip': (_compress_gzip, 6, lambda: True),
+    'xz': (_compress_xz, 6, lambda: lzma is not None),
+    'zstd': (_compress_zstd, 3, lambda: zstandard is not None),
+}
+
+
+def check_method(method):
+    """Raise a FatalError if a compression method cannot be used"""
+    if method not in METHODS:
+        raise FatalError("Unknown compression method: `%s'" % method)
+    if not METHODS[method][2]():
+        module = 'zstandard' if method == 'zstd' else 'lzma'
+        raise FatalError("Compression method `%s' needs the python `%s' "
+                         "module, which is not installed" % (method, module))
+
+
+class CompressedWriter(object):
+    """File-like object that compresses the data written to it in
+    independent frames, using a pool of threads.
+    """
+
+    def __init__(self, fileobj, method, level=None, workers=None):
+        """Create a CompressedWriter instance"""
+        check_method(method)
+
+        self.fileobj = fileobj
+        self.method = method
+        self.compress, default_level, _ = METHODS[method]
+        self.level = default_level if level is None else level
+        self.workers = cpu_count() if workers is None else workers
+
+        self._pool = ThreadPool(self.workers)
+        self._flying = deque()
+        self._buf = []
+        self._buf_size = 0
+        # (compressed size, decompressed size) for each frame
+        self.frames = []
+
+    def _wait(self):
+        """Write the oldest compressed frame to the file"""
+        size, result = self._flying.popleft()
+        frame = result.get()
+        self.fileobj.write(frame)
+        self.frames.append((len(frame), size))
+
+    def _submit(self, data):
+        """Compress a frame in the thread pool"""
+        # Limit the number of frames kept in memory
+        while len(self._flying) >= 2 * self.workers:
+            self._wait()
+        self._flying.append((len(data), self._pool.apply_async(
+            self.compress, (data, self.level))))
+
+    def write(self, data):
+        """Write data to the compressed file"""
+        if not isinstance(data, str):  # The frames are kept for compressing
+            data = str(data)
+        if not self._buf and len(data) == FRAME_SIZE:
+            self._submit(data)
+            return
+
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size < FRAME_SIZE:
+            return
+
+        buf = ''.join(self._buf)
+        offset = 0
+        while len(buf) - offset >= FRAME_SIZE:
+            self._submit(buf[offset:offset + FRAME_SIZE])
+            offset += FRAME_SIZE
+        rest = buf[offset:]
+        self._buf = [rest] if rest else []
+        self._buf_size = len(rest)
+
+    def _seek_table(self):
+        """Returns the seek table of the zstd seekable format"""
+        entries = ''.join(struct.pack('<II', c, d) for c, d in self.frames)
+        # The descriptor byte is 0: no checksums in the entries
+        footer = struct.pack('<IBI', len(self.frames), 0, ZSTD_SEEKABLE_MAGIC)
+        return struct.pack('<II', ZSTD_SKIPPABLE_MAGIC,
+                           len(entries) + len(footer)) + entries + footer
+
+    def close(self):
+        """Compress the remaining data and finalize the file. The underlying
+        file object is not closed.
+        """
+        if self._buf:
+            self._submit(''.join(self._buf))
+            self._buf = []
+            self._buf_size = 0
+
+        try:
+            while self._flying:
+                self._wait()
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+        if self.method == 'zstd':
+            self.fileobj.write(self._seek_table())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
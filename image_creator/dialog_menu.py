@@ -26,6 +26,7 @@ import json
 import re
 import time
 import tempfile
+from multiprocessing import cpu_count
 
 from image_creator import __version__ as version
 from image_creator.util import FatalError, virtio_versions
@@ -149,10 +150,8 @@ def upload_image(session):
             continue
 
         kamaki = Kamaki(cloud['account'], None)
-        overwrite = []
-        for f in (name, "%s.md5sum" % name, "%s.meta" % name):
-            if kamaki.object_exists(container, f):
-                overwrite.append(f)
+        overwrite = kamaki.objects_exist(
+            container, (name, "%s.md5sum" % name, "%s.meta" % name))
 
         if overwrite:
             if d.yesno("The following storage service object(s) already "
@@ -167,17 +166,24 @@ def upload_image(session):
         out.append(gauge)
         kamaki.out = out
         try:
-            if 'checksum' not in session:
-                session['checksum'] = image.md5()
-
             try:
+                # Compute the block hashes in parallel. If the checksum is
+                # missing, compute both in a single pass.
+                if 'checksum' not in session:
+                    hashmap = kamaki.new_hashmap(container, cpu_count())
+                    session['checksum'] = image.md5(hashmap=hashmap)
+                else:
+                    template = kamaki.new_hashmap(container)
+                    hashmap = image.block_hashes(template.blocksize,
+                                                 template.blockhash)
+
                 # Upload image file
                 with image.raw_device() as raw:
                     with open(raw, 'rb') as f:
                         cloud["uploaded"] = \
                             kamaki.upload(f, image.size, name, container, None,
-                                          "Calculating block hashes",
-                                          "Uploading missing blocks")
+                                          None, "Uploading missing blocks",
+                                          hashmap=hashmap)
                 # Upload md5sum file
                 out.info("Uploading md5sum file ...")
                 md5str = "%s %s\n" % (session['checksum'], name)
@@ -222,11 +222,11 @@ def extract_image(session):
             out = image.out
             out.append(gauge)
             try:
-                if "checksum" not in session:
-                    session['checksum'] = image.md5()
-
                 # Extract image file
-                image.dump(path)
+                if "checksum" not in session:
+                    session['checksum'] = image.dump(path, md5=True)
+                else:
+                    image.dump(path)
 
                 # Extract metadata file
                 out.info("Extracting metadata file ...", False)
@@ -23,6 +23,7 @@ import time
 import StringIO
 import json
 import re
+from multiprocessing import cpu_count
 
 from image_creator.kamaki_wrapper import Kamaki, ClientError, CONTAINER
 from image_creator.util import FatalError, virtio_versions
@@ -463,26 +464,28 @@ def create_image(session, answers):
 
         metadata['DESCRIPTION'] = answers['ImageDescription']
 
-        # MD5
-        session['checksum'] = image.md5()
-
         image.out.info()
         try:
-            image.out.info("Uploading image to the cloud:")
             account = Kamaki.get_account(answers['Cloud'])
             assert account, "Cloud: %s is not valid" % answers['Cloud']
             kamaki = Kamaki(account, image.out)
 
+            # MD5 and block hashes
+            hashmap = kamaki.new_hashmap(CONTAINER, cpu_count())
+            session['checksum'] = image.md5(hashmap=hashmap)
+
+            image.out.info()
+            image.out.info("Uploading image to the cloud:")
             name = "%s-%s.diskdump" % (answers['ImageName'],
                                        time.strftime("%Y%m%d%H%M"))
             with image.raw_device() as raw:
                 with open(raw, 'rb') as device:
                     remote = kamaki.upload(device, image.size, name, CONTAINER,
-                                           None,
-                                           "(1/3)  Calculating block hashes",
-                                           "(2/3)  Uploading image blocks")
+                                           None, None,
+                                           "(1/2)  Uploading image blocks",
+                                           hashmap=hashmap)
 
-            image.out.info("(3/3)  Uploading md5sum file ...", False)
+            image.out.info("(2/2)  Uploading md5sum file ...", False)
             md5sumstr = '%s %s\n' % (session['checksum'], name)
             kamaki.upload(StringIO.StringIO(md5sumstr), size=len(md5sumstr),
                           remote_path="%s.%s" % (name, 'md5sum'),
@@ -199,12 +199,18 @@ class Disk(object):
         self.out.success('done')
         return "/dev/mapper/%s" % snapshot
 
-    def get_image(self, media, **kwargs):
-        """Returns a newly created Image instance."""
+    def get_image(self, media, inspect=True, **kwargs):
+        """Returns a newly created Image instance. If inspect is False, the
+        helper VM is launched in the background and the image gets inspected
+        the first time it is needed or when enable() is called.
+        """
         info = image_info(media)
         image = Image(media, self.out, format=info['format'], **kwargs)
         self._images.append(image)
-        image.enable()
+        if inspect:
+            image.enable()
+        else:
+            image.launch_guestfs()
         return image
 
     def destroy_image(self, image):
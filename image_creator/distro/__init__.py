@@ -19,13 +19,36 @@
 Systems for image creation.
 """
 
-import textwrap
+import os
 import re
+import stat
+import tempfile
+import textwrap
 from collections import namedtuple
 from functools import wraps
 
 from image_creator.util import FatalError
 from image_creator.bootloader import mbr_bootinfo
+from image_creator.guestfs_wrapper import FileIndex, FileCache, \
+    AugeasSession
+
+# Guest commands that perform a guestfs action on many files at once
+BULK_COMMANDS = {
+    'rm': ['/bin/rm', '-f', '--'],
+    'rm_rf': ['/bin/rm', '-rf', '--'],
+    'truncate': ['/bin/sh', '-c', 'for f; do : > "$f"; done', 'sh'],
+}
+
+# Maximum size in bytes of the file names passed to a single bulk command
+BULK_ARGS_SIZE = 128 * 1024
+
+# Maximum number of files to lstat with a single call
+LSTAT_BATCH = 1000
+
+# The file types returned by guestfs_readdir
+FILE_TYPES = ((stat.S_ISREG, 'r'), (stat.S_ISDIR, 'd'), (stat.S_ISLNK, 'l'),
+              (stat.S_ISCHR, 'c'), (stat.S_ISBLK, 'b'), (stat.S_ISFIFO, 'f'),
+              (stat.S_ISSOCK, 's'))
 
 OSTYPE_ORDER = {
     "windows": 8,
@@ -268,6 +291,14 @@ class OSBase(object):
         self._mount_warnings = []
         self._mounted = None
 
+        # Caches the guest files read and written while the media is mounted
+        self._files = FileCache(self.image.g)
+        # Answers file type queries on the mounted media with fewer calls
+        self._fsindex = FileIndex(self.image.g, self._files)
+        # An Augeas session shared by the tasks run while the media is mounted
+        self._augeas = AugeasSession(self.image.g)
+        self._files.add_observer(self._augeas.observe_file)
+
         # Many guestfs compilations don't support scrub
         self._scrub_support = True
         try:
@@ -285,6 +316,10 @@ class OSBase(object):
 
         self._cleanup_jobs = {}
 
+        # Whether the bulk command of an action runs in the helper VM. Each
+        # command is probed the first time a bulk action needs it.
+        self._bulk_support = {}
+
     def _add_cleanup(self, namespace, job, *args):
         """Add a new job in a cleanup list"""
 
@@ -541,11 +576,20 @@ class OSBase(object):
             def umount(self):
                 """umount all"""
                 output("Umounting the media ...", False)
-                parent.image.g.umount_all()
-                parent._mounted = None
+                try:
+                    try:
+                        parent._augeas.disable()
+                    finally:
+                        parent._files.disable()
+                finally:
+                    parent.image.g.umount_all()
+                    parent._mounted = None
                 success('done')
 
         self._mounted = Mount()
+        if mounted:
+            self._files.enable()
+            self._augeas.enable()
         return self._mounted
 
     def umount(self):
@@ -583,8 +627,87 @@ class OSBase(object):
         """List the name of all files recursively under a directory"""
         return self.image.g.find(directory)
 
+    def _list_files(self, directory, **kwargs):
+        """Returns the files under a directory that _foreach_file() would
+        perform an action on, in the same order. Subdirectories are listed
+        before their parents. The files are listed with a single call and
+        their types are fetched in batches.
+        """
+        maxdepth = None if 'maxdepth' not in kwargs else kwargs['maxdepth']
+        exclude = None if 'exclude' not in kwargs else kwargs['exclude']
+        include = None if 'include' not in kwargs else kwargs['include']
+        ftype = None if 'ftype' not in kwargs else kwargs['ftype']
+
+        if maxdepth == 0:
+            return []
+
+        if maxdepth == 1:
+            # A listing of the directory includes the file types
+            entries = [f for f in self.image.g.readdir(directory)
+                       if f['name'] not in ('.', '..')]
+            names = [f['name'] for f in entries]
+            types = dict((f['name'], f['ftyp']) for f in entries)
+        else:
+            fd, tmp = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                self.image.g.find0(directory, tmp)
+                with open(tmp) as f:
+                    names = [n for n in f.read().split('\0') if n]
+            finally:
+                os.unlink(tmp)
+            types = None
+
+        # Apply the filters the way a recursive walk would. Nothing is
+        # listed under a directory that is filtered out.
+        pruned = set()
+        selected = []
+        for name in names:
+            parent = name.rpartition('/')[0]
+            if parent in pruned:
+                pruned.add(name)
+                continue
+
+            full_path = "%s/%s" % (directory, name)
+            if (exclude and re.match(exclude, full_path)) or \
+                    (include and not re.match(include, full_path)) or \
+                    (maxdepth is not None and name.count('/') >= maxdepth):
+                pruned.add(name)
+                continue
+            selected.append(name)
+
+        if ftype is not None and types is None:
+            types = self._file_types(directory, selected)
+
+        return ["%s/%s" % (directory, name) for name in reversed(selected)
+                if ftype is None or types.get(name) == ftype]
+
+    def _file_types(self, directory, names):
+        """Returns the guestfs_readdir file types of files under a
+        directory
+        """
+        g = self.image.g
+        if hasattr(g, 'lstatnslist'):
+            lstat, mode = g.lstatnslist, 'st_mode'
+        else:
+            lstat, mode = g.lstatlist, 'mode'
+
+        types = {}
+        for i in xrange(0, len(names), LSTAT_BATCH):
+            batch = names[i:i + LSTAT_BATCH]
+            for name, st in zip(batch, lstat(directory, batch)):
+                if st[mode] < 0:
+                    continue  # The file does not exist
+                types[name] = 'u'
+                for check, ftyp in FILE_TYPES:
+                    if check(st[mode]):
+                        types[name] = ftyp
+                        break
+        return types
+
     def _foreach_file(self, directory, action, **kwargs):
         """Perform an action recursively on all files under a directory.
+        Returns the number of files the action was performed on.
 
         The following options are allowed:
 
@@ -601,42 +724,64 @@ class OSBase(object):
         """
         if not self.image.g.is_dir(directory):
             self.out.warn("Directory: `%s' does not exist!" % directory)
-            return
-
-        maxdepth = None if 'maxdepth' not in kwargs else kwargs['maxdepth']
-        if maxdepth == 0:
-            return
-
-        # maxdepth -= 1
-        maxdepth = None if maxdepth is None else maxdepth - 1
-        kwargs['maxdepth'] = maxdepth
-
-        exclude = None if 'exclude' not in kwargs else kwargs['exclude']
-        include = None if 'include' not in kwargs else kwargs['include']
-        ftype = None if 'ftype' not in kwargs else kwargs['ftype']
-
-        def has_ftype(f, ftype):
-            """Returns True if the type of the file is ftype"""
-            return ftype is None and True or f['ftyp'] == ftype
-
-        for f in self.image.g.readdir(directory):
-            if f['name'] in ('.', '..'):
-                continue
-
-            full_path = "%s/%s" % (directory, f['name'])
-
-            if exclude and re.match(exclude, full_path):
-                continue
+            return 0
 
-            if include and not re.match(include, full_path):
-                continue
+        files = self._list_files(directory, **kwargs)
+        for full_path in files:
+            action(full_path)
 
-            if has_ftype(f, 'd'):
-                self._foreach_file(full_path, action, **kwargs)
+        return len(files)
 
-            if has_ftype(f, ftype):
+    def _bulk_action(self, directory, name, **kwargs):
+        """Perform the guestfs action with this name on all files under a
+        directory, like _foreach_file() does. If the action has a bulk
+        command and the guest binary it needs runs in the helper VM, the
+        files are handled in batches. If a batch fails, the rest of the files
+        are handled by the guestfs action. Returns the number of files.
+        """
+        g = self.image.g
+        action = getattr(g, name)
+        if name not in BULK_COMMANDS or not g.is_dir(directory):
+            return self._foreach_file(directory, action, **kwargs)
+
+        if name not in self._bulk_support:
+            # Without any files, the command only checks that the binary
+            # exists and runs
+            try:
+                g.command(BULK_COMMANDS[name])
+                self._bulk_support[name] = True
+            except RuntimeError:
+                self._bulk_support[name] = False
+
+        files = self._list_files(directory, **kwargs)
+
+        batches = []
+        size = 0
+        for full_path in files:
+            if not batches or size + len(full_path) >= BULK_ARGS_SIZE:
+                batches.append([])
+                size = 0
+            batches[-1].append(full_path)
+            size += len(full_path) + 1
+
+        for batch in batches:
+            if self._bulk_support[name]:
+                try:
+                    g.command(BULK_COMMANDS[name] + batch)
+                    continue
+                except RuntimeError as e:
+                    self.out.warn("Running `%s' in the guest failed: %s" %
+                                  (BULK_COMMANDS[name][0], e))
+                    self._bulk_support[name] = False
+                    if name == 'rm':
+                        # The command may have removed some of the files
+                        batch = [f for f in batch
+                                 if g.exists(f) or g.is_symlink(f)]
+            for full_path in batch:
                 action(full_path)
 
+        return len(files)
+
     def _do_inspect(self):
         """helper method for inspect"""
         self.out.warn("No inspection method available")
@@ -36,7 +36,7 @@ class Bsd(Unix):
 
         master_passwd = []
 
-        for line in self.image.g.cat('/etc/master.passwd').splitlines():
+        for line in self._files.cat('/etc/master.passwd').splitlines():
 
             # Check for empty or comment lines
             if not line.split('#')[0]:
@@ -49,7 +49,7 @@ class Bsd(Unix):
 
             master_passwd.append(":".join(fields))
 
-        self.image.g.write(
+        self._files.write(
             '/etc/master.passwd', "\n".join(master_passwd) + '\n')
 
         # Make sure no one can login on the system
@@ -117,7 +117,7 @@ class Bsd(Unix):
             '^([^:]+):((?:![^:]+)|(?:[^!*][^:]+)|):(?:[^:]*:){7}(?:[^:]*)'
         )
 
-        for line in self.image.g.cat('/etc/master.passwd').splitlines():
+        for line in self._files.cat('/etc/master.passwd').splitlines():
             line = line.split('#')[0]
             match = regexp.match(line)
             if not match:
@@ -39,7 +39,7 @@ class Freebsd(Bsd):
             if not self.image.g.is_file(rc_conf):
                 continue
 
-            for line in self.image.g.cat(rc_conf).splitlines():
+            for line in self._files.cat(rc_conf).splitlines():
                 line = line.split('#')[0].strip()
                 # Be paranoid. Don't stop examining lines after a match. This
                 # is a shell variable and can be overwritten many times. Only
@@ -20,7 +20,6 @@
 import os
 import os.path
 import re
-import tempfile
 from collections import namedtuple
 from functools import wraps
 
@@ -70,6 +69,14 @@ GRUB1_CONFIG = ['/boot/grub/menu.lst']
 GRUB2_CONFIG = ['/boot/grub/grub.cfg',
                 '/boot/grub2/grub.cfg']
 
+# The Augeas transforms needed by the system preparation tasks. Only these are
+# loaded, instead of every lens over the whole guest.
+AUGEAS_TRANSFORMS = {
+    'Shellvars': ('Shellvars.lns', ['/etc/default/grub']),
+    'Sysctl': ('Sysctl.lns', ['/etc/sysctl.conf', '/etc/sysctl.d/*']),
+    'Grub': ('Grub.lns', ['/boot/grub/menu.lst', '/etc/grub.conf'])
+}
+
 
 def cloudinit(method):
     """Decorator that adds a check to run only on cloud-init enabled images"""
@@ -134,7 +141,7 @@ class Linux(Unix):
 
         cfg = {}
         for c in self.get_cloud_init_config_files():
-            cfg.update(yaml.load(self.image.g.cat(c)))
+            cfg.update(yaml.load(self._files.cat(c)))
 
         return cfg
 
@@ -149,7 +156,7 @@ class Linux(Unix):
             passwd = []
             metadata_users = self.meta['USERS'].split() \
                 if 'USERS' in self.meta else []
-            for line in self.image.g.cat('/etc/passwd').splitlines():
+            for line in self._files.cat('/etc/passwd').splitlines():
                 fields = line.split(':')
                 if int(fields[2]) > 1000:
                     removed_users[fields[0]] = fields
@@ -165,7 +172,7 @@ class Linux(Unix):
             if not self.meta['USERS']:
                 del self.meta['USERS']
 
-            self.image.g.write('/etc/passwd', '\n'.join(passwd) + '\n')
+            self._files.write('/etc/passwd', '\n'.join(passwd) + '\n')
         else:
             self.out.warn("File: `/etc/passwd' is missing. "
                           "No users were deleted")
@@ -174,23 +181,23 @@ class Linux(Unix):
         if self.image.g.is_file('/etc/shadow'):
             # Remove the corresponding /etc/shadow entries
             shadow = []
-            for line in self.image.g.cat('/etc/shadow').splitlines():
+            for line in self._files.cat('/etc/shadow').splitlines():
                 fields = line.split(':')
                 if fields[0] not in removed_users:
                     shadow.append(':'.join(fields))
-            self.image.g.write('/etc/shadow', "\n".join(shadow) + '\n')
+            self._files.write('/etc/shadow', "\n".join(shadow) + '\n')
         else:
             self.out.warn("File: `/etc/shadow' is missing.")
 
         if self.image.g.is_file('/etc/group'):
             # Remove the corresponding /etc/group entries
             group = []
-            for line in self.image.g.cat('/etc/group').splitlines():
+            for line in self._files.cat('/etc/group').splitlines():
                 fields = line.split(':')
                 # Remove groups tha have the same name as the removed users
                 if fields[0] not in removed_users:
                     group.append(':'.join(fields))
-            self.image.g.write('/etc/group', '\n'.join(group) + '\n')
+            self._files.write('/etc/group', '\n'.join(group) + '\n')
 
         # Remove home directories
         for home in [field[5] for field in removed_users.values()]:
@@ -207,7 +214,7 @@ class Linux(Unix):
         new_name = self.sysprep_params['default_user'].value
 
         for f in self.get_cloud_init_config_files():
-            cfg = yaml.load(self.image.g.cat(f))
+            cfg = yaml.load(self._files.cat(f))
             try:
                 old_name = cfg['system_info']['default_user']['name']
             except KeyError:
@@ -216,7 +223,7 @@ class Linux(Unix):
             if old_name != new_name:
                 self.image.g.mv(f, f + ".bak")
                 cfg['system_info']['default_user']['name'] = new_name
-                self.image.g.write(f, yaml.dump(cfg, default_flow_style=False))
+                self._files.write(f, yaml.dump(cfg, default_flow_style=False))
             else:
                 self.out.warn(
                     'The default cloud-init user is already named: "%s"' %
@@ -249,8 +256,8 @@ class Linux(Unix):
         if not self.image.g.is_dir('/etc/cloud/cloud.cfg.d'):
             self.image.g.mkdir('/etc/cloud/cloud.cfg.d')
 
-        self.image.g.write('/etc/cloud/cloud.cfg.d/%s' % fname,
-                           yaml.dump(new_cfg))
+        self._files.write('/etc/cloud/cloud.cfg.d/%s' % fname,
+                          yaml.dump(new_cfg))
 
         metadata_users = self.meta['USERS'].split() if 'USERS' in self.meta \
                 else []
@@ -265,14 +272,14 @@ class Linux(Unix):
 
         shadow = []
 
-        for line in self.image.g.cat('/etc/shadow').splitlines():
+        for line in self._files.cat('/etc/shadow').splitlines():
             fields = line.split(':')
             if fields[1] not in ('*', '!'):
                 fields[1] = '!'
 
             shadow.append(":".join(fields))
 
-        self.image.g.write('/etc/shadow', "\n".join(shadow) + '\n')
+        self._files.write('/etc/shadow', "\n".join(shadow) + '\n')
 
         # Remove backup file for /etc/shadow
         self.image.g.rm_rf('/etc/shadow-')
@@ -299,7 +306,7 @@ class Linux(Unix):
             event = -1
             action = -1
             fullpath = "%s/%s" % (events_dir, events_file['name'])
-            content = self.image.g.cat(fullpath).splitlines()
+            content = self._files.cat(fullpath).splitlines()
             for i in xrange(len(content)):
                 if event_exp.match(content[i]):
                     event = i
@@ -316,8 +323,8 @@ class Linux(Unix):
             entry = content[event].split('=')[1].strip()
             if entry in ("button[ /]power", "button/power.*"):
                 content[action] = "action=%s" % powerbtn_action
-                self.image.g.write(fullpath, "\n".join(content) +
-                                   '\n\n### Edited by snf-image-creator ###\n')
+                self._files.write(fullpath, "\n".join(content) +
+                                  '\n\n### Edited by snf-image-creator ###\n')
                 return
             elif entry == ".*":
                 self.out.warn("Found action `.*'. Don't know how to handle "
@@ -353,7 +360,7 @@ class Linux(Unix):
             return
 
         new_fstab = ""
-        fstab = self.image.g.cat('/etc/fstab')
+        fstab = self._files.cat('/etc/fstab')
         for line in fstab.splitlines():
 
             entry = line.split('#')[0].strip().split()
@@ -362,7 +369,7 @@ class Linux(Unix):
 
             new_fstab += "%s\n" % line
 
-        self.image.g.write('/etc/fstab', new_fstab)
+        self._files.write('/etc/fstab', new_fstab)
 
     @sysprep('Change boot menu timeout to %(bootmenu_timeout)s seconds')
     def _change_bootmenu_timeout(self):
@@ -373,29 +380,18 @@ class Linux(Unix):
         timeout = self.sysprep_params['bootmenu_timeout'].value
 
         if self.image.g.is_file('/etc/default/grub'):
-            self.image.g.aug_init('/', 0)
-            try:
-                self.image.g.aug_set('/files/etc/default/grub/GRUB_TIMEOUT',
-                                     str(timeout))
-            finally:
-                self.image.g.aug_save()
-                self.image.g.aug_close()
+            self._augeas_load()
+            self.image.g.aug_set('/files/etc/default/grub/GRUB_TIMEOUT',
+                                 str(timeout))
 
         def replace_timeout(remote, regexp, timeout):
             """Replace the timeout value from a config file"""
-            tmpfd, tmp = tempfile.mkstemp()
-            try:
-                for line in self.image.g.cat(remote).splitlines():
-                    if regexp.match(line):
-                        line = re.sub(r'\d+', str(timeout), line)
-                    os.write(tmpfd, line + '\n')
-                os.close(tmpfd)
-                tmpfd = None
-                self.image.g.upload(tmp, remote)
-            finally:
-                if tmpfd is not None:
-                    os.close(tmpfd)
-                os.unlink(tmp)
+            content = []
+            for line in self._files.cat(remote).splitlines():
+                if regexp.match(line):
+                    line = re.sub(r'\d+', str(timeout), line)
+                content.append(line + '\n')
+            self._files.write(remote, ''.join(content))
 
         grub1_regexp = re.compile(r'^\s*timeout\s+\d+\s*$')
         grub2_regexp = re.compile(r'^\s*set\s+timeout=\d+\s*$')
@@ -440,29 +436,25 @@ class Linux(Unix):
         file_path = '/files/etc/sysctl.conf/net.ipv6.conf.%s.use_tempaddr'
         dir_path = '/files/etc/sysctl.d/*/net.ipv6.conf.%s.use_tempaddr'
 
-        self.image.g.aug_init('/', 0)
-        try:
-            default = self.image.g.aug_match(file_path % 'default') + \
-                self.image.g.aug_match(dir_path % 'default')
+        self._augeas_load()
 
-            all = self.image.g.aug_match(file_path % 'all') + \
-                self.image.g.aug_match(dir_path % 'all')
+        default = self.image.g.aug_match(file_path % 'default') + \
+            self.image.g.aug_match(dir_path % 'default')
 
-            if not default:
-                self.image.g.aug_set(file_path % 'default', '0')
-            else:
-                for token in default:
-                    self.image.g.aug_set(token, '0')
+        all = self.image.g.aug_match(file_path % 'all') + \
+            self.image.g.aug_match(dir_path % 'all')
 
-            if not all:
-                self.image.g.aug_set(file_path % 'all', '0')
-            else:
-                for token in all:
-                    self.image.g.aug_set(token, '0')
+        if not default:
+            self.image.g.aug_set(file_path % 'default', '0')
+        else:
+            for token in default:
+                self.image.g.aug_set(token, '0')
 
-        finally:
-            self.image.g.aug_save()
-            self.image.g.aug_close()
+        if not all:
+            self.image.g.aug_set(file_path % 'all', '0')
+        else:
+            for token in all:
+                self.image.g.aug_set(token, '0')
 
     @sysprep('Disabling predictable network interface naming')
     def _disable_predictable_network_interface_naming(self):
@@ -488,36 +480,32 @@ class Linux(Unix):
         self._replace_kernel_params(repl)
 
         if self.image.g.is_file('/etc/default/grub'):
-            self.image.g.aug_init('/', 0)
+            self._augeas_load()
             path = '/files/etc/default/grub/GRUB_CMDLINE_LINUX'
             path_default = path + '_DEFAULT'
-            try:
-                cmdline = ""
-                cmdline_default = ""
-                if self.image.g.aug_match(path):
-                    cmdline = self.image.g.aug_get(path)
-                    if ifnames.search(cmdline):
-                        self.image.g.aug_set(
-                            path, ifnames.sub(' net.ifnames=0', cmdline))
-                if self.image.g.aug_match(path_default):
-                    cmdline_default = self.image.g.aug_get(path_default)
-                    if ifnames.search(cmdline_default):
-                        self.image.g.aug_set(
-                            path_default,
-                            ifnames.sub(' net.ifnames=0', cmdline_default))
-
-                if not (ifnames.search(cmdline) or
-                        ifnames.search(cmdline_default)):
-                    # This looks a little bit weird but its a good way to
-                    # append text to a variable without messing up with the
-                    # quoting. The variable could have a value foo or 'foo' or
-                    # "foo". Appending ' bar' will lead to a valid result.
-
-                    self.image.g.aug_set(path, "%s' %s'" % (cmdline.strip(),
-                                                            'net.ifnames=0'))
-            finally:
-                self.image.g.aug_save()
-                self.image.g.aug_close()
+            cmdline = ""
+            cmdline_default = ""
+            if self.image.g.aug_match(path):
+                cmdline = self.image.g.aug_get(path)
+                if ifnames.search(cmdline):
+                    self.image.g.aug_set(
+                        path, ifnames.sub(' net.ifnames=0', cmdline))
+            if self.image.g.aug_match(path_default):
+                cmdline_default = self.image.g.aug_get(path_default)
+                if ifnames.search(cmdline_default):
+                    self.image.g.aug_set(
+                        path_default,
+                        ifnames.sub(' net.ifnames=0', cmdline_default))
+
+            if not (ifnames.search(cmdline) or
+                    ifnames.search(cmdline_default)):
+                # This looks a little bit weird but its a good way to append
+                # text to a variable without messing up with the quoting. The
+                # variable could have a value foo or 'foo' or "foo". Appending
+                # ' bar' will lead to a valid result.
+
+                self.image.g.aug_set(path, "%s' %s'" % (cmdline.strip(),
+                                                        'net.ifnames=0'))
 
     @sysprep('Disable serial console')
     def _disable_serial_console(self):
@@ -533,16 +521,12 @@ class Linux(Unix):
         self._replace_kernel_params(repl)
 
         if self.image.g.is_file('/etc/default/grub'):
-            self.image.g.aug_init('/', 0)
-            try:
-                for var in ('', '_DEFAULT'):
-                    path = '/files/etc/default/grub/GRUB_CMDLINE_LINUX' + var
-                    if self.image.g.aug_match(path):
-                        cmdline = self.image.g.aug_get(path)
-                        self.image.g.aug_set(path, regexp.sub(" ", cmdline))
-            finally:
-                self.image.g.aug_save()
-                self.image.g.aug_close()
+            self._augeas_load()
+            for var in ('', '_DEFAULT'):
+                path = '/files/etc/default/grub/GRUB_CMDLINE_LINUX' + var
+                if self.image.g.aug_match(path):
+                    cmdline = self.image.g.aug_get(path)
+                    self.image.g.aug_set(path, regexp.sub(" ", cmdline))
 
     @sysprep('Clearing local machine ID configuration file',
              display='Clear local machine ID configuration file')
@@ -568,16 +552,9 @@ class Linux(Unix):
         if not self.image.g.is_dir(connections):
             return
 
-        cnt = [0]
-
-        def count(f):
-            cnt[0] += 1
-
-        self._foreach_file(connections, count, ftype='r', maxdepth=1)
-        self._foreach_file(connections, self.image.g.rm, ftype='r', maxdepth=1)
-
-        if cnt:
-            self.out.success("removed %d connections" % cnt[0])
+        count = self._bulk_action(connections, 'rm', ftype='r', maxdepth=1)
+        if count:
+            self.out.success("removed %d connections" % count)
 
     @sysprep('Shrinking image (may take a while)', nomount=True)
     def _shrink(self):
@@ -605,6 +582,15 @@ class Linux(Unix):
                 self.image.g.command(['extlinux', '-U', basedir])
                 self.out.success("done")
 
+    def _augeas_load(self):
+        """Load the files the system preparation tasks edit with Augeas in
+        the shared session. They are all loaded at once, so that the session
+        does not need to be saved before other files are added to it.
+        """
+        for name, (lens, incl) in AUGEAS_TRANSFORMS.items():
+            self._augeas.add_transform(name, lens, incl)
+        self._augeas.load()
+
     def _get_syslinux_base_dir(self):
         """Find the installation directory we need to use to when updating
         syslinux
@@ -629,7 +615,7 @@ class Linux(Unix):
         kernel = None
         initrd = None
 
-        for line in self.image.g.cat(cfg).splitlines():
+        for line in self._files.cat(cfg).splitlines():
             kernel_match = kernel_regexp.match(line)
             if kernel_match:
                 kernel = kernel_match.group(1).strip()
@@ -670,20 +656,15 @@ class Linux(Unix):
         else:
             return
 
-        self.image.g.aug_init('/', 0)
-        try:
-            roots = self.image.g.aug_match(
-                '/files%s/title[*]/kernel/root' % grub1)
-            for root in roots:
-                dev = self.image.g.aug_get(root)
-                if not self._is_persistent(dev):
-                    # This is not always correct. Grub may contain root entries
-                    # for other systems, but we only support 1 OS per hard
-                    # disk, so this shouldn't harm.
-                    self.image.g.aug_set(root, new_root)
-        finally:
-            self.image.g.aug_save()
-            self.image.g.aug_close()
+        self._augeas_load()
+        roots = self.image.g.aug_match('/files%s/title[*]/kernel/root' % grub1)
+        for root in roots:
+            dev = self.image.g.aug_get(root)
+            if not self._is_persistent(dev):
+                # This is not always correct. Grub may contain root entries
+                # for other systems, but we only support 1 OS per hard disk,
+                # so this shouldn't harm.
+                self.image.g.aug_set(root, new_root)
 
     def _persistent_syslinux(self, new_root):
         """Replace non-persistent root device name occurrences with persistent
@@ -698,20 +679,13 @@ class Linux(Unix):
                 continue
 
             # There is no augeas lense for syslinux :-(
-            tmpfd, tmp = tempfile.mkstemp()
-            try:
-                for line in self.image.g.cat(config).splitlines():
-                    if append_regexp.match(line):
-                        line = re.sub(r'\broot=/dev/[hsv]d[a-z][1-9]*\b',
-                                      'root=%s' % new_root, line)
-                    os.write(tmpfd, line + '\n')
-                os.close(tmpfd)
-                tmpfd = None
-                self.image.g.upload(tmp, config)
-            finally:
-                if tmpfd is not None:
-                    os.close(tmpfd)
-                os.unlink(tmp)
+            content = []
+            for line in self._files.cat(config).splitlines():
+                if append_regexp.match(line):
+                    line = re.sub(r'\broot=/dev/[hsv]d[a-z][1-9]*\b',
+                                  'root=%s' % new_root, line)
+                content.append(line + '\n')
+            self._files.write(config, ''.join(content))
 
     def _persistent_fstab(self):
         """Replaces non-persistent device name occurrences in /etc/fstab with
@@ -725,7 +699,7 @@ class Linux(Unix):
 
         root_dev = None
         new_fstab = ""
-        fstab = self.image.g.cat('/etc/fstab')
+        fstab = self._files.cat('/etc/fstab')
         for line in fstab.splitlines():
 
             line, dev, mpoint = self._convert_fstab_line(line, device_dict)
@@ -734,7 +708,7 @@ class Linux(Unix):
             if mpoint == '/':
                 root_dev = dev
 
-        self.image.g.write('/etc/fstab', new_fstab)
+        self._files.write('/etc/fstab', new_fstab)
         if root_dev is None:
             pass  # TODO: error handling
 
@@ -878,10 +852,10 @@ class Linux(Unix):
             x2go_installed = False
             desktops = set()
             for path in ('/bin', '/usr/bin', '/usr/local/bin'):
-                if self.image.g.is_file("%s/%s" % (path, X2GO_EXECUTABLE)):
+                if self._fsindex.is_file("%s/%s" % (path, X2GO_EXECUTABLE)):
                     x2go_installed = True
                 for name, exe in X2GO_DESKTOPSESSIONS.items():
-                    if self.image.g.is_file("%s/%s" % (path, exe)):
+                    if self._fsindex.is_file("%s/%s" % (path, exe)):
                         desktops.add(name)
 
             if x2go_installed:
@@ -918,13 +892,13 @@ class Linux(Unix):
 
             generator_found = False
             for i in ("/run", "/etc", "/usr/local/lib", "/usr/lib"):
-                if self.image.g.is_file("%s/systemd/system-generators/"
-                                        "cloud-init-generator" % i):
+                if self._fsindex.is_file("%s/systemd/system-generators/"
+                                         "cloud-init-generator" % i):
                     generator_found = True
                     break
             if generator_found:
                 self.cloud_init = \
-                    not self.image.g.is_file("/etc/cloud/cloud-init.disabled")
+                    not self._fsindex.is_file("/etc/cloud/cloud-init.disabled")
         if self.cloud_init:
             self._collect_cloud_init_metadata()
 
@@ -942,7 +916,7 @@ class Linux(Unix):
 
                 # Could be a broken link
                 if self.image.g.is_file(service_file, followsymlinks=True):
-                    for line in self.image.g.cat(service_file).splitlines():
+                    for line in self._files.cat(service_file).splitlines():
                         if exec_start.search(line):
                             return True
                 else:
@@ -952,7 +926,7 @@ class Linux(Unix):
 
         def check_file(path):
             regexp = re.compile(r"[/=\s'\"]%s('\")?\s" % service)
-            for line in self.image.g.cat(path).splitlines():
+            for line in self._files.cat(path).splitlines():
                 line = line.split('#', 1)[0].strip()
                 if not line:
                     continue
@@ -996,7 +970,7 @@ class Linux(Unix):
         users = []
         regexp = re.compile(r'(\S+):((?:!\S+)|(?:[^!*]\S+)|):(?:\S*:){6}')
 
-        for line in self.image.g.cat('/etc/shadow').splitlines():
+        for line in self._files.cat('/etc/shadow').splitlines():
             match = regexp.match(line)
             if not match:
                 continue
@@ -1029,15 +1003,15 @@ class Linux(Unix):
         for path in GRUB2_CONFIG:
             if self.image.g.is_file(path):
                 cfg = re.sub(r'^(\s*linux(?:16)?\s+.*)', repl,
-                             self.image.g.cat(path),
+                             self._files.cat(path),
                              flags=re.MULTILINE)
-                self.image.g.write(path, cfg)
+                self._files.write(path, cfg)
 
         for path in self.syslinux.search_paths:
             if self.image.g.is_file(path):
                 cfg = re.sub(r'^(\s*append\s+.*)', repl,
-                             self.image.g.cat(path), flags=re.MULTILINE)
-                self.image.g.write(path, cfg)
+                             self._files.cat(path), flags=re.MULTILINE)
+                self._files.write(path, cfg)
 
 
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
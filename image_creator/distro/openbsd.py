@@ -37,7 +37,7 @@ class Openbsd(Bsd):
                 self.out.warn("File: `%s' does not exist!" % rc_conf)
                 continue
 
-            for line in self.image.g.cat(rc_conf).splitlines():
+            for line in self._files.cat(rc_conf).splitlines():
                 line = line.split('#')[0].strip()
                 if sshd_service.match(line):
                     sshd_enabled = sshd_no.match(line) is None
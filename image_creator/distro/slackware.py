@@ -29,8 +29,9 @@ class Slackware(Linux):
         # In Slackware the metadata about installed packages are
         # stored in /var/log/packages. Clearing all /var/log files
         # will destroy the package management system.
-        self._foreach_file('/var/log', self.image.g.truncate, ftype='r',
-                           exclude='/var/log/packages')
+        count = self._bulk_action('/var/log', 'truncate', ftype='r',
+                                  exclude='/var/log/packages')
+        self.out.success("emptied %d files" % count)
 
     def is_enabled(self, service):
         """Check if a service is enabled to start on boot"""
@@ -49,7 +49,7 @@ class Ubuntu(Linux):
             self.meta['OS'] = 'bitnami'
             readme = '/opt/bitnami/README.txt'
             if self.image.g.is_file(readme):
-                content = self.image.g.cat(readme).splitlines()
+                content = self._files.cat(readme).splitlines()
                 if content:
                     self.meta['OSVERSION'] = self.meta['DESCRIPTION']
                     self.meta['DESCRIPTION'] = content[0].strip()
@@ -155,7 +155,7 @@ class Unix(OSBase):
 
         paths = ['%s/bin/%s' % (p, X11_EXECUTABLE) for p in bin_prefixes]
         for path in paths:
-            if self.image.g.is_file(path):
+            if self._fsindex.is_file(path):
                 gui = True
                 break
 
@@ -168,7 +168,7 @@ class Unix(OSBase):
         for exe, session in DESKTOPSESSIONS.items():
             paths = ["%s/bin/%s" % (p, e) for p in bin_prefixes for e in exe]
             for path in paths:
-                if self.image.g.is_file(path):
+                if self._fsindex.is_file(path):
                     desktop.append(session)
                     break
         if gui and desktop:
@@ -185,7 +185,7 @@ class Unix(OSBase):
             if not self.image.g.is_file(fname):
                 return {}
 
-            for line in self.image.g.cat(fname).splitlines():
+            for line in self._files.cat(fname).splitlines():
                 line = line.split('#')[0].strip()
                 if not line:
                     continue
@@ -209,50 +209,57 @@ class Unix(OSBase):
     def _cleanup_cache(self):
         """Remove all regular files under /var/cache"""
 
-        self._foreach_file('/var/cache', self.image.g.rm, ftype='r')
+        count = self._bulk_action('/var/cache', 'rm', ftype='r')
+        self.out.success("removed %d files" % count)
 
     @sysprep('Removing files under /tmp and /var/tmp')
     def _cleanup_tmp(self):
         """Remove all files under /tmp and /var/tmp"""
 
-        self._foreach_file('/tmp', self.image.g.rm_rf, maxdepth=1)
-        self._foreach_file('/var/tmp', self.image.g.rm_rf, maxdepth=1)
+        count = self._bulk_action('/tmp', 'rm_rf', maxdepth=1)
+        count += self._bulk_action('/var/tmp', 'rm_rf', maxdepth=1)
+        self.out.success("removed %d files" % count)
 
     @sysprep('Emptying all files under /var/log')
     def _cleanup_log(self):
         """Empty all files under /var/log"""
 
-        self._foreach_file('/var/log', self.image.g.truncate, ftype='r')
+        count = self._bulk_action('/var/log', 'truncate', ftype='r')
+        self.out.success("emptied %d files" % count)
 
     @sysprep('Removing files under /var/mail & /var/spool/mail', enabled=False)
     def _cleanup_mail(self):
         """Remove all files under /var/mail and /var/spool/mail"""
 
-        self._foreach_file('/var/spool/mail', self.image.g.rm_rf, maxdepth=1)
-
-        self._foreach_file('/var/mail', self.image.g.rm_rf, maxdepth=1)
+        count = self._bulk_action('/var/spool/mail', 'rm_rf', maxdepth=1)
+        count += self._bulk_action('/var/mail', 'rm_rf', maxdepth=1)
+        self.out.success("removed %d files" % count)
 
     @sysprep('Removing sensitive user data')
     def _cleanup_userdata(self):
         """Delete sensitive user data"""
 
         homedirs = ['/root']
-        if self.image.g.is_dir('/home/'):
+        if self._fsindex.is_dir('/home/'):
             homedirs += self._ls('/home/')
 
-        action = self.image.g.rm_rf
+        action = 'rm_rf'
         if self._scrub_support:
-            action = self.image.g.scrub_file
+            action = 'scrub_file'
         else:
             self.out.warn("Sensitive data won't be scrubbed (not supported)")
 
+        count = 0
         sensitive_userdata = self.sysprep_params['sensitive_userdata'].value
         for homedir in homedirs:
             for data in sensitive_userdata:
                 fname = "%s/%s" % (homedir, data)
-                if self.image.g.is_file(fname):
-                    action(fname)
-                elif self.image.g.is_dir(fname):
-                    self._foreach_file(fname, action, ftype='r')
+                if self._fsindex.is_file(fname):
+                    getattr(self.image.g, action)(fname)
+                    count += 1
+                elif self._fsindex.is_dir(fname):
+                    count += self._bulk_action(fname, action, ftype='r')
+        self.out.success("%s %d files" % (
+            'scrubbed' if self._scrub_support else 'removed', count))
 
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -529,7 +529,7 @@ class Windows(OSBase):
 
         self.out.success('done')
 
-        self.image.disable_guestfs()
+        self.image.unplug_drive()
         booted = False
         try:
             self.out.info("Starting windows VM ...", False)
@@ -571,7 +571,7 @@ class Windows(OSBase):
                 # fatal.
                 self.vm.stop(shutdown_timeout if booted else 1, fatal=False)
         finally:
-            self.image.enable_guestfs()
+            self.image.plug_drive()
 
             self.out.info("Reverting media boot preparations ...", False)
             with self.mount(readonly=False, silent=True, fatal=False):
@@ -1041,7 +1041,7 @@ class Windows(OSBase):
         """Boot the media and install the VirtIO drivers"""
 
         old_windows = self.check_version(6, 1) <= 0
-        self.image.disable_guestfs()
+        self.image.unplug_drive()
         try:
             timeout = self.sysprep_params['boot_timeout'].value
             shutdown_timeout = self.sysprep_params['shutdown_timeout'].value
@@ -1076,7 +1076,7 @@ class Windows(OSBase):
             finally:
                 self.vm.stop(shutdown_timeout if booted else 1, fatal=False)
         finally:
-            self.image.enable_guestfs()
+            self.image.plug_drive()
 
         with self.mount(readonly=True, silent=True):
             self.virtio_state = self.compute_virtio_state()
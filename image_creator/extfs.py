@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the code for reading the block allocation bitmaps of
+ext2, ext3 and ext4 file systems.
+"""
+
+import re
+import struct
+
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_SIZE = 1024
+MAGIC = 0xEF53
+
+# Feature flags
+COMPAT_SPARSE_SUPER2 = 0x200
+INCOMPAT_RECOVER = 0x4
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+RO_COMPAT_SPARSE_SUPER = 0x1
+
+# Block group flags
+BG_BLOCK_UNINIT = 0x2
+
+
+class ExtFSError(Exception):
+    """Raised if the file system cannot be handled"""
+    pass
+
+
+class ExtFS(object):
+    """Represents an ext2/3/4 file system located at a specific offset of a
+    device.
+    """
+
+    class Superblock(object):
+        """Represents the fields of the superblock we need"""
+
+        def __init__(self, raw):
+            """Create a Superblock instance"""
+            def le32(off):
+                """Read a little-endian 32-bit field"""
+                return struct.unpack_from('<I', raw, off)[0]
+
+            def le16(off):
+                """Read a little-endian 16-bit field"""
+                return struct.unpack_from('<H', raw, off)[0]
+
+            self.magic = le16(0x38)
+            if self.magic != MAGIC:
+                raise ExtFSError("Not an ext2/3/4 file system")
+
+            self.inodes_count = le32(0x0)
+            self.first_data_block = le32(0x14)
+            self.block_size = 1024 << le32(0x18)
+            self.blocks_per_group = le32(0x20)
+            self.inodes_per_group = le32(0x28)
+            self.rev_level = le32(0x4C)
+            self.inode_size = le16(0x58) if self.rev_level >= 1 else 128
+            self.feature_compat = le32(0x5C)
+            self.feature_incompat = le32(0x60)
+            self.feature_ro_compat = le32(0x64)
+            self.reserved_gdt_blocks = le16(0xCE)
+
+            self.is_64bit = bool(self.feature_incompat & INCOMPAT_64BIT)
+            self.desc_size = le16(0xFE) if self.is_64bit else 32
+            self.blocks_count = le32(0x4)
+            if self.is_64bit:
+                self.blocks_count |= le32(0x150) << 32
+            self.backup_bgs = (le32(0x24C), le32(0x250))
+
+    def __init__(self, dev, offset):
+        """Create an ExtFS instance. dev is an open file object of the device
+        hosting the file system and offset is where the file system starts.
+        """
+        self.dev = dev
+        self.offset = offset
+
+        self.sb = self.Superblock(self._read(SUPERBLOCK_OFFSET,
+                                             SUPERBLOCK_SIZE))
+
+        if self.sb.feature_incompat & INCOMPAT_RECOVER:
+            raise ExtFSError("The journal needs recovery")
+        if self.sb.feature_incompat & INCOMPAT_META_BG:
+            raise ExtFSError("meta_bg file systems are not supported")
+        if self.sb.blocks_per_group == 0 or self.sb.desc_size < 32:
+            raise ExtFSError("Corrupted superblock")
+
+        self.groups = (self.sb.blocks_count - self.sb.first_data_block +
+                       self.sb.blocks_per_group - 1) // \
+            self.sb.blocks_per_group
+
+    def _read(self, offset, length):
+        """Read data relative to the beginning of the file system"""
+        self.dev.seek(self.offset + offset)
+        data = self.dev.read(length)
+        if len(data) != length:
+            raise ExtFSError("Short read at offset %d" % offset)
+        return data
+
+    def _read_block(self, block):
+        """Read a file system block"""
+        return self._read(block * self.sb.block_size, self.sb.block_size)
+
+    def _has_super(self, group):
+        """Check if a block group hosts a superblock backup"""
+        if group == 0:
+            return True
+
+        if self.sb.feature_compat & COMPAT_SPARSE_SUPER2:
+            return group in self.sb.backup_bgs
+
+        if group == 1 or not self.sb.feature_ro_compat & \
+                RO_COMPAT_SPARSE_SUPER:
+            return True
+
+        for base in (3, 5, 7):
+            n = base
+            while n < group:
+                n *= base
+            if n == group:
+                return True
+        return False
+
+    def _descriptors(self):
+        """Generator that yields a (block bitmap, inode bitmap, inode table,
+        flags) tuple for each block group.
+        """
+        sb = self.sb
+        size = self.groups * sb.desc_size
+        table = self._read((sb.first_data_block + 1) * sb.block_size, size)
+
+        for group in xrange(self.groups):
+            desc = table[group * sb.desc_size:(group + 1) * sb.desc_size]
+            block_bitmap, inode_bitmap, inode_table = \
+                struct.unpack_from('<III', desc, 0)
+            flags = struct.unpack_from('<H', desc, 0x12)[0]
+            if sb.is_64bit and sb.desc_size >= 64:
+                hi = struct.unpack_from('<III', desc, 0x20)
+                block_bitmap |= hi[0] << 32
+                inode_bitmap |= hi[1] << 32
+                inode_table |= hi[2] << 32
+            yield block_bitmap, inode_bitmap, inode_table, flags
+
+    def used_ranges(self):
+        """Returns a sorted list of (offset, length) tuples, relative to the
+        beginning of the file system, with the areas that are in use.
+        """
+        sb = self.sb
+        bs = sb.block_size
+        gdt_blocks = (self.groups * sb.desc_size + bs - 1) // bs
+        itable_blocks = (sb.inodes_per_group * sb.inode_size + bs - 1) // bs
+
+        # Everything before the first block group (e.g. the boot block of 1KB
+        # block file systems) is considered used.
+        used = [(0, sb.first_data_block)]
+        metadata = []
+
+        for group, desc in enumerate(self._descriptors()):
+            block_bitmap, inode_bitmap, inode_table, flags = desc
+            start = sb.first_data_block + group * sb.blocks_per_group
+            count = min(sb.blocks_per_group, sb.blocks_count - start)
+
+            metadata.append((block_bitmap, 1))
+            metadata.append((inode_bitmap, 1))
+            metadata.append((inode_table, itable_blocks))
+
+            if flags & BG_BLOCK_UNINIT:
+                # The bitmap is not initialized. Only the superblock backup
+                # and the group descriptors may be found in the group. The
+                # bitmaps and the inode table are added above.
+                if self._has_super(group):
+                    used.append((start, 1 + gdt_blocks +
+                                 sb.reserved_gdt_blocks))
+                continue
+
+            bitmap = self._read_block(block_bitmap)[:(count + 7) // 8]
+
+            # Work with whole bytes. A byte is considered free only if all 8
+            # blocks it maps are free.
+            prev = 0
+            for match in re.finditer('\x00+', bitmap):
+                free_start, free_end = match.start() * 8, match.end() * 8
+                if free_start > prev:
+                    used.append((start + prev, free_start - prev))
+                prev = free_end
+            if count > prev:
+                used.append((start + prev, count - prev))
+
+        ranges = []
+        for block, length in sorted(used + metadata):
+            if length <= 0:
+                continue
+            begin, end = block * bs, min(block + length, sb.blocks_count) * bs
+            if ranges and begin <= ranges[-1][0] + ranges[-1][1]:
+                last_begin, last_length = ranges[-1]
+                ranges[-1] = (last_begin,
+                              max(last_begin + last_length, end) - last_begin)
+            elif end > begin:
+                ranges.append((begin, end - begin))
+
+        return ranges
+
+    def size(self):
+        """Returns the size of the file system in bytes"""
+        return self.sb.blocks_count * self.sb.block_size
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
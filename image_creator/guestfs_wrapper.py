@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides a wrapper around libguestfs handles that counts the
+calls made to the helper VM, an index of the guest file system that answers
+file type queries from directory listings, a cache for the contents of guest
+files and a shared Augeas session.
+"""
+
+from fnmatch import fnmatch
+from collections import Counter
+
+# The guestfs calls that do not modify the guest or the mounted file systems
+READONLY_CALLS = frozenset((
+    'aug_get', 'aug_ls', 'aug_match', 'available', 'case_sensitive_path',
+    'cat', 'checksum', 'download', 'exists', 'file', 'file_architecture',
+    'find', 'find0', 'hivex_root', 'ls', 'ls0', 'lstat', 'lstatlist',
+    'lstatns', 'lstatnslist', 'mountpoints', 'mounts', 'part_list', 'pread',
+    'pread_device', 'read_file', 'read_lines', 'readdir', 'readlink',
+    'readlinklist', 'realpath', 'stat', 'statns', 'statvfs', 'sync',
+    'version', 'vfs_label', 'vfs_type', 'vfs_uuid'))
+
+# Augeas calls that only change the tree in memory. Their changes reach the
+# guest with aug_save.
+AUGEAS_TREE_CALLS = frozenset((
+    'aug_clear', 'aug_defnode', 'aug_defvar', 'aug_insert', 'aug_label',
+    'aug_mv', 'aug_rm', 'aug_set', 'aug_setm'))
+
+# The backup and package manager leftovers the stock Augeas lenses exclude
+AUGEAS_EXCL = ('*~', '*.rpmnew', '*.rpmsave', '*.rpmorig', '*.dpkg-old',
+               '*.dpkg-new', '*.dpkg-bak', '*.dpkg-dist', '*.augsave',
+               '*.augnew', '*.bak', '*.old', '#*#', '.#*')
+
+# Flags of aug_init: Do not load the files or the lens modules on init
+AUG_NO_LOAD = 32
+AUG_NO_MODL_AUTOLOAD = 64
+
+# Read-only calls that only look at the type of a file
+TYPE_QUERIES = frozenset(('exists', 'is_dir', 'is_file', 'is_symlink'))
+
+# Prefixes of the names of guestfs calls that only query information
+READONLY_PREFIXES = ('blockdev_get', 'get_', 'hivex_node_get',
+                     'hivex_node_children', 'hivex_node_name',
+                     'hivex_node_parent', 'hivex_node_values',
+                     'hivex_value_', 'inspect_get_', 'inspect_list_', 'is_',
+                     'list_', 'part_get_', 'part_to_')
+
+
+class GuestFS(object):
+    """A guestfs handle that counts the calls made to it. Every call that may
+    modify the guest increases the generation of the handle.
+    """
+
+    def __init__(self, factory):
+        """Create a new GuestFS instance. factory is called to create the
+        underlying guestfs handle.
+        """
+        self._factory = factory
+        self._handle = factory()
+        self.calls = Counter()
+        self.generation = 0
+        self._observers = []
+
+    def add_observer(self, observer):
+        """Register a function that is called with the name, the arguments
+        and the read-only flag of each call, before the call is made.
+        """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Unregister a function registered with add_observer()"""
+        self._observers.remove(observer)
+
+    def reset(self):
+        """Replace the underlying handle with a new one"""
+        self._handle = self._factory()
+        self.generation += 1
+
+    def __getattr__(self, name):
+        attr = getattr(self._handle, name)
+        if not callable(attr):
+            return attr
+
+        readonly = name in READONLY_CALLS or name in AUGEAS_TREE_CALLS or \
+            name.startswith(READONLY_PREFIXES)
+
+        def call(*args, **kwargs):
+            """Count the call and forward it to the handle"""
+            for observer in list(self._observers):
+                observer(name, args, readonly)
+            self.calls[name] += 1
+            if not readonly:
+                self.generation += 1
+            return attr(*args, **kwargs)
+        return call
+
+    @property
+    def total_calls(self):
+        """The number of calls made to the handle"""
+        return sum(self.calls.values())
+
+
+class FileIndex(object):
+    """An index of the mounted guest file system. The type of a file is
+    looked up in the listing of its parent directory, which is fetched with a
+    single call and kept until the guest gets modified. Files created through
+    a FileCache are found before they are written back.
+    """
+
+    def __init__(self, g, files=None):
+        """Create a new FileIndex instance for a GuestFS handle and an
+        optional FileCache
+        """
+        self.g = g
+        self.files = files
+        self._dirs = {}
+        self._generation = None
+
+    def invalidate(self):
+        """Forget all the directory listings"""
+        self._dirs.clear()
+        self._generation = None
+
+    def _listing(self, directory):
+        """Returns a dictionary with the type of each file in a directory"""
+        if self._generation != self.g.generation:
+            self._dirs.clear()
+            self._generation = self.g.generation
+
+        if directory not in self._dirs:
+            try:
+                entries = self.g.readdir(directory)
+            except RuntimeError:
+                entries = []  # The directory does not exist
+            self._dirs[directory] = dict((e['name'], e['ftyp'])
+                                         for e in entries)
+        return self._dirs[directory]
+
+    def ftype(self, path):
+        """Returns the type of a file as returned by guestfs_readdir, or None
+        if it does not exist. Symbolic links are not followed.
+        """
+        assert path.startswith('/'), "Path is not absolute: %s" % path
+
+        directory, _, name = path.rstrip('/').rpartition('/')
+        if not name:
+            return 'd'  # The root directory
+
+        ftyp = self._listing(directory or '/').get(name)
+        if ftyp is None and self.files is not None and \
+                self.files.pending(path.rstrip('/')):
+            return 'r'  # A new file that is not written back yet
+        return ftyp
+
+    def is_file(self, path, followsymlinks=False):
+        """Returns True if path is a regular file"""
+        ftyp = self.ftype(path)
+        if ftyp == 'l' and followsymlinks:
+            return self.g.is_file(path, followsymlinks=True)
+        return ftyp == 'r'
+
+    def is_dir(self, path, followsymlinks=False):
+        """Returns True if path is a directory"""
+        ftyp = self.ftype(path)
+        # A trailing slash makes the path refer to the target of a link
+        if ftyp == 'l' and (followsymlinks or path.endswith('/')):
+            return self.g.is_dir(path, followsymlinks=True)
+        return ftyp == 'd'
+
+    def exists(self, path):
+        """Returns True if path exists"""
+        ftyp = self.ftype(path)
+        if ftyp == 'l':
+            return self.g.exists(path)  # The link may be broken
+        return ftyp is not None
+
+
+class FileCache(object):
+    """A write-back cache for the contents of guest files. While enabled,
+    repeated reads of a file are served from memory and the writes to a file
+    are only uploaded once, when the cache is flushed. Pending writes are
+    also flushed before any other call that may observe or modify them.
+    """
+
+    def __init__(self, g):
+        """Create a new FileCache instance for a GuestFS handle"""
+        self.g = g
+        self.enabled = False
+        self._data = {}
+        self._dirty = []
+        # Files that were read from the guest. Writing them does not change
+        # their type.
+        self._existing = set()
+        self._flushing = False
+        self._observers = []
+
+    def add_observer(self, observer):
+        """Register a function that is called with the path and a write flag
+        before a file is read or written through the cache.
+        """
+        self._observers.append(observer)
+
+    def enable(self):
+        """Start caching"""
+        if not self.enabled:
+            self.g.add_observer(self._observe)
+            self.enabled = True
+
+    def disable(self):
+        """Write back the pending changes and stop caching"""
+        if not self.enabled:
+            return
+        try:
+            self.flush()
+        finally:
+            self.g.remove_observer(self._observe)
+            self.enabled = False
+            self._data.clear()
+            self._existing.clear()
+            del self._dirty[:]
+
+    def flush(self):
+        """Write back the pending changes"""
+        self._flushing = True
+        try:
+            while self._dirty:
+                path = self._dirty[0]
+                self.g.write(path, self._data[path])
+                del self._dirty[0]
+        finally:
+            self._flushing = False
+
+    def pending(self, path):
+        """Returns True if path has changes that are not written back"""
+        return path in self._dirty
+
+    def cat(self, path):
+        """Returns the contents of a guest file"""
+        if not self.enabled:
+            return self.g.cat(path)
+
+        for observer in list(self._observers):
+            observer(path, False)
+
+        if path not in self._data:
+            self._data[path] = self.g.cat(path)
+            self._existing.add(path)
+        return self._data[path]
+
+    def write(self, path, content):
+        """Replace the contents of a guest file"""
+        if not self.enabled:
+            self.g.write(path, content)
+            return
+
+        for observer in list(self._observers):
+            observer(path, True)
+
+        self._data[path] = content
+        if path not in self._dirty:
+            self._dirty.append(path)
+
+    def _observe(self, name, args, readonly):
+        """Keep the guest consistent with the cache before a call is made"""
+        if self._flushing:
+            return
+
+        if not readonly:
+            self.flush()
+            # The call may change any of the cached files
+            self._data.clear()
+            self._existing.clear()
+            return
+
+        if not (self._dirty and args and isinstance(args[0], basestring) and
+                args[0].startswith('/')):
+            return
+
+        path = args[0].rstrip('/')
+        if name in TYPE_QUERIES:
+            # Only the creation of a file changes the answer
+            if path in self._dirty and path not in self._existing:
+                self.flush()
+            return
+
+        # Any other read-only call on a file with pending changes or on a
+        # directory containing one needs to see them.
+        for dirty in self._dirty:
+            if dirty == path or dirty.startswith(path + '/'):
+                self.flush()
+                break
+
+
+class AugeasSession(object):
+    """An Augeas session shared by the users of a mounted guest. Only the
+    transforms that are added are loaded, and the changes are saved once when
+    the session is closed, or earlier if the guest needs to see them.
+    """
+
+    def __init__(self, g):
+        """Create a new AugeasSession instance for a GuestFS handle"""
+        self.g = g
+        self.enabled = False
+        self.opened = False
+        self._transforms = {}
+        self._applied = set()
+        self._loaded = False
+        self._dirty = False
+
+    def enable(self):
+        """Allow the session to be opened"""
+        if not self.enabled:
+            self.g.add_observer(self._observe)
+            self.enabled = True
+
+    def disable(self):
+        """Save the changes and close the session"""
+        if not self.enabled:
+            return
+        try:
+            if self.opened:
+                try:
+                    if self._dirty:
+                        self.save()
+                finally:
+                    self.g.aug_close()
+        finally:
+            self.g.remove_observer(self._observe)
+            self.enabled = False
+            self.opened = False
+            self._applied.clear()
+            self._loaded = False
+            self._dirty = False
+
+    def add_transform(self, name, lens, incl, excl=AUGEAS_EXCL):
+        """Have the files matching the incl patterns and none of the excl
+        patterns loaded using lens. name identifies the transform under
+        /augeas/load.
+        """
+        transform = (lens, list(incl), list(excl))
+        if self._transforms.get(name) != transform:
+            self._transforms[name] = transform
+            self._applied.discard(name)
+
+    def save(self):
+        """Save the changes made to the tree"""
+        self._dirty = False
+        self.g.aug_save()
+
+    def load(self):
+        """Open the session if needed and make sure the files of all the
+        transforms are loaded.
+        """
+        assert self.enabled, "The Augeas session is not enabled"
+
+        if not self.opened:
+            self.g.aug_init('/', AUG_NO_LOAD | AUG_NO_MODL_AUTOLOAD)
+            self.opened = True
+
+        new = [n for n in self._transforms if n not in self._applied]
+        if new:
+            # Loading drops the unsaved changes
+            if self._dirty:
+                self.save()
+            for name in new:
+                lens, incl, excl = self._transforms[name]
+                self.g.aug_rm('/augeas/load/%s' % name)
+                self.g.aug_set('/augeas/load/%s/lens' % name, lens)
+                for i, pattern in enumerate(incl):
+                    self.g.aug_set('/augeas/load/%s/incl[%d]' % (name, i + 1),
+                                   pattern)
+                for i, pattern in enumerate(excl):
+                    self.g.aug_set('/augeas/load/%s/excl[%d]' % (name, i + 1),
+                                   pattern)
+                self._applied.add(name)
+            self._loaded = False
+
+        if not self._loaded:
+            self.g.aug_load()
+            self._loaded = True
+            self._dirty = False
+
+    def _related(self, path):
+        """Returns True if path is a file handled by the session or a
+        directory above one
+        """
+        path = path.rstrip('/')
+        basename = path.rpartition('/')[2]
+        for _, incl, excl in self._transforms.values():
+            for pattern in incl:
+                if pattern.startswith(path + '/'):
+                    return True
+                # Like Augeas, match the patterns without a slash against the
+                # file name
+                if fnmatch(path, pattern) and not any(
+                        fnmatch(basename if '/' not in p else path, p)
+                        for p in excl):
+                    return True
+        return False
+
+    def observe_file(self, path, write):
+        """Keep the session consistent with a file that is read or written
+        through a FileCache. The write does not reach the guest before the
+        cache is flushed, so the tree is reloaded the next time it is used.
+        """
+        if not (self.opened and self._related(path)):
+            return
+
+        if self._dirty:
+            self.save()
+        if write:
+            self._loaded = False
+
+    def _observe(self, name, args, readonly):
+        """Save the changes before the guest sees the files they affect and
+        reload the tree after the files get modified by other means.
+        """
+        if not self.opened:
+            return
+
+        if name.startswith('aug_'):
+            if name in AUGEAS_TREE_CALLS:
+                self._dirty = True
+            return
+
+        paths = [a for a in args
+                 if isinstance(a, basestring) and a.startswith('/')]
+
+        if not readonly:
+            # Calls without paths, like mount or command, may affect anything
+            if not paths or any(self._related(p) for p in paths):
+                if self._dirty:
+                    self.save()
+                self._loaded = False
+            return
+
+        if not (self._dirty and paths and self._related(paths[0])):
+            return
+
+        # Saving a file that was loaded does not change its type
+        if name in TYPE_QUERIES and \
+                self.g.aug_match('/augeas/files%s' % paths[0].rstrip('/')):
+            return
+
+        self.save()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
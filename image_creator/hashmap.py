@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the code for computing the block hashmap of a file,
+the way the Pithos+ storage service does.
+"""
+
+import os
+import json
+import hashlib
+import binascii
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from image_creator.util import FatalError
+
+# The defaults of Pithos+
+BLOCKSIZE = 2 ** 22  # 4MB
+BLOCKHASH = 'sha256'
+
+
+def hash_block(block, blockhash):
+    """Returns the Pithos+ hash of a block of data"""
+    h = hashlib.new(blockhash)
+    h.update(block.rstrip('\x00'))
+    return h.hexdigest()
+
+
+def _hash_file_blocks(path, blocksize, blockhash, first, last, size):
+    """Hash the blocks in [first, last) of a file. Each call opens its own
+    file descriptor, so that it can run in parallel with other calls.
+    """
+    hashes = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.lseek(fd, first * blocksize, os.SEEK_SET)
+        for index in xrange(first, last):
+            length = min(blocksize, size - index * blocksize)
+            chunks = []
+            while length > 0:
+                data = os.read(fd, length)
+                if not data:
+                    raise FatalError("Short read in block %d of `%s'" %
+                                     (index, path))
+                chunks.append(data)
+                length -= len(data)
+            hashes.append(hash_block(''.join(chunks), blockhash))
+    finally:
+        os.close(fd)
+    return hashes
+
+
+class Hashmap(object):
+    """Computes the Pithos+ hashmap of a stream of data.
+
+    The instances of this class can be used like hashlib objects. The data is
+    fed using the update() method in chunks of any size. Each block is hashed
+    after stripping the trailing zeros, like Pithos+ does.
+
+    If workers is larger than 1, the blocks are hashed in a pool of threads
+    while the caller goes on reading the next blocks. hashlib releases the GIL
+    while hashing large buffers, so the threads run on different cores.
+
+    If callback is defined, it is called with the hash and the data of each
+    block, in order, as soon as the hash of the block is known.
+    """
+
+    def __init__(self, blocksize=BLOCKSIZE, blockhash=BLOCKHASH, workers=1,
+                 callback=None):
+        """Create a Hashmap instance"""
+        self.blocksize = blocksize
+        self.blockhash = blockhash
+        self.callback = callback
+        self.hashes = []
+        self.size = 0
+        self._pending = []
+        self._pending_size = 0
+
+        # Make sure the hash algorithm is supported
+        hashlib.new(blockhash)
+
+        self.workers = workers
+        self._pool = ThreadPool(workers) if workers > 1 else None
+        # Blocks submitted to the pool, in order
+        self._flying = deque()
+
+    def _add_hash(self, block_hash, block):
+        """Append the hash of the next block"""
+        self.hashes.append(block_hash)
+        if self.callback is not None:
+            self.callback(block_hash, block)
+
+    def _hash_block(self, block):
+        """Hash a block of data"""
+        if self._pool is None:
+            self._add_hash(hash_block(block, self.blockhash), block)
+            return
+
+        # Limit the number of blocks kept in memory
+        while len(self._flying) >= 2 * self.workers:
+            self._collect()
+
+        self._flying.append((block, self._pool.apply_async(
+            hash_block, (block, self.blockhash))))
+
+    def _collect(self):
+        """Collect the hash of the oldest block hashed by the pool"""
+        block, result = self._flying.popleft()
+        self._add_hash(result.get(), block)
+
+    def update(self, data):
+        """Feed the hashmap with more data"""
+        if not isinstance(data, str):  # The blocks are kept for hashing
+            data = str(data)
+        self.size += len(data)
+
+        # Fast path for aligned, full sized blocks
+        if not self._pending and len(data) == self.blocksize:
+            self._hash_block(data)
+            return
+
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size < self.blocksize:
+            return
+
+        buf = ''.join(self._pending)
+        offset = 0
+        while len(buf) - offset >= self.blocksize:
+            self._hash_block(buf[offset:offset + self.blocksize])
+            offset += self.blocksize
+
+        rest = buf[offset:]
+        self._pending = [rest] if rest else []
+        self._pending_size = len(rest)
+
+    def finish(self):
+        """Hash the last, partial block. No more data may be fed after this
+        is called. The list of block hashes is returned.
+        """
+        if self._pending:
+            self._hash_block(''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+        while self._flying:
+            self._collect()
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+        return self.hashes
+
+    @classmethod
+    def from_file(cls, path, size, blocksize=BLOCKSIZE, blockhash=BLOCKHASH,
+                  workers=None, progress=None):
+        """Compute the hashmap of the first size bytes of a file or a block
+        device. The file is split in disjoint ranges of blocks that are read
+        and hashed by a pool of workers, each using its own file descriptor.
+
+        If progress is defined, it is called with the number of bytes hashed
+        every time a range completes.
+        """
+        workers = cpu_count() if workers is None else workers
+        hashmap = cls(blocksize, blockhash)
+        hashmap.size = size
+
+        nblocks = (size + blocksize - 1) // blocksize
+        # Use small ranges to keep all the workers busy until the end
+        step = max(1, min(64, nblocks // (4 * workers) or 1))
+        ranges = [(i, min(i + step, nblocks))
+                  for i in xrange(0, nblocks, step)]
+
+        pool = ThreadPool(workers)
+        try:
+            results = [pool.apply_async(
+                _hash_file_blocks,
+                (path, blocksize, blockhash, first, last, size))
+                for first, last in ranges]
+            for (first, last), result in zip(ranges, results):
+                hashmap.hashes.extend(result.get())
+                if progress is not None:
+                    progress(min(last * blocksize, size))
+        finally:
+            pool.close()
+            pool.join()
+
+        return hashmap
+
+    def top_hash(self):
+        """Returns the top hash of the Merkle tree built on top of the block
+        hashes. This is the value Pithos+ reports as the hash of an object.
+        """
+        hashes = [binascii.unhexlify(h) for h in self.hashes]
+
+        if len(hashes) == 0:
+            return hashlib.new(self.blockhash, '').hexdigest()
+        if len(hashes) == 1:
+            return self.hashes[0]
+
+        size = 2
+        while size < len(hashes):
+            size *= 2
+        hashes += ['\x00' * len(hashes[0])] * (size - len(hashes))
+
+        while len(hashes) > 1:
+            hashes = [hashlib.new(self.blockhash,
+                                  hashes[i] + hashes[i + 1]).digest()
+                      for i in xrange(0, len(hashes), 2)]
+
+        return binascii.hexlify(hashes[0])
+
+    def save(self, path):
+        """Save the hashmap in a JSON file"""
+        hashmap = self.to_dict()
+        hashmap['hash'] = self.top_hash()
+        with open(path, 'w') as f:
+            json.dump(hashmap, f)
+
+    @classmethod
+    def load(cls, path):
+        """Load a hashmap previously saved with save()"""
+        with open(path) as f:
+            data = json.load(f)
+
+        hashmap = cls(int(data['block_size']), str(data['block_hash']))
+        hashmap.size = int(data['bytes'])
+        hashmap.hashes = [str(h) for h in data['hashes']]
+        return hashmap
+
+    def block_range(self, index):
+        """Returns the (offset, length) tuple of a block"""
+        offset = index * self.blocksize
+        return offset, min(self.blocksize, self.size - offset)
+
+    def diff(self, other):
+        """Returns the indices of the blocks that differ from the ones of
+        another hashmap of the same data. Blocks present in only one of the
+        two hashmaps are considered different.
+        """
+        if (self.blocksize, self.blockhash) != \
+                (other.blocksize, other.blockhash):
+            raise ValueError("The hashmaps use different blocks: %d/%s != "
+                             "%d/%s" % (self.blocksize, self.blockhash,
+                                        other.blocksize, other.blockhash))
+
+        common = min(len(self.hashes), len(other.hashes))
+        different = [i for i in xrange(common)
+                     if self.hashes[i] != other.hashes[i]]
+        different.extend(xrange(common, max(len(self.hashes),
+                                            len(other.hashes))))
+        return different
+
+    def to_dict(self):
+        """Returns the hashmap in the format Pithos+ uses"""
+        return {'block_size': self.blocksize,
+                'block_hash': self.blockhash,
+                'bytes': self.size,
+                'hashes': self.hashes}
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -19,19 +19,86 @@
 
 import os
 import re
+import time
 import hashlib
 import threading
+from collections import namedtuple
+from multiprocessing import cpu_count
 
 from sendfile import sendfile
 
 from image_creator.util import FatalError, QemuNBD, get_command
+from image_creator import blockio
 from image_creator.gpt import GPTPartitionTable
+from image_creator.extfs import ExtFS, ExtFSError
+from image_creator.hashmap import Hashmap, BLOCKSIZE, BLOCKHASH
+from image_creator.compress import CompressedWriter
+from image_creator.qcow2 import Qcow2Writer
+from image_creator.pipeline import Pipeline
 from image_creator.distro import distro_cls
+from image_creator.guestfs_wrapper import GuestFS
 
-# Make sure libguestfs runs qemu directly to launch an appliance.
-os.environ['LIBGUESTFS_BACKEND'] = 'direct'
+# Make libguestfs run qemu directly to launch an appliance, unless the user
+# has selected a backend. The libvirt backend allows hotplugging the media.
+os.environ.setdefault('LIBGUESTFS_BACKEND', 'direct')
 import guestfs  # noqa pylint: disable=wrong-import-position,wrong-import-order
 
+# The memory in MB and the number of vCPUs of the helper VM. None leaves the
+# libguestfs default in place.
+ApplianceParams = namedtuple('ApplianceParams', 'memsize smp')
+DEFAULT_APPLIANCE = ApplianceParams(None, None)
+
+# Limits of the automatically selected helper VM resources
+MIN_AUTO_MEMSIZE = 768
+MAX_AUTO_MEMSIZE = 4096
+MAX_AUTO_SMP = 4
+
+# The label of the media drive in the helper VM. Labeled drives can be
+# hot-removed and hot-added while the helper VM is running.
+DRIVE_LABEL = 'media'
+
+
+def host_appliance_params():
+    """Returns helper VM resources that suit the host. The VM gets an eighth
+    of the host memory and half of its CPUs, within limits.
+    """
+    try:
+        total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        total = 0
+    memsize = min(MAX_AUTO_MEMSIZE, total // 8 // 2 ** 20)
+    smp = min(MAX_AUTO_SMP, cpu_count() // 2)
+
+    return ApplianceParams(memsize if memsize >= MIN_AUTO_MEMSIZE else None,
+                           smp if smp > 1 else None)
+
+
+def setup_appliance(g, params):
+    """Set the resources of the helper VM of a guestfs handle. This needs to
+    be called before the handle is launched.
+    """
+    if params.memsize:
+        g.set_memsize(params.memsize)
+    if params.smp and hasattr(g, 'set_smp'):
+        g.set_smp(params.smp)
+
+
+def add_drive(g, device, throwaway=False, label=None):
+    """Add a drive to a guestfs handle for writing. If the device is a
+    throwaway snapshot, the flush requests of the helper VM are ignored,
+    since nothing needs to survive a crash of the host.
+    """
+    opts = {'readonly': 0}
+    if label is not None:
+        opts['label'] = label
+    if throwaway:
+        try:
+            g.add_drive_opts(device, cachemode='unsafe', **opts)
+            return
+        except TypeError:
+            pass  # Old libguestfs versions do not support cachemode
+    g.add_drive_opts(device, **opts)
+
 
 class Image(object):
     """The instances of this class can create images out of block devices."""
@@ -46,14 +113,31 @@ class Image(object):
         self.meta = kwargs['meta'] if 'meta' in kwargs else {}
         self.sysprep_params = \
             kwargs['sysprep_params'] if 'sysprep_params' in kwargs else {}
+        self.io_params = kwargs['io_params'] if 'io_params' in kwargs \
+            else blockio.DEFAULT_IO
+        self.appliance = kwargs['appliance'] if 'appliance' in kwargs \
+            else DEFAULT_APPLIANCE
+        # The device is a snapshot that is thrown away afterwards
+        self.throwaway = kwargs['throwaway'] if 'throwaway' in kwargs \
+            else False
 
         self.progress_bar = None
         self.guestfs_device = None
         self.size = 0
 
-        self.g = guestfs.GuestFS()
+        self.g = GuestFS(guestfs.GuestFS)
         self.guestfs_enabled = False
         self.guestfs_version = self.g.version()
+        # A helper VM launch running in the background
+        self._launcher = None
+        self._launch_error = None
+        # Drive hotplugging was introduced in version 1.19.49 and is only
+        # supported by the libvirt backend.
+        self.hotplug = hasattr(self.g, 'remove_drive') and \
+            self.check_guestfs_version(1, 19, 49) >= 0 and \
+            getattr(self.g, 'get_backend',
+                    lambda: 'direct')().startswith('libvirt')
+        self._unplugged = False
 
         # This is needed if the image format is not raw
         self.nbd = QemuNBD(device)
@@ -134,20 +218,18 @@ class Image(object):
         """Returns if this image is unsupported"""
         return hasattr(self, '_unsupported')
 
-    def enable_guestfs(self):
-        """Enable the guestfs handler"""
-
-        if self.guestfs_enabled:
-            self.out.warn("Guestfs is already enabled")
-            return
+    def _prepare_guestfs(self):
+        """Prepare the guestfs handler for launching the helper VM"""
 
         # Before version 1.18.4 the behavior of kill_subprocess was different
         # and you need to reset the guestfs handler to relaunch a previously
         # shut down QEMU backend
         if self.check_guestfs_version(1, 18, 4) < 0:
-            self.g = guestfs.GuestFS()
+            self.g.reset()
 
-        self.g.add_drive_opts(self.device, readonly=0)
+        add_drive(self.g, self.device, self.throwaway,
+                  DRIVE_LABEL if self.hotplug else None)
+        setup_appliance(self.g, self.appliance)
 
         # Before version 1.17.14 the recovery process, which is a fork of the
         # original process that called libguestfs, did not close its inherited
@@ -164,17 +246,69 @@ class Image(object):
         # self.g.set_trace(1)
         # self.g.set_verbose(1)
 
-        self.out.info('Launching helper VM (may take a while) ...', False)
-        # self.progressbar = self.out.Progress(100, "Launching helper VM",
-        #                                     "percent")
-        # eh = self.g.set_event_callback(self.progress_callback,
-        #                               guestfs.EVENT_PROGRESS)
-        try:
-            self.g.launch()
-        except RuntimeError as e:
+    def launch_guestfs(self):
+        """Start launching the helper VM in the background. The launch is
+        waited for the first time the guestfs handler is enabled. The handler
+        must not be used in the meantime.
+        """
+
+        if self.guestfs_enabled or self._launcher is not None:
+            return
+
+        self._prepare_guestfs()
+
+        def launch():
+            """Body of the launcher thread"""
+            try:
+                self.g.launch()
+            except RuntimeError as e:
+                self._launch_error = e
+
+        self.out.info('Launching helper VM in the background ...', False)
+        self._launcher = threading.Thread(target=launch)
+        self._launcher.daemon = True
+        self._launcher.start()
+        self.out.success('started')
+
+    def _wait_launch(self):
+        """Wait for a launch started by launch_guestfs() to complete"""
+        while self._launcher.is_alive():
+            # A timeout lets signals reach the main thread
+            self._launcher.join(1)
+        self._launcher = None
+
+        error = self._launch_error
+        self._launch_error = None
+        return error
+
+    def enable_guestfs(self):
+        """Enable the guestfs handler"""
+
+        if self.guestfs_enabled:
+            self.out.warn("Guestfs is already enabled")
+            return
+
+        if self._launcher is not None:
+            self.out.info('Waiting for the helper VM to launch ...', False)
+            error = self._wait_launch()
+        else:
+            self._prepare_guestfs()
+            self.out.info('Launching helper VM (may take a while) ...', False)
+            # self.progressbar = self.out.Progress(100, "Launching helper VM",
+            #                                     "percent")
+            # eh = self.g.set_event_callback(self.progress_callback,
+            #                               guestfs.EVENT_PROGRESS)
+            try:
+                self.g.launch()
+                error = None
+            except RuntimeError as e:
+                error = e
+
+        if error is not None:
             raise FatalError(
                 "Launching libguestfs's helper VM failed!\nReason: %s.\n\n"
-                "Please run `libguestfs-test-tool' for more info." % str(e))
+                "Please run `libguestfs-test-tool' for more info." %
+                str(error))
 
         self.guestfs_enabled = True
         # self.g.delete_event_callback(eh)
@@ -209,6 +343,63 @@ class Image(object):
         self.guestfs_enabled = False
         self.out.success('done')
 
+    def unplug_drive(self):
+        """Detach the media from the helper VM, so that another VM can use
+        it. If drive hotplugging is not supported, the helper VM is shut down
+        instead.
+        """
+
+        if not self.guestfs_enabled:
+            self.out.warn("Guestfs is already disabled")
+            return
+
+        if self.hotplug:
+            self.out.info("Unplugging media from the helper VM ...", False)
+            self.g.umount_all()
+            self.g.sync()
+            try:
+                self.g.remove_drive(DRIVE_LABEL)
+            except RuntimeError:
+                self.hotplug = False
+                self.out.success('not supported')
+            else:
+                self.guestfs_enabled = False
+                self._unplugged = True
+                self.out.success('done')
+                return
+
+        self.disable_guestfs()
+
+    def plug_drive(self):
+        """Attach the media to the helper VM again after unplug_drive(). If
+        the drive cannot be hot-added, the helper VM is relaunched.
+        """
+
+        if not self._unplugged:
+            self.enable_guestfs()
+            return
+
+        self.out.info("Plugging media into the helper VM ...", False)
+        self._unplugged = False
+        try:
+            add_drive(self.g, self.device, self.throwaway, DRIVE_LABEL)
+            # The partitions are addressed by the name of the disk device
+            plugged = self.guestfs_device in self.g.list_devices()
+        except RuntimeError:
+            plugged = False
+
+        if plugged:
+            self.guestfs_enabled = True
+            self.out.success('done')
+            return
+
+        self.hotplug = False
+        self.out.success('failed')
+        self.out.info("Shutting down helper VM ...", False)
+        self.g.shutdown()
+        self.out.success('done')
+        self.enable_guestfs()
+
     @property
     def os(self):
         """Return an OS class instance for this image"""
@@ -253,6 +444,10 @@ class Image(object):
     def destroy(self):
         """Destroy this Image instance."""
 
+        # The handler may not be used while the helper VM is launching
+        if self._launcher is not None:
+            self._wait_launch()
+
         # In new guestfs versions, there is a handy shutdown method for this
         try:
             if self.guestfs_enabled:
@@ -458,6 +653,7 @@ class Image(object):
         block_size = int(filter(lambda x: x[0] == 'Block size', out)[0][1])
         old_block_cnt = int(filter(lambda x: x[0] == 'Block count', out)[0][1])
 
+        start = time.time()
         try:
             if self.check_guestfs_version(1, 15, 17) >= 0:
                 self.g.e2fsck(part_dev, forceall=1)
@@ -500,8 +696,8 @@ class Image(object):
             self.size = min(new_size + 2048 * sector_size, self.size)
 
         if not silent:
-            self.out.success("Image size is %dMB" %
-                             ((self.size + MB - 1) // MB))
+            self.out.success("Image size is %dMB (shrinking took %.1fs)" %
+                             ((self.size + MB - 1) // MB, time.time() - start))
 
         return part_dev
 
@@ -570,11 +766,183 @@ class Image(object):
         finally:
             self.os.umount()
 
-    def dump(self, outfile):
+    def used_ranges(self, raw):
+        """Returns a sorted list of (offset, length) tuples with the parts of
+        the image that need to be copied.
+
+        Everything that is not hosted on an ext[234] file system is considered
+        used. This includes the partition tables, the gaps between the
+        partitions where the bootloaders live and all non-ext partitions. For
+        ext[234] file systems, only the allocated blocks found in the block
+        bitmaps are included.
+        """
+        if self.is_unsupported() or not self.guestfs_enabled:
+            return [(0, self.size)]
+
+        free = []
+        with open(raw, 'rb') as dev:
+            for partition in self.g.part_list(self.guestfs_device):
+                start = partition['part_start']
+                try:
+                    fs = ExtFS(dev, start)
+                    used = fs.used_ranges()
+                except ExtFSError:
+                    continue
+
+                end = start + min(fs.size(), partition['part_size'])
+                prev = start
+                for offset, length in used + [(end - start, 0)]:
+                    if start + offset > prev:
+                        free.append((prev, start + offset - prev))
+                    prev = max(prev, start + offset + length)
+
+        ranges = []
+        prev = 0
+        for offset, length in sorted(free) + [(self.size, 0)]:
+            offset = min(offset, self.size)
+            if offset > prev:
+                ranges.append((prev, offset - prev))
+            prev = max(prev, offset + length)
+
+        return ranges
+
+    def dump(self, outfile, md5=False, sparse=False, used_only=False,
+             hashmap=None, compress=None, fmt='raw', bmap=None,
+             pipeline=False):
         """Dumps the content of the image into a file.
 
         This method will only dump the actual payload, found by reading the
         partition table. Empty space in the end of the device will be ignored.
+
+        If md5 is True, the MD5 checksum of the image is computed while the
+        file is being written and is returned. This way the device is only
+        read once. If the media is a regular file that the kernel can copy
+        on its own, the file is copied first and then read to compute the
+        checksum instead. Should the kernel fail to copy all of it, the file
+        is written again while the checksum is computed.
+
+        If sparse is True, holes of the source and blocks that only contain
+        zeros are not written. They are left as holes in the output file.
+
+        If used_only is True, the blocks that are not allocated by an ext[234]
+        file system are not copied. Zeros (or holes, if sparse is True) are
+        written in their place.
+
+        If hashmap is defined, it should be a Hashmap instance. It is fed with
+        the dumped data, so that the block hashes needed for uploading the
+        image are computed in the same pass.
+
+        If compress is defined, the output file is compressed using this
+        method (gzip, xz or zstd) on multiple threads. The md5 checksum and
+        the hashmap always refer to the uncompressed data.
+
+        If fmt is `qcow2', a QCOW2 image file is written instead of a raw one.
+        Clusters that are unallocated or only contain zeros are omitted. In
+        this case compress may only be `zlib', which compresses each cluster
+        separately. The md5 checksum and the hashmap still refer to the raw
+        image data.
+
+        If bmap is defined, it should be a Bmap instance. It is fed with the
+        ranges of the image that are written to the output file, so that a
+        bmap file can be created for it.
+
+        If pipeline is True, writing the file and computing the checksums
+        overlap with reading the image, on separate threads.
+
+        The I/O is performed according to the io_params of the image (see
+        blockio.IOParams).
+        """
+        assert fmt in ('raw', 'qcow2'), "Unknown image format: %s" % fmt
+
+        if not (sparse or used_only or hashmap is not None or
+                compress is not None or fmt != 'raw' or bmap is not None or
+                self.io_params.direct or self.io_params.nocache):
+            if not md5:
+                return self._sendfile(outfile)
+            # If the checksum is needed, the copy is read back to compute it.
+            # This only pays off if the kernel copied the media without
+            # reading them, which may be the case if they are a regular file.
+            if self._fast_copy_support():
+                checksum = self._fast_copy(outfile)
+                if checksum is not None:
+                    return checksum
+
+        checksum = hashlib.md5() if md5 else None
+        digests = [d for d in (checksum, hashmap) if d is not None]
+        with open(outfile, "wb") as fileobj:
+            f = blockio.OutputFile(fileobj, self.io_params.nocache)
+            if fmt == 'qcow2':
+                dst = Qcow2Writer(f, self.size, compress is not None)
+                title = "Dumping %sqcow2 image file" % \
+                    ("compressed " if compress is not None else "")
+                # Zero blocks are skipped by seeking forward
+                progressbar = self._copy(title, dst, digests, True, used_only,
+                                         bmap, pipeline)
+                dst.close()
+            elif compress is not None:
+                dst = CompressedWriter(f, compress)
+                progressbar = self._copy("Dumping %s compressed image file" %
+                                         compress, dst, digests, False,
+                                         used_only, bmap, pipeline)
+                dst.close()
+            else:
+                if not sparse:
+                    f.allocate(self.size)
+                progressbar = self._copy("Dumping image file", f, digests,
+                                         sparse, used_only, bmap, pipeline)
+            f.close()
+        if hashmap is not None:
+            hashmap.finish()
+        if bmap is not None:
+            bmap.finish()
+
+        if not md5:
+            progressbar.success(
+                'image file %s was successfully created' % outfile)
+            return None
+
+        checksum = checksum.hexdigest()
+        progressbar.success('image file %s was successfully created '
+                            '(md5sum: %s)' % (outfile, checksum))
+        return checksum
+
+    def _fast_copy_support(self):
+        """Returns True if the media may be copied with a reflink or with
+        copy_file_range
+        """
+        return self.format == 'raw' and os.path.isfile(self.device)
+
+    def _fast_copy(self, outfile):
+        """Dumps a media file using a reflink or copy_file_range and returns
+        the MD5 checksum of the output file. If the file system cannot copy
+        the whole file, None is returned and the output file is incomplete.
+        """
+        MB = 2 ** 20
+        progr_size = (self.size + MB - 1) // MB  # in MB
+        progressbar = self.out.Progress(progr_size, "Copying image file", 'mb')
+
+        with self.raw_device() as raw:
+            with open(raw, 'rb') as src:
+                with open(outfile, "wb") as dst:
+                    progressbar.next()
+                    done = blockio.fast_copy(
+                        src.fileno(), dst.fileno(), self.size,
+                        lambda done: progressbar.goto(done // MB))
+
+        if done < self.size:
+            progressbar.success('not supported by the file system')
+            return None
+
+        progressbar.success('image file %s was successfully created' % outfile)
+        return self.file_md5(outfile)
+
+    def _sendfile(self, outfile):
+        """Dumps the image using sendfile. The data never reaches the user
+        space.
+
+        If the media is a regular file, the output file shares its extents
+        (reflink) or is copied by the kernel using copy_file_range, where the
+        file system supports it. sendfile only copies what is left.
         """
         MB = 2 ** 20
         blocksize = 2 ** 22  # 4MB
@@ -584,9 +952,11 @@ class Image(object):
         with self.raw_device() as raw:
             with open(raw, 'rb') as src:
                 with open(outfile, "wb") as dst:
-                    left = self.size
-                    offset = 0
                     progressbar.next()
+                    offset = blockio.fast_copy(
+                        src.fileno(), dst.fileno(), self.size,
+                        lambda done: progressbar.goto(done // MB))
+                    left = self.size - offset
                     while left > 0:
                         length = min(left, blocksize)
                         sent = sendfile(dst.fileno(), src.fileno(), offset,
@@ -605,29 +975,156 @@ class Image(object):
 
         progressbar.success('image file %s was successfully created' % outfile)
 
-    def md5(self):
-        """Computes the MD5 checksum of the image"""
+    def md5(self, hashmap=None, pipeline=False):
+        """Computes the MD5 checksum of the image. Holes of the media are
+        not read.
+
+        If hashmap is defined, the block hashes of the image are computed
+        in the same pass. If pipeline is True, the checksums are computed on
+        separate threads while the image is being read.
+        """
 
-        MB = 2 ** 20
-        blocksize = 2 ** 22  # 4MB
-        progr_size = ((self.size + MB - 1) // MB)  # in MB
-        progressbar = self.out.Progress(progr_size, "Calculating md5sum", 'mb')
         md5 = hashlib.md5()
+        if hashmap is None:
+            progressbar = self._copy("Calculating md5sum", None, [md5],
+                                     pipeline=pipeline)
+        else:
+            progressbar = self._copy("Calculating md5sum and block hashes",
+                                     None, [md5, hashmap], pipeline=pipeline)
+            hashmap.finish()
+        checksum = md5.hexdigest()
+        progressbar.success(checksum)
 
-        with self.raw_device() as raw:
-            with open(raw, "rb") as src:
-                left = self.size
-                while left > 0:
-                    length = min(left, blocksize)
-                    data = src.read(length)
-                    md5.update(data)
-                    left -= length
-                    progressbar.goto((self.size - left) // MB)
+        return checksum
+
+    def file_md5(self, path):
+        """Computes the MD5 checksum of a file created by dump(). This is
+        needed when the file does not contain the raw image data, like when
+        it is compressed.
+        """
+        MB = 2 ** 20
+        size = os.path.getsize(path)
+        progr_size = ((size + MB - 1) // MB)  # in MB
+        progressbar = self.out.Progress(progr_size,
+                                        "Calculating md5sum of %s" % path,
+                                        'mb')
+        zeros = blockio.Zeros(self.io_params.blocksize)
+        md5 = hashlib.md5()
+        done = 0
+        reader = blockio.BlockReader(path, size, self.io_params)
+        for length, data in reader.blocks():
+            if data is None:
+                for chunk in zeros.chunks(length):
+                    md5.update(chunk)
+            else:
+                md5.update(data)
+            done += length
+            progressbar.goto(done // MB)
 
         checksum = md5.hexdigest()
         progressbar.success(checksum)
 
         return checksum
 
+    def block_hashes(self, blocksize=BLOCKSIZE, blockhash=BLOCKHASH,
+                     workers=None):
+        """Computes the Pithos+ hashmap of the image using a pool of workers
+        that hash disjoint parts of the device in parallel.
+        """
+        MB = 2 ** 20
+        progr_size = ((self.size + MB - 1) // MB)  # in MB
+        progressbar = self.out.Progress(progr_size, "Calculating block hashes",
+                                        'mb')
+
+        with self.raw_device() as raw:
+            hashmap = Hashmap.from_file(
+                raw, self.size, blocksize, blockhash, workers,
+                lambda done: progressbar.goto(done // MB))
+
+        progressbar.success('done')
+        return hashmap
+
+    def _copy(self, title, dst, digests, sparse=False, used_only=False,
+              bmap=None, pipeline=False):
+        """Read the payload of the image once and feed every block to all the
+        digests. If dst is not None, the blocks are also written to it.
+
+        Holes of the source are never read. The digests are fed with zeros
+        instead. If sparse is True, holes and zero blocks are not written to
+        dst either. If used_only is True, the unallocated blocks of the ext
+        file systems are treated as holes. If bmap is defined, it is fed with
+        the parts of the image that are written and the ones that are not.
+
+        If pipeline is True, each digest, the bmap and dst are fed from their
+        own thread, through a bounded queue, while the next blocks are read.
+
+        The progress bar is returned for the caller to print the result.
+        """
+        MB = 2 ** 20
+        progr_size = ((self.size + MB - 1) // MB)  # in MB
+        progressbar = self.out.Progress(progr_size, title, 'mb')
+        zeros = blockio.Zeros(self.io_params.blocksize)
+
+        def feeder(digest):
+            """Returns a stage that feeds a digest"""
+            def feed(length, data, _):
+                """Feed a block or a hole to the digest"""
+                if data is None:
+                    for chunk in zeros.chunks(length):
+                        digest.update(chunk)
+                else:
+                    digest.update(data)
+            return feed
+
+        def update_bmap(length, data, skip):
+            """Record a block or a hole in the bmap"""
+            if data is None:
+                bmap.skip(length)
+            else:
+                bmap.update(data, not skip)
+
+        def write(length, data, skip):
+            """Write a block or a hole to dst"""
+            if sparse and skip:
+                dst.seek(length, os.SEEK_CUR)
+            elif data is None:
+                for chunk in zeros.chunks(length):
+                    dst.write(chunk)
+            else:
+                dst.write(data)
+
+        stages = [feeder(digest) for digest in digests]
+        if bmap is not None:
+            stages.append(update_bmap)
+        if dst is not None:
+            stages.append(write)
+
+        with self.raw_device() as raw:
+            ranges = self.used_ranges(raw) if used_only else None
+            reader = blockio.BlockReader(raw, self.size, self.io_params)
+            pipe = Pipeline(stages) if pipeline else None
+            try:
+                done = 0
+                for length, data in reader.blocks(ranges):
+                    skip = data is None or (sparse and zeros.match(data))
+                    if pipe is not None:
+                        # The buffers of the reader are reused
+                        pipe.put(length, None if data is None else str(data),
+                                 skip)
+                    else:
+                        for stage in stages:
+                            stage(length, data, skip)
+
+                    done += length
+                    progressbar.goto(done // MB)
+            finally:
+                if pipe is not None:
+                    pipe.close()
+
+            # If the image ends with a hole, the file needs to be extended
+            if dst is not None and sparse:
+                dst.truncate(self.size)
+
+        return progressbar
 
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -20,8 +20,13 @@ The library is used to upload images to and register them with a Synnefo
 deployment.
 """
 
+import os
 import sys
+import time
 import logging
+from functools import wraps
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from os.path import basename
 
@@ -31,6 +36,10 @@ from kamaki.clients.image import ImageClient
 from kamaki.clients.pithos import PithosClient
 from kamaki.clients.astakos import CachedAstakosClient as AstakosClient
 
+from image_creator.hashmap import Hashmap
+from image_creator.uploader import BlockUploader, DEFAULT_WORKERS
+from image_creator.session import SessionCache
+
 try:
     from kamaki.clients.utils import https
     https.patch_ignore_ssl()
@@ -47,6 +56,38 @@ except Exception as e:
 
 CONTAINER = "images"
 
+# Maximum number of concurrent object existence checks
+CHECK_WORKERS = 4
+
+# Number of blocks a pipelined upload asks the storage service about at once
+QUERY_BATCH = 8
+
+# Maximum number of concurrent queries of a pipelined upload
+QUERY_WORKERS = 2
+
+# The object the missing blocks are queried with. It is never created.
+QUERY_PATH = '.snf-image-creator-query'
+
+
+def refresh_stale_session(func):
+    """Decorator for the Kamaki methods that perform requests. If a request
+    is rejected as unauthorized while the account information comes from the
+    session cache, the token may have been revoked since it was cached. The
+    session is then refreshed, which authenticates again, and the method is
+    called once more.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        """Call the method and retry it with a fresh session"""
+        try:
+            return func(self, *args, **kwargs)
+        except ClientError as e:
+            if e.status != 401 or not self.cached_session:
+                raise
+        self.refresh_session()
+        return func(self, *args, **kwargs)
+    return wrapper
+
 
 class Kamaki(object):
     """Wrapper class for the ./kamaki library"""
@@ -103,9 +144,14 @@ class Kamaki(object):
     @staticmethod
     def create_account(url, token):
         """Given a valid (URL, tokens) pair this method returns an Astakos
-        client instance
+        client instance. The pair is not checked again if it is found in the
+        session cache. It is checked when a request made with it is rejected
+        (see refresh_stale_session()).
         """
         client = AstakosClient(url, token)
+        if SessionCache(url, token).valid:
+            return client
+
         try:
             client.authenticate()
         except ClientError:
@@ -130,45 +176,315 @@ class Kamaki(object):
         self.account = account
         self.out = output
 
-        self.pithos = PithosClient(
-            self.account.get_service_endpoints('object-store')['publicURL'],
-            self.account.token,
-            self.account.user_info()['id'],
-            CONTAINER)
+        self.session = SessionCache(self.account.base_url, self.account.token)
+        # True if the account information was not checked in this run
+        self.cached_session = self.session.valid
+        self._connect()
+
+    def _connect(self):
+        """Create the service clients. The account information is fetched
+        unless it is cached.
+        """
+        if not self.session.valid:
+            endpoints = {}
+            for service in ('object-store', 'image'):
+                endpoints[service] = self.account.get_service_endpoints(
+                    service)['publicURL']
+            self.session.update(self.account.user_info()['id'], endpoints)
+        self.user_id = self.session.user_id
+
+        self.pithos = PithosClient(self.session.endpoints['object-store'],
+                                   self.account.token, self.user_id,
+                                   CONTAINER)
+
+        self.image = ImageClient(self.session.endpoints['image'],
+                                 self.account.token)
+
+    def refresh_session(self):
+        """Drop the cached account information, authenticate again and
+        recreate the service clients
+        """
+        self.cached_session = False
+        self.session.invalidate()
+        self.account.authenticate()
+        self._connect()
+
+    def storage_account(self):
+        """Returns a string that identifies the storage service account"""
+        return "%s/%s" % (self.pithos.base_url, self.user_id)
+
+    @refresh_stale_session
+    def _create_container(self, container):
+        """Create a container if it does not exist"""
+        if container in self.session.containers:
+            return
+        try:
+            self.pithos.create_container(container)
+        except ClientError as e:
+            if e.status != 202:  # Ignore container already exists errors
+                raise e
+        self.session.add_container(container)
+
+    @refresh_stale_session
+    def new_hashmap(self, container=None, workers=1):
+        """Returns an empty Hashmap instance that follows the block size and
+        the hash algorithm of a container.
+        """
+        if container is None:
+            container = CONTAINER
+
+        self._create_container(container)
+        try:
+            self.pithos.container = container
+            try:
+                info = self.pithos.get_container_info()
+            except ClientError as e:
+                if e.status != 404:
+                    raise
+                # The container was removed since it was cached
+                self.session.remove_container(container)
+                self._create_container(container)
+                info = self.pithos.get_container_info()
+        finally:
+            self.pithos.container = CONTAINER
+
+        return Hashmap(int(info['x-container-block-size']),
+                       info['x-container-block-hash'], workers)
 
-        self.image = ImageClient(
-            self.account.get_service_endpoints('image')['publicURL'],
-            self.account.token)
+    def _new_pithos_client(self, container):
+        """Returns a new Pithos+ client with its own HTTP connection"""
+        return PithosClient(self.pithos.base_url, self.pithos.token,
+                            self.pithos.account, container)
 
     def upload(self, file_obj, size=None, remote_path=None, container=None,
-               content_type=None, hp=None, up=None):
-        """Upload a file to Pithos+"""
+               content_type=None, hp=None, up=None, hashmap=None,
+               workers=DEFAULT_WORKERS, manifest=None, base=None):
+        """Upload a file to Pithos+
+
+        If hashmap is defined, it should hold the precomputed block hashes of
+        the file (see new_hashmap()) and the hashing phase is skipped. The
+        missing blocks are then uploaded over up to workers connections. If
+        manifest is also defined, the uploaded blocks are recorded there, so
+        that an interrupted upload can be resumed. If base is defined, it
+        should be the hashmap of a previous version of the file (see
+        get_hashmap()) and only the blocks that differ from it are sent.
+        """
 
         path = basename(file_obj.name) if remote_path is None else remote_path
 
         if container is None:
             container = CONTAINER
 
+        self._create_container(container)
+
+        def upload():
+            """Upload the file to the container"""
+            hash_cb = self.out.progress_generator(hp) if hp is not None \
+                else None
+            upload_cb = self.out.progress_generator(up) if up is not None \
+                else None
+            try:
+                self.pithos.container = container
+                if hashmap is not None:
+                    assert size is None or size == hashmap.size, \
+                        "The hashmap does not match the file size"
+                    self._upload_hashmap(path, file_obj, hashmap, up,
+                                         content_type, workers, manifest,
+                                         base)
+                else:
+                    self.pithos.upload_object(path, file_obj, size=size,
+                                              hash_cb=hash_cb,
+                                              upload_cb=upload_cb,
+                                              content_type=content_type)
+            finally:
+                self.pithos.container = CONTAINER
+
+        start = file_obj.tell()
         try:
-            self.pithos.create_container(container)
+            upload()
         except ClientError as e:
-            if e.status != 202:  # Ignore container already exists errors
-                raise e
-
-        hash_cb = self.out.progress_generator(hp) if hp is not None else None
-        upload_cb = self.out.progress_generator(up) if up is not None else None
+            if e.status == 401 and self.cached_session:
+                self.refresh_session()
+            elif e.status == 404 and container in self.session.containers:
+                # The container was removed since it was cached
+                self.session.remove_container(container)
+                self._create_container(container)
+            else:
+                raise
+            file_obj.seek(start)
+            upload()
+
+        return "pithos://%s/%s/%s" % (self.user_id, container, path)
+
+    def _upload_hashmap(self, path, file_obj, hashmap, title=None,
+                        content_type=None, workers=DEFAULT_WORKERS,
+                        manifest=None, base=None):
+        """Upload a file whose hashmap is already known. Only the blocks that
+        are missing from the storage service are sent, over multiple
+        connections. If title is defined, a progress bar with this title is
+        shown, followed by the amount of data sent and the throughput.
+
+        If base is defined, it should be the hashmap of a previous version of
+        the file. The blocks of the file that are not part of it are sent
+        without asking the storage service first.
+        """
+        content_type = content_type or 'application/octet-stream'
+        json = {'bytes': hashmap.size, 'hashes': hashmap.hashes}
+
+        if base is not None and (base.blocksize, base.blockhash) != \
+                (hashmap.blocksize, hashmap.blockhash):
+            self.out.warn("The base object uses different blocks. Ignoring "
+                          "it")
+            base = None
+
+        if base is not None:
+            known = set(base.hashes)
+            if manifest is not None:
+                known.update(manifest.confirmed)
+            missing = [h for h in hashmap.hashes if h not in known]
+        else:
+            r = self.pithos.object_put(path, format='json', hashmap=True,
+                                       content_type=content_type, json=json,
+                                       success=(201, 409))
+            if r.status_code == 201:
+                if title is not None:
+                    self.out.info("%s ..." % title, False)
+                    self.out.success('done (all blocks exist)')
+                if manifest is not None:
+                    manifest.remove()
+                return 0
+
+            missing = r.json
+            if manifest is not None and manifest.confirmed:
+                # The storage service is the authority on what is missing
+                resumed = manifest.confirmed.difference(missing)
+                self.out.info("Resuming the upload: %d blocks were already "
+                              "sent" % len(resumed))
+
+        sent = self._upload_blocks(file_obj, hashmap, missing, title, workers,
+                                   manifest)
+
+        r = self.pithos.object_put(path, format='json', hashmap=True,
+                                   content_type=content_type, json=json,
+                                   success=(201, 409))
+        if r.status_code == 409:
+            # Blocks of the base object that the storage service lacks
+            sent += self._upload_blocks(file_obj, hashmap, r.json, None,
+                                        workers, manifest)
+            self.pithos.object_put(path, format='json', hashmap=True,
+                                   content_type=content_type, json=json,
+                                   success=201)
+
+        if manifest is not None:
+            manifest.remove()
+        return sent
+
+    def _upload_blocks(self, file_obj, hashmap, missing, title=None,
+                       workers=DEFAULT_WORKERS, manifest=None):
+        """Upload the blocks of a file whose hashes are listed in missing.
+        Returns the number of bytes sent.
+        """
+        MB = 2 ** 20
+        index = dict((h, i) for i, h in enumerate(hashmap.hashes))
+        total = sum(hashmap.block_range(index[h])[1] for h in set(missing))
+
+        progressbar = None
+        if title is not None:
+            progressbar = self.out.Progress(max(1, (total + MB - 1) // MB),
+                                            title, 'mb')
+            progressbar.goto(0)
+
+        def progress(done):
+            """Update the progress bar"""
+            if progressbar is not None:
+                progressbar.goto(done // MB)
+
+        container = self.pithos.container
+        uploader = BlockUploader(lambda: self._new_pithos_client(container),
+                                 workers)
+        start = time.time()
+        sent = uploader.upload(file_obj, hashmap, missing, progress,
+                               manifest)
+        elapsed = max(time.time() - start, 0.001)
+
+        if progressbar is not None:
+            progressbar.success('done (%d of %d MB sent at %.1f MB/s)' %
+                                (sent // MB, (hashmap.size + MB - 1) // MB,
+                                 float(sent) / MB / elapsed))
+        return sent
+
+    def pipelined_upload(self, container=None, workers=DEFAULT_WORKERS,
+                         base=None):
+        """Returns a PipelinedUpload instance for uploading the blocks of an
+        image to a container while the image is being read.
+        """
+        if container is None:
+            container = CONTAINER
+        known = base.hashes if base is not None else ()
+        return PipelinedUpload(
+            BlockUploader(lambda: self._new_pithos_client(container),
+                          workers), known,
+            lambda hashes, size: self.missing_blocks(container, hashes, size))
+
+    def missing_blocks(self, container, hashes, size):
+        """Returns the hashes of the blocks that a container lacks. size is
+        the total size of the blocks.
+
+        The storage service is sent the hashmap of an object made of the
+        blocks and of one more block that does not exist, so the object is
+        never created and the missing blocks are listed in the reply. A new
+        client is used, which makes this safe to call from any thread.
+        """
+        sentinel = os.urandom(len(hashes[0]) // 2).encode('hex')
+        json = {'bytes': size + 1, 'hashes': list(hashes) + [sentinel]}
+        client = self._new_pithos_client(container)
+        r = client.object_put(QUERY_PATH, format='json', hashmap=True,
+                              json=json, success=(409,))
+        return [str(h) for h in r.json if h != sentinel]
+
+    @refresh_stale_session
+    def get_hashmap(self, location):
+        """Returns the hashmap of a remote object. The location may be a
+        pithos:// URL, a container/path pair or a path in the default
+        container.
+        """
+        own_account = self.pithos.account
+        account = own_account
+        container = CONTAINER
+        path = location
+        if location.startswith('pithos://'):
+            account, container, path = location[len('pithos://'):].split(
+                '/', 2)
+        elif '/' in location:
+            container, path = location.split('/', 1)
 
         try:
+            self.pithos.account = account
             self.pithos.container = container
-            self.pithos.upload_object(path, file_obj, size=size,
-                                      hash_cb=hash_cb, upload_cb=upload_cb,
-                                      content_type=content_type)
+            info = self.pithos.get_object_hashmap(path)
         finally:
+            self.pithos.account = own_account
             self.pithos.container = CONTAINER
 
-        return "pithos://%s/%s/%s" % (self.account.user_info()['id'],
-                                      container, path)
+        hashmap = Hashmap(int(info['block_size']), str(info['block_hash']))
+        hashmap.size = int(info['bytes'])
+        hashmap.hashes = [str(h) for h in info['hashes']]
+        return hashmap
 
+    def verify(self, location, hashmap):
+        """Compare the hashmap of a remote object with the block hashes of
+        the local data, without downloading anything. The location is
+        resolved like in get_hashmap(). The indices of the blocks that
+        differ are returned.
+        """
+        remote = self.get_hashmap(location)
+        mismatches = hashmap.diff(remote)
+        if remote.size != hashmap.size and not mismatches:
+            # The last block only differs in the trailing zeros
+            mismatches = [len(hashmap.hashes) - 1]
+        return mismatches
+
+    @refresh_stale_session
     def register(self, name, location, metadata, public=False):
         """Register an image with Cyclades"""
 
@@ -176,11 +492,13 @@ class Kamaki(object):
         params = {'is_public': is_public, 'disk_format': 'diskdump'}
         return self.image.register(name, location, params, metadata)
 
+    @refresh_stale_session
     def share(self, location):
         """Share this file with all the users"""
 
         self.pithos.set_object_sharing(location, "*")
 
+    @refresh_stale_session
     def object_exists(self, container, location):
         """Check if an object exists in Pithos+"""
 
@@ -197,4 +515,129 @@ class Kamaki(object):
         self.pithos.container = CONTAINER
         return True
 
+    @refresh_stale_session
+    def objects_exist(self, container, locations):
+        """Check concurrently which of the objects exist in Pithos+. The
+        existing ones are returned in the order they were given.
+        """
+        def exists(location):
+            """Check a single object using its own connection"""
+            client = self._new_pithos_client(container)
+            try:
+                client.get_object_info(location)
+            except ClientError as e:
+                if e.status == 404:  # Object not found error
+                    return False
+                raise
+            return True
+
+        locations = list(locations)
+        if len(locations) <= 1:
+            return [loc for loc in locations
+                    if self.object_exists(container, loc)]
+
+        pool = ThreadPool(min(CHECK_WORKERS, len(locations)))
+        try:
+            found = pool.map(exists, locations)
+        finally:
+            pool.close()
+            pool.join()
+        return [loc for loc, f in zip(locations, found) if f]
+
+
+class PipelinedUpload(object):
+    """Uploads the blocks of an image as soon as they are hashed.
+
+    An instance is meant to be used as the callback of the Hashmap of the
+    image (see Kamaki.pipelined_upload()). Blocks already known to exist on
+    the storage service are skipped. The rest are collected in batches and,
+    if query is defined, only the ones the storage service reports missing
+    are uploaded. query is called with the hashes and the total size of a
+    batch, on up to workers threads, so that reading the image does not wait
+    for the replies.
+
+    The object itself still needs to be created with Kamaki.upload() after
+    finish() is called, which also sends any blocks that turn out to be
+    missing. The hashes of the blocks the storage service is known to have
+    are then in confirmed, to be recorded in the UploadManifest of the
+    object.
+    """
+
+    def __init__(self, uploader, known=(), query=None, batch=QUERY_BATCH,
+                 workers=QUERY_WORKERS):
+        """Create a PipelinedUpload instance"""
+        self.uploader = uploader
+        self.known = set(known)
+        self.query = query
+        self.batch = batch
+        self.workers = workers
+        self.confirmed = set()
+        self._blocks = []
+        self._submitted = set()
+        self._pool = ThreadPool(workers) if query is not None else None
+        # Batches whose query was submitted to the pool, in order
+        self._flying = deque()
+        self.uploader.start()
+
+    def __call__(self, block_hash, block):
+        """Queue a block for uploading"""
+        if block_hash in self.known:
+            return
+        self.known.add(block_hash)
+        self._blocks.append((block_hash, block))
+        if len(self._blocks) >= self.batch:
+            self._flush()
+
+    def _flush(self):
+        """Find out which of the collected blocks the storage service lacks"""
+        blocks = self._blocks
+        self._blocks = []
+        if not blocks:
+            return
+
+        if self._pool is None:
+            self._submit(blocks, [h for h, _ in blocks])
+            return
+
+        # Upload the blocks of the answered queries and limit the number of
+        # blocks kept in memory
+        while self._flying and (self._flying[0][1].ready() or
+                                len(self._flying) >= 2 * self.workers):
+            self._collect()
+
+        self._flying.append((blocks, self._pool.apply_async(
+            self.query, ([h for h, _ in blocks],
+                         sum(len(b) for _, b in blocks)))))
+
+    def _collect(self):
+        """Wait for the reply to the oldest query"""
+        blocks, result = self._flying.popleft()
+        self._submit(blocks, result.get())
+
+    def _submit(self, blocks, missing):
+        """Upload the blocks that are missing"""
+        missing = set(missing)
+        for block_hash, block in blocks:
+            if block_hash in missing:
+                self._submitted.add(block_hash)
+                self.uploader.submit(block_hash, block)
+            else:
+                self.confirmed.add(block_hash)
+
+    def finish(self):
+        """Wait for the queued blocks to be uploaded. Returns the number of
+        bytes sent.
+        """
+        try:
+            self._flush()
+            while self._flying:
+                self._collect()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+            sent = self.uploader.finish()
+        self.confirmed.update(self._submitted)
+        return sent
+
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -34,15 +34,26 @@ import subprocess
 import time
 import re
 import locale
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from image_creator import __version__ as version
-from image_creator.disk import Disk
+from image_creator.disk import Disk, get_tmp_dir
 from image_creator.util import FatalError, static_vars, to_shell
 from image_creator.output.cli import SilentOutput, SimpleOutput, \
     OutputWthProgress
 from image_creator.output.composite import CompositeOutput
+from image_creator.output.prefixed import PrefixedOutput
 from image_creator.output.syslog import SyslogOutput
 from image_creator.kamaki_wrapper import Kamaki, ClientError, CONTAINER
+from image_creator.uploader import DEFAULT_WORKERS, UploadManifest
+from image_creator.hashmap import Hashmap
+from image_creator.bmap import Bmap
+from image_creator.compress import METHODS, check_method, method_from_filename
+from image_creator import qcow2
+from image_creator.blockio import IOParams, DEFAULT_IO, ALIGNMENT
+from image_creator.image import ApplianceParams
 
 
 @static_vars(enc=locale.getdefaultlocale()[1])
@@ -106,6 +117,16 @@ class AddKeyValue(argparse.Action):
         setattr(namespace, self.dest, dest)
 
 
+def parse_size(value):
+    """Parse a size in bytes with an optional K, M or G suffix"""
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    match = re.match(r'^(\d+)([KMG]?)$', value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError("`%s' is not a valid size" % value)
+    number, unit = match.groups()
+    return int(number) * units.get(unit, 1)
+
+
 def parse_options():
     """Parse input parameters"""
     description = "Command-line tool for creating OS images"
@@ -127,14 +148,51 @@ def parse_options():
         "supported", default=False, action="store_true")
 
     parser.add_argument(
-        "-c", "--cloud", dest="cloud", default=None,
+        "--appliance-memsize", dest="appliance_memsize", type=int,
+        default=None, metavar="MB",
+        help="give MB of memory to the helper VM that manipulates the media "
+        "[default: the libguestfs default]")
+
+    parser.add_argument(
+        "--appliance-smp", dest="appliance_smp", type=int, default=None,
+        metavar="N",
+        help="give N virtual CPUs to the helper VM that manipulates the "
+        "media [default: the libguestfs default]")
+
+    parser.add_argument(
+        "--base-object", dest="base_object", default=None, metavar="LOCATION",
+        help="upload only the blocks of the image that differ from the "
+        "previously uploaded object at LOCATION. LOCATION may be a pithos:// "
+        "URL, a CONTAINER/PATH pair or a PATH in the upload container")
+
+    parser.add_argument(
+        "--bmap", dest="bmap", default=False, action="store_true",
+        help="also dump a block map of the image to FILE.bmap, that lists "
+        "the ranges of the image that contain data, for use with bmaptool")
+
+    parser.add_argument(
+        "-c", "--cloud", dest="cloud", default=[], action="append",
         help="use this saved cloud account to authenticate against a cloud "
-             "when uploading/registering images")
+             "when uploading/registering images. This option may be defined "
+             "multiple times to upload the image to several clouds from a "
+             "single read of the input media")
+
+    parser.add_argument(
+        "--compress", dest="compress", default=None,
+        choices=sorted(METHODS.keys() + [qcow2.COMPRESSION]),
+        help="compress the dumped image file using METHOD. This is implied if "
+        "FILE ends in .gz, .xz or .zst. QCOW2 image files may only be "
+        "compressed using %s" % qcow2.COMPRESSION, metavar="METHOD")
 
     parser.add_argument(
         "--container", dest="container", default=CONTAINER,
         help="Upload files to CONTAINER [default: %s]" % CONTAINER)
 
+    parser.add_argument(
+        "--direct-io", dest="direct_io", default=False, action="store_true",
+        help="read the input media bypassing the page cache of the host "
+        "(O_DIRECT)")
+
     parser.add_argument(
         "--disable-sysprep", dest="disabled_syspreps",
         help="prevent SYSPREP operation from running on the input media",
@@ -149,6 +207,16 @@ def parse_options():
         "-f", "--force", dest="force", default=False, action="store_true",
         help="overwrite output files if they exist")
 
+    parser.add_argument(
+        "--format", dest="format", default=None, choices=['raw', 'qcow2'],
+        help="dump the image file in FORMAT. This is implied to be qcow2 if "
+        "FILE ends in .qcow2 [default: raw]", metavar="FORMAT")
+
+    parser.add_argument(
+        "--hashmap", dest="hashmap", default=False, action="store_true",
+        help="also dump the block hashmap of the image to FILE.hashmap, so "
+        "that it can be reused by later uploads and verifications")
+
     parser.add_argument(
         "--host-run", dest="host_run", default=[],
         help="mount the media in the host and run a script against the guest "
@@ -162,10 +230,22 @@ def parse_options():
         "--install-virtio", dest="virtio", metavar="DIR",
         help="install VirtIO drivers hosted under DIR (Windows only)")
 
+    parser.add_argument(
+        "--io-block-size", dest="io_block_size", type=parse_size,
+        default=DEFAULT_IO.blocksize, metavar="SIZE",
+        help="read the input media in blocks of SIZE bytes. K, M and G "
+        "suffixes are accepted [default: %dM]" % (DEFAULT_IO.blocksize >> 20))
+
     parser.add_argument(
         "-m", "--metadata", dest="metadata", default={}, action=AddKeyValue,
         help="add custom KEY=VALUE metadata to the image", metavar="KEY=VALUE")
 
+    parser.add_argument(
+        "--no-page-cache", dest="nocache", default=False, action="store_true",
+        help="drop the image data from the page cache of the host as soon as "
+        "it is processed, so that the cache of other processes is not "
+        "evicted")
+
     parser.add_argument(
         "--no-snapshot", dest="snapshot", default=True,
         help="don't snapshot the input media. (THIS IS DANGEROUS AS IT WILL "
@@ -179,6 +259,12 @@ def parse_options():
                         action=CheckWritableDir, metavar="FILE",
                         help="dump image to FILE")
 
+    parser.add_argument(
+        "--pipeline", dest="pipeline", default=False, action="store_true",
+        help="overlap reading the media with writing the image file, "
+        "computing the checksums and uploading the image, using separate "
+        "threads and bounded queues")
+
     parser.add_argument("--print-metadata", dest="print_metadata",
                         action='store_true', default=False,
                         help="print the detected image metadata")
@@ -204,6 +290,11 @@ def parse_options():
     parser.add_argument("-s", "--silent", dest="silent", default=False,
                         help="output only errors", action="store_true")
 
+    parser.add_argument("--sparse", dest="sparse", default=False,
+                        help="leave holes in the output file where the image "
+                        "contains unallocated or zero-filled blocks",
+                        action="store_true")
+
     parser.add_argument('--syslog', dest="syslog", default=False,
                         help="log to syslog", action="store_true")
 
@@ -218,10 +309,30 @@ def parse_options():
     parser.add_argument("--tmpdir", dest="tmp", default=None, metavar="DIR",
                         help="create large temporary image files under DIR")
 
+    parser.add_argument(
+        "--used-blocks-only", dest="used_only", default=False,
+        help="only dump the blocks that are allocated by the ext[234] file "
+        "systems of the image. Unallocated blocks are dumped as zeros",
+        action="store_true")
+
     parser.add_argument(
         "-u", "--upload", dest="upload", default=None, metavar="FILENAME",
         help="upload the image to the cloud with name FILENAME")
 
+    parser.add_argument(
+        "--upload-workers", dest="upload_workers", type=int,
+        default=DEFAULT_WORKERS, metavar="N",
+        help="upload the image over up to N concurrent connections. The "
+        "number of connections in use adapts to the observed latency and "
+        "errors [default: %d]" % DEFAULT_WORKERS)
+
+    parser.add_argument(
+        "--verify", dest="verify", default=None, nargs='?', const='',
+        metavar="HASHMAP",
+        help="after uploading, compare the hashmap of the remote image with "
+        "the block hashes computed while reading it, or with the ones of a "
+        "HASHMAP file dumped with --hashmap. Nothing is downloaded")
+
     options = parser.parse_args()
 
     if not os.path.exists(options.source):
@@ -230,26 +341,101 @@ def parse_options():
     if options.register and not options.upload:
         parser.error("You also need to set -u when -r option is set")
 
+    if options.base_object and not options.upload:
+        parser.error("You also need to set -u when --base-object is set")
+
+    if options.verify is not None:
+        if not options.upload:
+            parser.error("You also need to set -u when --verify is set")
+        if options.verify and not os.path.isfile(options.verify):
+            parser.error("Hashmap file `%s' does not exist" % options.verify)
+
     if options.upload and (options.token is None or options.url is None) and \
-            options.cloud is None:
+            not options.cloud:
 
         parser.error("Image uploading cannot be performed. You need to either "
                      "specify an authentication URL and token pair or an "
                      "available cloud name.")
 
+    if options.used_only and options.outfile is None:
+        parser.error("You also need to set -o when --used-blocks-only is set")
+
+    if options.format is None:
+        qcow2_ext = options.outfile is not None and \
+            options.outfile.endswith('.qcow2')
+        options.format = 'qcow2' if qcow2_ext else 'raw'
+
+    if options.format == 'qcow2':
+        if options.outfile is None:
+            parser.error("You also need to set -o when --format is set")
+        if options.compress not in (None, qcow2.COMPRESSION):
+            parser.error("QCOW2 image files may only be compressed using %s"
+                         % qcow2.COMPRESSION)
+        if options.used_only and options.upload:
+            parser.error("--used-blocks-only cannot be combined with "
+                         "the qcow2 format when uploading")
+    elif options.compress == qcow2.COMPRESSION:
+        parser.error("Compression method `%s' is only supported for qcow2 "
+                     "image files" % qcow2.COMPRESSION)
+    elif options.compress is None and options.outfile is not None:
+        options.compress = method_from_filename(options.outfile)
+
+    if options.compress is not None and options.format == 'raw':
+        if options.outfile is None:
+            parser.error("You also need to set -o when --compress is set")
+        if options.sparse:
+            parser.error("Compressed image files cannot be sparse")
+        if options.used_only and options.upload:
+            parser.error("--used-blocks-only cannot be combined with "
+                         "compression when uploading")
+        try:
+            check_method(options.compress)
+        except FatalError as e:
+            parser.error(str(e))
+
+    if options.hashmap and options.outfile is None:
+        parser.error("You also need to set -o when --hashmap is set")
+
+    if options.bmap:
+        if options.outfile is None:
+            parser.error("You also need to set -o when --bmap is set")
+        if options.format == 'qcow2':
+            parser.error("A bmap file cannot be created for qcow2 images")
+
+    if options.upload_workers < 1:
+        parser.error("The number of upload workers must be positive")
+
+    if options.appliance_memsize is not None and \
+            options.appliance_memsize < 128:
+        parser.error("The helper VM needs at least 128 MB of memory")
+
+    if options.appliance_smp is not None and options.appliance_smp < 1:
+        parser.error("The number of helper VM CPUs must be positive")
+
+    if options.io_block_size <= 0 or options.io_block_size % ALIGNMENT:
+        parser.error("The I/O block size must be a positive multiple of %d"
+                     % ALIGNMENT)
+
     if options.tmp is not None and not os.path.isdir(options.tmp):
         parser.error("The directory `%s' specified with --tmpdir is not valid"
                      % options.tmp)
 
     # Convert input attributes to unicode
-    for opt in ('url', 'cloud', 'container', 'outfile', 'register', 'token',
-                'tmp', 'upload', 'virtio'):
+    for opt in ('url', 'container', 'outfile', 'register', 'token',
+                'tmp', 'upload', 'virtio', 'base_object'):
         attr = getattr(options, opt)
         if attr:
             setattr(options, opt, attr.decode(get_encoding()))
 
     options.host_run = [h.decode(get_encoding()) for h in options.host_run]
 
+    clouds = []
+    for cloud in options.cloud:
+        cloud = cloud.decode(get_encoding())
+        if cloud not in clouds:
+            clouds.append(cloud)
+    options.cloud = clouds
+
     metadata_regexp = re.compile('^[A-Za-z0-9_]+$')
     for m in options.metadata:
         if not re.match(metadata_regexp, m):
@@ -268,7 +454,7 @@ def parse_options():
 
     if not options.force and options.outfile is not None and \
             os.path.realpath(options.outfile) != '/dev/null':
-        for extension in ('', '.meta', '.md5sum'):
+        for extension in ('', '.meta', '.md5sum', '.hashmap', '.bmap'):
             filename = "%s%s" % (options.outfile, extension)
             if os.path.exists(filename):
                 parser.error("Output file `%s' exists (use --force to "
@@ -277,14 +463,176 @@ def parse_options():
     return options
 
 
-def image_creator(options, out):
-    """snf-mkimage main function"""
+def verify_upload(kamaki, options, hashmap, out):
+    """Compare the hashmap of the uploaded image with the local one"""
+    if options.verify:
+        try:
+            hashmap = Hashmap.load(options.verify)
+        except (IOError, ValueError, KeyError) as e:
+            raise FatalError("Unable to load hashmap file `%s': %s" %
+                             (options.verify, e))
 
-    if os.geteuid() != 0:
-        raise FatalError("You must run %s as root"
-                         % os.path.basename(sys.argv[0]))
+    out.info("       Verifying the uploaded image ...", False)
+    try:
+        mismatches = kamaki.verify("%s/%s" % (options.container,
+                                              options.upload), hashmap)
+    except ValueError as e:
+        raise FatalError("Unable to verify the uploaded image: %s" % e)
+
+    if mismatches:
+        blocks = ", ".join("%d (offset %d)" % (i, i * hashmap.blocksize)
+                           for i in mismatches[:10])
+        if len(mismatches) > 10:
+            blocks += ", ..."
+        raise FatalError("The uploaded image differs from the local one in "
+                         "%d blocks: %s" % (len(mismatches), blocks))
+    out.success('done (%d blocks match)' % len(hashmap.hashes))
+
+
+def publish(kamaki, options, source, size, checksum, hashmap, base, meta,
+            out, confirmed=()):
+    """Upload the image and its md5sum file to a cloud and register the
+    image if asked to. If hashmap is None, the blocks of the image are hashed
+    again using the layout of the cloud. confirmed holds the hashes of blocks
+    that are known to be stored already, like the ones of a pipelined upload.
+    Returns a dictionary with the location of the image and the registration
+    result.
+    """
+    outcome = {}
+    try:
+        if hashmap is None:
+            layout = kamaki.new_hashmap(options.container)
+            out.info("Hashing the image for the storage service ...", False)
+            hashmap = Hashmap.from_file(source, size, layout.blocksize,
+                                        layout.blockhash)
+            out.success('done')
+
+        out.info("Uploading image to the storage service:")
+        # Record the uploaded blocks outside the temporary directory of this
+        # run, so that a failed upload can be resumed.
+        manifest = UploadManifest(get_tmp_dir(options.tmp), checksum,
+                                  options.container, options.upload,
+                                  kamaki.storage_account())
+        if confirmed:
+            manifest.confirmed.update(confirmed)
+            manifest.save()
+        with open(source, 'rb') as f:
+            remote = kamaki.upload(
+                f, size, options.upload, options.container, None, None,
+                "(1/2)  Uploading missing blocks", hashmap=hashmap,
+                workers=options.upload_workers, manifest=manifest, base=base)
+        outcome['location'] = remote
+
+        if options.verify is not None:
+            verify_upload(kamaki, options, hashmap, out)
+
+        out.info("(2/2)  Uploading md5sum file ...", False)
+        md5sumstr = '%s %s\n' % (checksum, os.path.basename(options.upload))
+        kamaki.upload(StringIO.StringIO(md5sumstr), size=len(md5sumstr),
+                      remote_path="%s.%s" % (options.upload, 'md5sum'),
+                      container=options.container, content_type="text/plain")
+        out.success('done')
+        out.info()
 
-    # Check if the authentication info is valid. The earlier the better
+        if options.register:
+            img_type = 'public' if options.public else 'private'
+            out.info('Registering %s image with the compute service ...'
+                     % img_type, False)
+            result = kamaki.register(options.register, remote, meta,
+                                     options.public)
+            out.success('done')
+            out.info("Uploading metadata file ...", False)
+            metastring = unicode(json.dumps(result, ensure_ascii=False,
+                                            indent=4))
+            kamaki.upload(StringIO.StringIO(metastring.encode('utf8')),
+                          size=len(metastring),
+                          remote_path="%s.%s" % (options.upload, 'meta'),
+                          container=options.container,
+                          content_type="application/json")
+            out.success('done')
+            if options.public:
+                out.info("Sharing md5sum file ...", False)
+                kamaki.share("%s.md5sum" % options.upload)
+                out.success('done')
+                out.info("Sharing metadata file ...", False)
+                kamaki.share("%s.meta" % options.upload)
+                out.success('done')
+            outcome['registered'] = result
+    except ClientError as e:
+        raise FatalError("Service client: %d %s" % (e.status, e.message))
+
+    return outcome
+
+
+def publish_all(clouds, options, source, size, checksum, hashmaps, bases,
+                meta, out, confirmed):
+    """Upload the image to several clouds concurrently. The messages about
+    each cloud are prefixed with its name. Returns a dictionary with the
+    outcome of each cloud.
+    """
+    lock = threading.Lock()
+
+    def run(name, kamaki):
+        """Publish the image to a single cloud"""
+        cloud_out = PrefixedOutput(out, cloud_prefix(clouds, name), lock)
+        kamaki.out = cloud_out
+        try:
+            return publish(kamaki, options, source, size, checksum,
+                           hashmaps[name], bases[name], meta, cloud_out,
+                           confirmed[name])
+        except FatalError as e:
+            return {'error': str(e)}
+
+    out.info("Uploading image to %d clouds:" % len(clouds))
+    pool = ThreadPool(len(clouds))
+    try:
+        results = [pool.apply_async(run, cloud) for cloud in clouds]
+        # Waiting with a timeout lets signals reach the main thread
+        outcomes = [r.get(2 ** 31) for r in results]
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [name for (name, _), o in zip(clouds, outcomes) if 'error' in o]
+    out.info()
+    out.info("Uploading image to %d clouds ..." % len(clouds), False)
+    if failed:
+        out.warn("failed for %d of them" % len(failed))
+    else:
+        out.success('done')
+
+    for (name, _), outcome in zip(clouds, outcomes):
+        if 'error' in outcome:
+            out.warn("%s: %s" % (name, outcome['error']))
+        else:
+            out.info("%s: %s" % (name, outcome['location']))
+    out.info()
+
+    return dict((name, o) for (name, _), o in zip(clouds, outcomes))
+
+
+def fan_out(callbacks):
+    """Returns a function that calls each of the callbacks in turn"""
+    def callback(*args):
+        """Call all the callbacks with the same arguments"""
+        for func in callbacks:
+            func(*args)
+    return callback
+
+
+def cloud_prefix(clouds, name):
+    """Returns the prefix of the messages about a cloud. The messages are
+    only prefixed with the name of the cloud if there are many.
+    """
+    return "%s: " % name if len(clouds) > 1 else ""
+
+
+def connect_clouds(options, out):
+    """Authenticate against the clouds and check that the image can be
+    uploaded. Returns a list of (name, Kamaki instance) pairs and the
+    hashmaps of the base object in each cloud.
+    """
+    clouds = []  # (name, Kamaki instance) pairs
     if options.token is not None and options.url is not None:
         try:
             account = Kamaki.create_account(options.url, options.token)
@@ -292,39 +640,76 @@ def image_creator(options, out):
                 raise FatalError("The authentication token and/or URL you "
                                  "provided is not valid!")
             else:
-                kamaki = Kamaki(account, out)
+                clouds.append((options.url, Kamaki(account, out)))
         except ClientError as e:
             raise FatalError("Astakos client: %d %s" % (e.status, e.message))
     elif options.cloud:
         avail_clouds = Kamaki.get_clouds()
-        if options.cloud not in avail_clouds.keys():
-            raise FatalError(
-                "Cloud: `%s' does not exist.\n\nAvailable clouds:\n\n\t%s\n"
-                % (options.cloud, "\n\t".join(avail_clouds.keys())))
-        try:
-            account = Kamaki.get_account(options.cloud)
-            if account is None:
+        for cloud in options.cloud:
+            if cloud not in avail_clouds.keys():
                 raise FatalError(
-                    "Cloud: `%s' exists but is not valid!" % options.cloud)
-            else:
-                kamaki = Kamaki(account, out)
-        except ClientError as e:
-            raise FatalError("Astakos client: %d %s" % (e.status, e.message))
+                    "Cloud: `%s' does not exist.\n\nAvailable clouds:"
+                    "\n\n\t%s\n" % (cloud, "\n\t".join(avail_clouds.keys())))
+            try:
+                account = Kamaki.get_account(cloud)
+                if account is None:
+                    raise FatalError(
+                        "Cloud: `%s' exists but is not valid!" % cloud)
+                else:
+                    clouds.append((cloud, Kamaki(account, out)))
+            except ClientError as e:
+                raise FatalError("Astakos client: %d %s" %
+                                 (e.status, e.message))
+
+    def prefix(name):
+        """Returns the prefix of the messages about a cloud"""
+        return cloud_prefix(clouds, name)
+
+    if clouds and options.upload and not options.force:
+        objects = [options.upload, "%s.md5sum" % options.upload]
+        if options.register:
+            objects.append("%s.meta" % options.upload)
+
+        # The clouds are checked concurrently
+        pool = ThreadPool(len(clouds))
+        try:
+            results = [pool.apply_async(kamaki.objects_exist,
+                                        (options.container, objects))
+                       for _, kamaki in clouds]
+            # Waiting with a timeout lets signals reach the main thread
+            found = [r.get(2 ** 31) for r in results]
+        finally:
+            pool.close()
+            pool.join()
+
+        for (name, _), existing in zip(clouds, found):
+            if existing:
+                raise FatalError("%sRemote storage service object: `%s' "
+                                 "exists (use --force to overwrite it)." %
+                                 (prefix(name), existing[0]))
+
+    bases = dict((name, None) for name, _ in clouds)
+    if options.base_object:
+        for name, kamaki in clouds:
+            out.info("%sFetching the hashmap of the base object ..." %
+                     prefix(name), False)
+            try:
+                bases[name] = kamaki.get_hashmap(options.base_object)
+            except ClientError as e:
+                raise FatalError("%sBase object `%s': %d %s" %
+                                 (prefix(name), options.base_object,
+                                  e.status, e.message))
+            out.success('done')
 
-    if options.upload and not options.force:
-        if kamaki.object_exists(options.container, options.upload):
-            raise FatalError("Remote storage service object: `%s' exists "
-                             "(use --force to overwrite it)." % options.upload)
-        if kamaki.object_exists(options.container,
-                                "%s.md5sum" % options.upload):
-            raise FatalError("Remote storage service object: `%s.md5sum' "
-                             "exists (use --force to overwrite it)." %
-                             options.upload)
-
-    if options.register and not options.force:
-        if kamaki.object_exists(options.container, "%s.meta" % options.upload):
-            raise FatalError("Remote storage service object `%s.meta' exists "
-                             "(use --force to overwrite it)." % options.upload)
+    return clouds, bases
+
+
+def image_creator(options, out):
+    """snf-mkimage main function"""
+
+    if os.geteuid() != 0:
+        raise FatalError("You must run %s as root"
+                         % os.path.basename(sys.argv[0]))
 
     disk = Disk(options.source, out, options.tmp)
 
@@ -338,7 +723,20 @@ def image_creator(options, out):
         # There is no need to snapshot the media if it was created by the Disk
         # instance as a temporary object.
         device = disk.file if not options.snapshot else disk.snapshot()
-        image = disk.get_image(device, sysprep_params=options.sysprep_params)
+        io_params = IOParams(options.io_block_size, options.direct_io,
+                             options.nocache)
+        # The helper VM is launched in the background while the clouds are
+        # contacted, and the image is inspected afterwards.
+        appliance = ApplianceParams(options.appliance_memsize,
+                                    options.appliance_smp)
+        image = disk.get_image(device, inspect=False,
+                               sysprep_params=options.sysprep_params,
+                               io_params=io_params, appliance=appliance)
+
+        # Check if the authentication info is valid. The earlier the better
+        clouds, bases = connect_clouds(options, out)
+
+        image.enable()
 
         if image.is_unsupported() and not options.allow_unsupported:
             raise FatalError(
@@ -395,6 +793,7 @@ def image_creator(options, out):
             out.info()
 
         if options.outfile is None and not options.upload:
+            out.info("Calls made to the helper VM: %d" % image.g.total_calls)
             return 0
 
         if options.virtio is not None and \
@@ -436,92 +835,154 @@ def image_creator(options, out):
         if options.sysprep:
             image.os.do_sysprep()
 
-        checksum = image.md5()
+        # When dumping to a file, the checksum is computed while dumping to
+        # avoid reading the whole device twice.
+        dump = options.outfile is not None and \
+            os.path.realpath(options.outfile) != '/dev/null'
+
+        # The block hashes needed for uploading are computed in the same pass
+        # by a pool of workers. Clouds whose containers use different blocks
+        # than the first one get their hashes in a separate pass.
+        hashmap = None
+        hashmaps = {}
+        streams = []
+        if options.upload:
+            try:
+                hashmap = clouds[0][1].new_hashmap(options.container,
+                                                   cpu_count())
+                hashmaps[clouds[0][0]] = hashmap
+                for name, kamaki in clouds[1:]:
+                    layout = kamaki.new_hashmap(options.container)
+                    same = (layout.blocksize, layout.blockhash) == \
+                        (hashmap.blocksize, hashmap.blockhash)
+                    hashmaps[name] = hashmap if same else None
+            except ClientError as e:
+                raise FatalError("Service client: %d %s" %
+                                 (e.status, e.message))
+            if options.pipeline or len(clouds) > 1:
+                # Upload the blocks as soon as they are hashed. With many
+                # clouds, this also serves all of them from a single read of
+                # the media, instead of one read of the missing blocks each.
+                for name, kamaki in clouds:
+                    if hashmaps[name] is not None:
+                        streams.append((name, kamaki.pipelined_upload(
+                            options.container, options.upload_workers,
+                            bases[name])))
+                hashmap.callback = streams[0][1] if len(streams) == 1 else \
+                    fan_out([stream for _, stream in streams])
+        elif options.hashmap:
+            hashmap = Hashmap(workers=cpu_count())
+
+        bmap = Bmap(image.size) if dump and options.bmap else None
+
+        if dump:
+            checksum = image.dump(options.outfile, md5=True,
+                                  sparse=options.sparse,
+                                  used_only=options.used_only,
+                                  hashmap=hashmap,
+                                  compress=options.compress,
+                                  fmt=options.format,
+                                  bmap=bmap,
+                                  pipeline=options.pipeline)
+        else:
+            checksum = image.md5(hashmap=hashmap, pipeline=options.pipeline)
+
+        # The blocks each cloud is known to have after a pipelined upload
+        confirmed = dict((name, set()) for name, _ in clouds)
+        for name, stream in streams:
+            out.info("%sWaiting for the pipelined upload to complete ..." %
+                     cloud_prefix(clouds, name), False)
+            try:
+                sent = stream.finish()
+            except ClientError as e:
+                raise FatalError("Service client: %d %s" %
+                                 (e.status, e.message))
+            confirmed[name] = stream.confirmed
+            out.success('done (%d MB sent)' % (sent // 2 ** 20))
 
         image_meta = {}
         for k, v in image.meta.items():
             image_meta[str(k)] = str(v)
 
-        metastring = json.dumps(
-            {'properties': image_meta, 'disk-format': 'diskdump'},
-            ensure_ascii=False)
+        # The file may not hold the raw image data. Describe what is actually
+        # written.
+        compression = options.compress if options.format == 'raw' else None
+        disk_format = 'qcow2' if options.format == 'qcow2' else 'diskdump'
+        file_meta = {'properties': image_meta, 'disk-format': disk_format}
+        if compression is not None:
+            file_meta['compression'] = compression
+        metastring = json.dumps(file_meta, ensure_ascii=False)
 
         img_properties = json.dumps(image_meta, ensure_ascii=False)
 
         if options.outfile is not None:
-            if os.path.realpath(options.outfile) == '/dev/null':
+            if not dump:
                 out.warn('Not dumping file to /dev/null')
             else:
-                image.dump(options.outfile)
-
                 out.info('Dumping metadata file ...', False)
                 with open('%s.%s' % (options.outfile, 'meta'), 'w') as f:
                     f.write(metastring)
                 out.success('done')
 
+                file_checksum = checksum
+                if compression is not None or options.format != 'raw':
+                    file_checksum = image.file_md5(options.outfile)
+
                 out.info('Dumping md5sum file ...', False)
                 with open('%s.%s' % (options.outfile, 'md5sum'), 'w') as f:
-                    f.write('%s %s\n' % (checksum,
+                    f.write('%s %s\n' % (file_checksum,
                                          os.path.basename(options.outfile)))
                 out.success('done')
 
+                if options.hashmap:
+                    out.info('Dumping hashmap file ...', False)
+                    hashmap.save('%s.%s' % (options.outfile, 'hashmap'))
+                    out.success('done')
+
+                if options.bmap:
+                    out.info('Dumping bmap file ...', False)
+                    bmap.save('%s.%s' % (options.outfile, 'bmap'))
+                    out.success('done')
+
                 out.info('Dumping variant file ...', False)
                 with open('%s.%s' % (options.outfile, 'variant'), 'w') as f:
-                    f.write(to_shell(IMG_ID=options.outfile,
-                                     IMG_FORMAT="diskdump",
-                                     IMG_PROPERTIES=img_properties))
+                    variant = dict(IMG_ID=options.outfile,
+                                   IMG_FORMAT=disk_format,
+                                   IMG_PROPERTIES=img_properties)
+                    if compression is not None:
+                        variant['IMG_COMPRESSION'] = compression
+                    f.write(to_shell(**variant))
                 out.success('done')
 
         out.info()
-        try:
-            if options.upload:
-                out.info("Uploading image to the storage service:")
-                with image.raw_device() as raw:
-                    with open(raw, 'rb') as f:
-                        remote = kamaki.upload(
-                            f, image.size, options.upload, options.container,
-                            None, "(1/3)  Calculating block hashes",
-                            "(2/3)  Uploading missing blocks")
-
-                out.info("(3/3)  Uploading md5sum file ...", False)
-                md5sumstr = '%s %s\n' % (checksum,
-                                         os.path.basename(options.upload))
-                kamaki.upload(StringIO.StringIO(md5sumstr),
-                              size=len(md5sumstr),
-                              remote_path="%s.%s" % (options.upload, 'md5sum'),
-                              container=options.container,
-                              content_type="text/plain")
-                out.success('done')
-                out.info()
-
-            if options.register:
-                img_type = 'public' if options.public else 'private'
-                out.info('Registering %s image with the compute service ...'
-                         % img_type, False)
-                result = kamaki.register(options.register, remote,
-                                         image.meta, options.public)
-                out.success('done')
-                out.info("Uploading metadata file ...", False)
-                metastring = unicode(json.dumps(result, ensure_ascii=False,
-                                                indent=4))
-                kamaki.upload(StringIO.StringIO(metastring.encode('utf8')),
-                              size=len(metastring),
-                              remote_path="%s.%s" % (options.upload, 'meta'),
-                              container=options.container,
-                              content_type="application/json")
-                out.success('done')
-                if options.public:
-                    out.info("Sharing md5sum file ...", False)
-                    kamaki.share("%s.md5sum" % options.upload)
-                    out.success('done')
-                    out.info("Sharing metadata file ...", False)
-                    kamaki.share("%s.meta" % options.upload)
-                    out.success('done')
-                out.result(json.dumps(result, indent=4, ensure_ascii=False))
-                out.info()
-        except ClientError as e:
-            raise FatalError("Service client: %d %s" % (e.status, e.message))
+        if options.upload:
+            with image.raw_device() as raw:
+                # If only the used blocks were dumped, the checksum refers to
+                # the dumped file and not to the device.
+                source = options.outfile if dump and options.used_only \
+                    else raw
+                if len(clouds) == 1:
+                    name, kamaki = clouds[0]
+                    outcome = publish(kamaki, options, source, image.size,
+                                      checksum, hashmaps[name], bases[name],
+                                      image.meta, out, confirmed[name])
+                    if options.register:
+                        out.result(json.dumps(outcome['registered'], indent=4,
+                                              ensure_ascii=False))
+                        out.info()
+                else:
+                    outcomes = publish_all(clouds, options, source,
+                                           image.size, checksum, hashmaps,
+                                           bases, image.meta, out, confirmed)
+                    out.result(json.dumps(outcomes, indent=4,
+                                          ensure_ascii=False))
+                    out.info()
+                    failed = [n for n, o in outcomes.items() if 'error' in o]
+                    if failed:
+                        raise FatalError("Uploading the image failed for: %s"
+                                         % ", ".join(sorted(failed)))
 
+        out.info("Calls made to the helper VM: %d" % image.g.total_calls)
     finally:
         out.info('cleaning up ...')
         disk.cleanup()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the PrefixedOutput output class"""
+
+import threading
+
+from image_creator.output import Output
+
+
+class PrefixedOutput(Output):
+    """This class prefixes every line with a string and passes it to another
+    output instance.
+
+    Many instances, each used by a different thread, may share the same
+    output. The parts of a line are collected and the whole line is passed
+    on at once, while holding a lock shared by the instances. Progress bars
+    are not drawn, only their title and result are printed.
+    """
+
+    def __init__(self, output, prefix, lock=None):
+        """Initialize a PrefixedOutput instance"""
+        self.output = output
+        self.prefix = prefix
+        self.lock = threading.Lock() if lock is None else lock
+        self.line = []
+
+    def _flush(self):
+        """Print the unfinished line. Empty lines are dropped."""
+        text = "".join(self.line)
+        self.line = []
+        if text:
+            self.output.info(self.prefix + text)
+
+    def error(self, msg):
+        """Print an error"""
+        with self.lock:
+            self._flush()
+            self.output.error(self.prefix + msg)
+
+    def warn(self, msg):
+        """Print a warning"""
+        with self.lock:
+            self._flush()
+            self.output.warn(self.prefix + msg)
+
+    def success(self, msg):
+        """Print msg after an action is completed"""
+        with self.lock:
+            self.output.info(self.prefix + "".join(self.line), False)
+            self.line = []
+            self.output.success(msg)
+
+    def info(self, msg='', new_line=True):
+        """Print normal program output"""
+        self.line.append(msg)
+        if new_line:
+            with self.lock:
+                self._flush()
+
+    def result(self, msg=''):
+        """Print a result"""
+        with self.lock:
+            self._flush()
+            self.output.result(msg)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
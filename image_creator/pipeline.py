@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides a simple pipeline that feeds the blocks produced by
+a single reader to several consumers running concurrently.
+"""
+
+import threading
+import Queue
+
+DEPTH = 4
+
+
+class Pipeline(object):
+    """Runs each stage in its own thread.
+
+    A stage is a function that is called with each item put in the pipeline,
+    in order. Every stage has a bounded queue, so the producer blocks when
+    the slowest stage falls behind and the memory used stays capped. The
+    items are shared among the stages and must not be modified.
+    """
+
+    def __init__(self, stages, depth=DEPTH):
+        """Create a Pipeline instance and start the stage threads"""
+        self._errors = Queue.Queue()
+        self._queues = []
+        self._threads = []
+        for stage in stages:
+            queue = Queue.Queue(depth)
+            thread = threading.Thread(target=self._run, args=(stage, queue))
+            thread.daemon = True
+            self._queues.append(queue)
+            self._threads.append(thread)
+            thread.start()
+
+    def _run(self, stage, queue):
+        """Body of a stage thread"""
+        failed = False
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            if failed:
+                # Keep draining the queue, so that the producer never blocks
+                continue
+            try:
+                stage(*item)
+            except BaseException as e:
+                failed = True
+                self._errors.put(e)
+
+    def _check(self):
+        """Raise the first error of a stage, if any"""
+        try:
+            error = self._errors.get_nowait()
+        except Queue.Empty:
+            return
+        raise error
+
+    def put(self, *item):
+        """Feed all the stages with an item"""
+        self._check()
+        for queue in self._queues:
+            while True:
+                try:
+                    # A timeout lets signals reach the main thread
+                    queue.put(item, True, 1)
+                    break
+                except Queue.Full:
+                    self._check()
+
+    def close(self):
+        """Wait for all the stages to process the items fed so far and stop
+        them.
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            while thread.is_alive():
+                thread.join(1)
+        self._check()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
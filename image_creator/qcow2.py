@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the code for writing QCOW2 images in a single,
+sequential pass.
+
+The clusters are written one after the other as the data arrives. Clusters
+that only contain zeros are not allocated at all. The L2 tables, the L1 table
+and the refcount structures are written after the data, when the location of
+every cluster is known, and the header is written last.
+"""
+
+import os
+import zlib
+import struct
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS  # 64KB
+SECTOR_SIZE = 512
+
+MAGIC = 'QFI\xfb'
+VERSION = 3
+HEADER_LENGTH = 104
+REFCOUNT_ORDER = 4  # 16 bit refcounts
+
+OFLAG_COPIED = 1 << 63
+OFLAG_COMPRESSED = 1 << 62
+
+# Layout of the L2 entry of a compressed cluster
+CSIZE_SHIFT = 62 - (CLUSTER_BITS - 8)
+
+L2_ENTRIES = CLUSTER_SIZE // 8
+REFCOUNT_ENTRIES = CLUSTER_SIZE * 8 // (1 << REFCOUNT_ORDER)
+ZERO_CLUSTER = '\x00' * CLUSTER_SIZE
+
+# The name of the cluster compression method, as used by the command line
+COMPRESSION = 'zlib'
+
+
+def _process_clusters(data, compress):
+    """Split data in clusters and prepare them for writing. For each cluster
+    None is returned if it only contains zeros. Otherwise a (data, compressed)
+    tuple is returned.
+    """
+    result = []
+    for offset in xrange(0, len(data), CLUSTER_SIZE):
+        cluster = data[offset:offset + CLUSTER_SIZE]
+        if cluster == ZERO_CLUSTER[:len(cluster)]:
+            result.append(None)
+            continue
+
+        if len(cluster) < CLUSTER_SIZE:
+            cluster += ZERO_CLUSTER[len(cluster):]
+
+        if compress:
+            # QEMU expects raw deflate data with a 4KB window
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -12)
+            compressed = compressor.compress(cluster) + compressor.flush()
+            if len(compressed) < CLUSTER_SIZE - SECTOR_SIZE:
+                result.append((compressed, True))
+                continue
+
+        result.append((cluster, False))
+    return result
+
+
+def _align(value, alignment):
+    """Round value up to a multiple of alignment"""
+    return (value + alignment - 1) // alignment * alignment
+
+
+class Qcow2Writer(object):
+    """File-like object that writes the data written to it as a QCOW2 image.
+
+    Only sequential writes are supported. seek() may only be used for
+    skipping forward, which leaves the skipped clusters unallocated.
+    """
+
+    def __init__(self, fileobj, size, compress=False, workers=None):
+        """Create a Qcow2Writer instance. size is the virtual size of the
+        image.
+        """
+        self.fileobj = fileobj
+        self.size = size
+        self.compress = compress
+        self.workers = cpu_count() if workers is None else workers
+
+        # Virtual offset of the next byte that will be written
+        self._pos = 0
+        # Data of the next, partially filled cluster
+        self._buf = []
+        self._buf_size = 0
+        # Next free host offset. Cluster 0 is reserved for the header.
+        self._host = CLUSTER_SIZE
+        # Virtual cluster index -> L2 entry
+        self._l2 = {}
+        # Host cluster index -> refcount for data clusters
+        self._refcounts = {}
+
+        self._pool = ThreadPool(self.workers) if compress else None
+        self._flying = deque()
+
+        self.fileobj.seek(CLUSTER_SIZE)
+
+    def _store(self, index, clusters):
+        """Write processed clusters starting from virtual cluster index"""
+        for cluster in clusters:
+            if cluster is not None:
+                data, compressed = cluster
+                if compressed:
+                    self._store_compressed(index, data)
+                else:
+                    self._host = _align(self._host, CLUSTER_SIZE)
+                    self.fileobj.seek(self._host)
+                    self.fileobj.write(data)
+                    self._l2[index] = self._host | OFLAG_COPIED
+                    self._refcounts[self._host // CLUSTER_SIZE] = 1
+                    self._host += CLUSTER_SIZE
+            index += 1
+
+    def _store_compressed(self, index, data):
+        """Write a compressed cluster"""
+        offset = self._host
+        self.fileobj.seek(offset)
+        self.fileobj.write(data)
+        self._host += len(data)
+
+        nb_csectors = (offset + len(data) - 1) // SECTOR_SIZE - \
+            offset // SECTOR_SIZE
+        self._l2[index] = OFLAG_COMPRESSED | \
+            (nb_csectors << CSIZE_SHIFT) | offset
+
+        # The compressed data references whole sectors
+        start = offset - offset % SECTOR_SIZE
+        end = start + (nb_csectors + 1) * SECTOR_SIZE
+        for cluster in xrange(start // CLUSTER_SIZE,
+                              (end - 1) // CLUSTER_SIZE + 1):
+            self._refcounts[cluster] = self._refcounts.get(cluster, 0) + 1
+
+    def _wait(self):
+        """Store the oldest batch of clusters processed by the pool"""
+        index, result = self._flying.popleft()
+        self._store(index, result.get())
+
+    def _submit(self, data):
+        """Process and store whole clusters starting at the current
+        position.
+        """
+        index = self._pos // CLUSTER_SIZE
+        self._pos += len(data)
+
+        if self._pool is None:
+            self._store(index, _process_clusters(data, False))
+            return
+
+        while len(self._flying) >= 2 * self.workers:
+            self._wait()
+        self._flying.append((index, self._pool.apply_async(
+            _process_clusters, (data, True))))
+
+    def write(self, data):
+        """Write data to the image"""
+        if not isinstance(data, str):  # The clusters are kept for processing
+            data = str(data)
+        if self._buf_size == 0 and len(data) % CLUSTER_SIZE == 0:
+            self._submit(data)
+            return
+
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size < CLUSTER_SIZE:
+            return
+
+        buf = ''.join(self._buf)
+        whole = len(buf) - len(buf) % CLUSTER_SIZE
+        self._submit(buf[:whole])
+        rest = buf[whole:]
+        self._buf = [rest] if rest else []
+        self._buf_size = len(rest)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Skip forward. The skipped area will read as zeros."""
+        if whence == os.SEEK_CUR:
+            offset += self._pos + self._buf_size
+        elif whence != os.SEEK_SET:
+            raise ValueError("Unsupported whence value: %d" % whence)
+
+        current = self._pos + self._buf_size
+        if offset < current:
+            raise ValueError("Qcow2Writer does not support seeking backwards")
+
+        # Complete the current partial cluster with zeros
+        if self._buf_size:
+            fill = min(offset - current, CLUSTER_SIZE - self._buf_size)
+            self.write('\x00' * fill)
+            current += fill
+
+        if self._buf_size == 0:
+            # Skip whole clusters and keep the rest as buffered zeros
+            skip = (offset - current) - (offset - current) % CLUSTER_SIZE
+            self._pos += skip
+            current += skip
+
+        if offset > current:
+            self.write('\x00' * (offset - current))
+
+    def truncate(self, size):
+        """Set the virtual size of the image"""
+        self.size = size
+
+    def _metadata_layout(self, l2_tables, data_end):
+        """Compute the location of the metadata after the data clusters.
+        The size of the refcount structures depends on the number of clusters
+        they need to cover, which includes themselves.
+        """
+        l1_size = max(1, (self.size + CLUSTER_SIZE * L2_ENTRIES - 1) //
+                      (CLUSTER_SIZE * L2_ENTRIES))
+        l1_clusters = _align(l1_size * 8, CLUSTER_SIZE) // CLUSTER_SIZE
+
+        first = data_end // CLUSTER_SIZE
+        fixed = first + len(l2_tables) + l1_clusters
+        rb_count = rt_clusters = 0
+        while True:
+            total = fixed + rb_count + rt_clusters
+            new_rb_count = (total + REFCOUNT_ENTRIES - 1) // REFCOUNT_ENTRIES
+            new_rt_clusters = max(1, (new_rb_count * 8 + CLUSTER_SIZE - 1) //
+                                  CLUSTER_SIZE)
+            if (new_rb_count, new_rt_clusters) == (rb_count, rt_clusters):
+                break
+            rb_count, rt_clusters = new_rb_count, new_rt_clusters
+
+        return l1_size, l1_clusters, rb_count, rt_clusters
+
+    def close(self):
+        """Write the remaining data and the metadata of the image. The
+        underlying file object is not closed.
+        """
+        if self._buf_size:
+            self._submit(''.join(self._buf))
+            self._buf = []
+            self._buf_size = 0
+
+        if self._pool is not None:
+            try:
+                while self._flying:
+                    self._wait()
+            finally:
+                self._pool.close()
+                self._pool.join()
+
+        data_end = _align(self._host, CLUSTER_SIZE)
+
+        l2_tables = sorted(set(i // L2_ENTRIES for i in self._l2))
+        l1_size, l1_clusters, rb_count, rt_clusters = \
+            self._metadata_layout(l2_tables, data_end)
+
+        refcounts = dict(self._refcounts)
+        refcounts[0] = 1  # The header
+
+        # L2 tables
+        offset = data_end
+        l1 = [0] * l1_size
+        for table in l2_tables:
+            entries = [self._l2.get(table * L2_ENTRIES + i, 0)
+                       for i in xrange(L2_ENTRIES)]
+            self.fileobj.seek(offset)
+            self.fileobj.write(struct.pack('>%dQ' % L2_ENTRIES, *entries))
+            l1[table] = offset | OFLAG_COPIED
+            refcounts[offset // CLUSTER_SIZE] = 1
+            offset += CLUSTER_SIZE
+
+        # L1 table
+        l1_offset = offset
+        self.fileobj.seek(l1_offset)
+        self.fileobj.write(struct.pack('>%dQ' % l1_size, *l1))
+        for i in xrange(l1_clusters):
+            refcounts[l1_offset // CLUSTER_SIZE + i] = 1
+        offset += l1_clusters * CLUSTER_SIZE
+
+        # Refcount blocks and refcount table
+        rb_offset = offset
+        rt_offset = rb_offset + rb_count * CLUSTER_SIZE
+        for i in xrange(rb_count + rt_clusters):
+            refcounts[rb_offset // CLUSTER_SIZE + i] = 1
+
+        table = []
+        for block in xrange(rb_count):
+            counts = [refcounts.get(block * REFCOUNT_ENTRIES + i, 0)
+                      for i in xrange(REFCOUNT_ENTRIES)]
+            self.fileobj.seek(rb_offset + block * CLUSTER_SIZE)
+            self.fileobj.write(struct.pack('>%dH' % REFCOUNT_ENTRIES,
+                                           *counts))
+            table.append(rb_offset + block * CLUSTER_SIZE)
+
+        table += [0] * (rt_clusters * CLUSTER_SIZE // 8 - len(table))
+        self.fileobj.seek(rt_offset)
+        self.fileobj.write(struct.pack('>%dQ' % len(table), *table))
+
+        # The header
+        header = struct.pack(
+            '>4sIQIIQIIQQIIQQQQII', MAGIC, VERSION, 0, 0, CLUSTER_BITS,
+            self.size, 0, l1_size, l1_offset, rt_offset, rt_clusters, 0, 0,
+            0, 0, 0, REFCOUNT_ORDER, HEADER_LENGTH)
+        assert len(header) == HEADER_LENGTH
+        self.fileobj.seek(0)
+        self.fileobj.write(header)
+        # End of header extensions
+        self.fileobj.write(struct.pack('>II', 0, 0))
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides a disk cache for the information the program needs
+to get from a Synnefo deployment before it can talk to its services.
+
+The service endpoints, the user ID and the names of the containers that are
+known to exist are kept per (authentication URL, token) pair and expire
+after a while, so that consecutive runs of the program do not ask for them
+again.
+"""
+
+import os
+import json
+import time
+import errno
+import hashlib
+
+# Time in seconds after which the cached information is refreshed
+SESSION_TTL = 3600
+
+
+def cache_dir():
+    """Returns the directory where the session caches are stored"""
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'snf-image-creator')
+
+
+class SessionCache(object):
+    """Cached information about a cloud account"""
+
+    def __init__(self, url, token, ttl=SESSION_TTL, directory=None):
+        """Create a SessionCache instance, loading any fresh information
+        stored by a previous run.
+        """
+        self.ttl = ttl
+        self.directory = cache_dir() if directory is None else directory
+
+        # The token is not stored, only used for telling sessions apart
+        key = hashlib.sha1(json.dumps([url, token])).hexdigest()
+        self.path = os.path.join(self.directory, 'session-%s.json' % key)
+
+        self.endpoints = {}
+        self.user_id = None
+        self.containers = set()
+        self.created = None
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        try:
+            created = float(data['created'])
+            if not 0 <= time.time() - created < self.ttl:
+                return
+            self.created = created
+            self.user_id = data['user_id']
+            self.endpoints = dict(data['endpoints'])
+            self.containers = set(data['containers'])
+        except (KeyError, TypeError, ValueError):
+            self.invalidate()
+
+    @property
+    def valid(self):
+        """True if the account information is cached"""
+        return self.created is not None and self.user_id is not None
+
+    def update(self, user_id, endpoints):
+        """Replace the cached account information"""
+        self.user_id = user_id
+        self.endpoints = dict(endpoints)
+        self.containers = set()
+        self.created = time.time()
+        self.save()
+
+    def add_container(self, container):
+        """Record that a container exists"""
+        if container not in self.containers:
+            self.containers.add(container)
+            self.save()
+
+    def remove_container(self, container):
+        """Forget a container that turned out to be missing"""
+        if container in self.containers:
+            self.containers.discard(container)
+            self.save()
+
+    def invalidate(self):
+        """Drop the cached information"""
+        self.endpoints = {}
+        self.user_id = None
+        self.containers = set()
+        self.created = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def save(self):
+        """Store the cached information. A cache that cannot be written is
+        not an error.
+        """
+        if not self.valid:
+            return
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return
+
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'created': self.created,
+                           'user_id': self.user_id,
+                           'endpoints': self.endpoints,
+                           'containers': sorted(self.containers)}, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2018 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the code for uploading the blocks of a file to a
+Pithos+ container over multiple connections.
+
+Each worker thread uses its own Pithos+ client and thus its own HTTP
+connection. The number of blocks that are uploaded concurrently adapts to
+the observed latency and errors: it grows while the blocks get uploaded at
+a steady pace and shrinks when the latency increases or requests fail.
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+import Queue
+
+from kamaki.clients import ClientError
+
+from image_creator.util import FatalError
+
+DEFAULT_WORKERS = 8
+RETRIES = 5
+
+# Minimum interval in seconds between two saves of an upload manifest
+MANIFEST_SAVE_INTERVAL = 5
+
+
+class UploadManifest(object):
+    """Persistent record of the blocks of an upload that were confirmed by
+    the storage service.
+
+    The manifest is stored in a directory that survives the program, keyed
+    by the checksum of the image and the remote location. If an upload is
+    interrupted, the next upload of the same image to the same location
+    finds it and knows which blocks were already sent.
+    """
+
+    def __init__(self, directory, checksum, container, remote_path,
+                 account=None):
+        """Create an UploadManifest instance, loading any previous record of
+        this upload. account identifies the storage service account the
+        image is uploaded to.
+        """
+        self.checksum = checksum
+        self.container = container
+        self.remote_path = remote_path
+        self.account = account
+
+        key = hashlib.sha1(json.dumps(
+            [checksum, account, container, remote_path])).hexdigest()
+        self.path = os.path.join(directory,
+                                 '.snf-image-creator-upload-%s.json' % key)
+        self.confirmed = set()
+        self._saved = 0
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if [data.get('checksum'), data.get('account'), data.get('container'),
+                data.get('remote_path')] == [checksum, account, container,
+                                             remote_path]:
+            self.confirmed = set(str(h) for h in data.get('confirmed', []))
+
+    def confirm(self, block_hash):
+        """Record a block as uploaded"""
+        self.confirmed.add(block_hash)
+        if time.time() - self._saved >= MANIFEST_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """Write the manifest to the disk"""
+        tmp = "%s.tmp" % self.path
+        with open(tmp, 'w') as f:
+            json.dump({'checksum': self.checksum,
+                       'account': self.account,
+                       'container': self.container,
+                       'remote_path': self.remote_path,
+                       'confirmed': sorted(self.confirmed)}, f)
+        os.rename(tmp, self.path)
+        self._saved = time.time()
+
+    def remove(self):
+        """Remove the manifest after the upload has completed"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class AdaptiveLimit(object):
+    """Limits the number of concurrent requests.
+
+    The limit follows an additive increase, multiplicative decrease scheme.
+    It is increased by one for each window of successful requests, it is
+    decreased by one if the latency of a request is more than twice the
+    lowest observed one and it is halved when a request fails.
+    """
+
+    def __init__(self, initial, maximum):
+        """Create an AdaptiveLimit instance"""
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self._active = 0
+        self._best = None  # The lowest latency per byte
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait until a new request may start"""
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, latency=None, size=0):
+        """Mark a request as finished. If latency is None, the request
+        failed.
+        """
+        with self._cond:
+            self._active -= 1
+            if latency is None:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                per_byte = latency / max(size, 1)
+                if self._best is None or per_byte < self._best:
+                    self._best = per_byte
+                if per_byte > 2 * self._best:
+                    self.limit = max(1.0, self.limit - 1)
+                else:
+                    self.limit = min(self.maximum,
+                                     self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class BlockUploader(object):
+    """Uploads the blocks of a file to a Pithos+ container using a pool of
+    worker threads.
+    """
+
+    def __init__(self, new_client, workers=DEFAULT_WORKERS, retries=RETRIES):
+        """Create a BlockUploader instance. new_client is called by each
+        worker to create the Pithos+ client it will use.
+        """
+        self.new_client = new_client
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.limit = AdaptiveLimit(min(2, self.workers), self.workers)
+        self._lock = threading.Lock()
+
+    def _read(self, file_obj, offset, length):
+        """Read a block of the file. The file object is shared among the
+        workers.
+        """
+        with self._lock:
+            file_obj.seek(offset)
+            return file_obj.read(length)
+
+    def _send(self, client, block_hash, data):
+        """Upload a block once. Returns False if the request failed in a
+        way that may be retried.
+        """
+        self.limit.acquire()
+        start = time.time()
+        try:
+            r = client.container_post(
+                update=True, content_type='application/octet-stream',
+                content_length=len(data), data=data, format='json')
+        except ClientError as e:
+            self.limit.release()
+            if e.status and e.status < 500 and e.status != 408:
+                raise
+            return False
+        except (socket.error, IOError):
+            self.limit.release()
+            return False
+
+        self.limit.release(time.time() - start, len(data))
+        return r.json[0] == block_hash
+
+    def _worker(self):
+        """Body of a worker thread"""
+        try:
+            client = self.new_client()
+            while True:
+                task = self._tasks.get()
+                if task is None or self._stop.is_set():
+                    return
+
+                block_hash, data = task
+                if callable(data):
+                    data = data()
+                for attempt in xrange(self.retries + 1):
+                    if self._send(client, block_hash, data):
+                        break
+                    if attempt == self.retries:
+                        raise FatalError("Uploading block %s failed after %d "
+                                         "attempts" % (block_hash,
+                                                       attempt + 1))
+                    time.sleep(min(2 ** attempt, 30))
+                self._results.put((block_hash, len(data)))
+        except BaseException as e:
+            self._results.put((None, e))
+
+    def start(self, progress=None, manifest=None):
+        """Start the workers. Blocks are then queued for uploading using
+        submit() and finish() waits for all of them to complete.
+
+        If progress is defined, it is called from the thread that submits
+        the blocks with the number of bytes uploaded so far. If manifest is
+        defined, every uploaded block is recorded there.
+        """
+        self._progress = progress
+        self._manifest = manifest
+        self._sent = 0
+        self._pending = 0
+        self._stop = threading.Event()
+        # Limit the number of blocks kept in memory
+        self._tasks = Queue.Queue(2 * self.workers)
+        self._results = Queue.Queue()
+        self._threads = [threading.Thread(target=self._worker)
+                         for _ in xrange(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _collect(self, block=False):
+        """Process the results of the workers. If block is True, wait for
+        one result.
+        """
+        while self._pending:
+            try:
+                # Waiting with a timeout lets signals reach the main thread
+                block_hash, item = self._results.get(block, 1)
+            except Queue.Empty:
+                if block:
+                    continue
+                return
+
+            if block_hash is None:
+                # Nothing else is waited for after a failure
+                self._stop.set()
+                self._pending = 0
+                raise item
+            self._pending -= 1
+            self._sent += item
+            if self._manifest is not None:
+                self._manifest.confirm(block_hash)
+            if self._progress is not None:
+                self._progress(self._sent)
+            if block:
+                return
+
+    def submit(self, block_hash, data):
+        """Queue a block for uploading. data is either the content of the
+        block or a function that returns it. This blocks if the workers
+        cannot keep up.
+        """
+        self._pending += 1
+        while True:
+            self._collect()
+            try:
+                self._tasks.put((block_hash, data), True, 1)
+                return
+            except Queue.Full:
+                pass
+
+    def finish(self):
+        """Wait for all the queued blocks to be uploaded and stop the
+        workers. The total number of bytes uploaded is returned.
+        """
+        try:
+            while self._pending:
+                self._collect(True)
+        finally:
+            self._stop.set()
+            # Unblock the workers
+            while True:
+                try:
+                    self._tasks.get_nowait()
+                except Queue.Empty:
+                    break
+            for thread in self._threads:
+                self._tasks.put(None)
+            for thread in self._threads:
+                thread.join()
+            if self._manifest is not None:
+                self._manifest.save()
+
+        return self._sent
+
+    def upload(self, file_obj, hashmap, missing, progress=None,
+               manifest=None):
+        """Upload the blocks of a file whose hashes are listed in missing.
+        The blocks are located using the hashmap of the file and are read
+        by the workers.
+
+        See start() for progress and manifest. The total number of bytes
+        uploaded is returned.
+        """
+        index = dict((h, i) for i, h in enumerate(hashmap.hashes))
+
+        def reader(block_hash):
+            """Returns a function that reads a block of the file"""
+            offset, length = hashmap.block_range(index[block_hash])
+            return lambda: self._read(file_obj, offset, length)
+
+        self.start(progress, manifest)
+        try:
+            for block_hash in set(missing):
+                self.submit(block_hash, reader(block_hash))
+        finally:
+            sent = self.finish()
+        return sent
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :